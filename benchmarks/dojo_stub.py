@@ -0,0 +1,332 @@
+# Local stand-in for a Dojo (v2 API) and for the OXT api
+# Serves the endpoints used by the node subsystem so the address monitor
+# can be tested and load tested offline:
+#   POST /v2/auth/login      {apikey} -> access and refresh tokens
+#   POST /v2/auth/refresh    {rt} -> new access token
+#   GET  /v2/multiaddr       active=<addr|xpub>|<addr|xpub>...
+#   GET  /v2/xpub/<xpub>
+#   POST /v2/xpub            (accepted and ignored)
+#   GET  /v2/txs             active=<addr|xpub>&page=&count=
+#   GET  /v2/status
+#   GET  /oxt/addresses/<address>
+#   GET  /oxt/lastblock
+# Data comes from SyntheticWallets - reproducible (same seed = same data)
+# addresses and xpubs with any number of transactions.
+#
+# Options:
+#   latency         seconds added to each request
+#   failure_rate    fraction of requests answered with an error (a 500
+#                   or a Dojo style {"status": "error"} at random)
+#   token_ttl       seconds an access token is valid - expired tokens get
+#                   "Invalid JSON Web Token" as a real Dojo would
+#
+# Usage:
+#     wallets = SyntheticWallets(addresses=2000, xpubs=10)
+#     stub = DojoStub(wallets, latency=0.05, failure_rate=0.01)
+#     stub.start()
+#     stub.redirect(workdir)  # Dojo settings and OXT url to the stub
+#     ...
+#     stub.stop()             # restores the settings and stops the server
+import base64
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+from benchmarks.provider_stub import ThreadingHTTPServer
+
+API_KEY = 'benchmark'
+# Block height of the synthetic chain tip
+TIP = 650000
+INVALID_TOKEN = 'Invalid JSON Web Token'
+
+
+def synthetic_id(prefix, seed, i, length=40):
+    digest = hashlib.sha256(f"{prefix}-{seed}-{i}".encode()).hexdigest()
+    return (prefix + digest[:length])
+
+
+def jwt(kind, ttl):
+    # Unsigned token in the JWT format (the node code only reads exp)
+    def encode(data):
+        return base64.urlsafe_b64encode(
+            json.dumps(data).encode()).decode().rstrip('=')
+    payload = {'type': kind, 'exp': int(time.time() + ttl),
+               'nonce': random.random()}
+    return ('.'.join([encode({'alg': 'none'}), encode(payload), 'stub']))
+
+
+class SyntheticWallets():
+    def __init__(self, addresses=1000, xpubs=10, txs_per_address=5,
+                 txs_per_xpub=200, seed=42):
+        self.seed = seed
+        self.tip = TIP
+        self.addresses = [synthetic_id('bc1qsyn', seed, i)
+                          for i in range(addresses)]
+        self.xpubs = [synthetic_id('xpub6syn', seed, i, 100)
+                      for i in range(xpubs)]
+        self.n_txs = dict.fromkeys(self.addresses, txs_per_address)
+        self.n_txs.update(dict.fromkeys(self.xpubs, txs_per_xpub))
+        # New transactions (see receive) - {wallet: [tx]}
+        self.extra = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, wallet):
+        return (wallet in self.n_txs)
+
+    def transactions(self, wallet):
+        # Newest first, as returned by Dojo. Generated on request so large
+        # wallets do not use memory while not in use.
+        rnd = random.Random(f"{self.seed}-{wallet}")
+        n = self.n_txs.get(wallet, 0)
+        heights = sorted((rnd.randint(self.tip - 200000, self.tip)
+                          for _ in range(n)), reverse=True)
+        txs = list(self.extra.get(wallet, []))
+        balance = 0
+        history = []
+        for i, height in enumerate(reversed(heights)):
+            # Mostly receives - balance never goes negative
+            amount = rnd.randint(10000, 5000000)
+            if balance > amount and rnd.random() < 0.4:
+                amount = -amount
+            balance += amount
+            history.append({
+                'hash': hashlib.sha256(
+                    f"{wallet}-{i}".encode()).hexdigest(),
+                'time': 1231006505 + height * 600,
+                'block_height': height,
+                'result': amount
+            })
+        return (txs + list(reversed(history)))
+
+    def balance(self, wallet):
+        return (sum(tx['result'] for tx in self.transactions(wallet)))
+
+    def receive(self, count=1, amount=100000):
+        # Adds a new transaction (at a new block) to count random
+        # wallets - the next refresh should detect these changes
+        with self._lock:
+            self.tip += 1
+            wallets = random.Random(self.tip).sample(
+                list(self.n_txs), min(count, len(self.n_txs)))
+            for wallet in wallets:
+                self.extra.setdefault(wallet, []).insert(0, {
+                    'hash': hashlib.sha256(
+                        f"{wallet}-new-{self.tip}".encode()).hexdigest(),
+                    'time': int(time.time()),
+                    'block_height': self.tip,
+                    'result': amount
+                })
+        return (wallets)
+
+
+class DojoHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        stub = self.server.stub
+        url = urllib.parse.urlparse(self.path)
+        args = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length') or 0)
+            form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+            args.update({k: v[0] for k, v in form.items()})
+        status, data = stub.handle(method, url.path, args)
+        self._reply(data, status)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class DojoStub():
+    def __init__(self, wallets, host='127.0.0.1', port=0, latency=0,
+                 failure_rate=0, token_ttl=900, seed=42):
+        # port=0 picks any free port
+        self.wallets = wallets
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+        self.requests = {}
+        self.failures = 0
+        self.tokens = {}
+        self.server = ThreadingHTTPServer((host, port), DojoHandler)
+        self.server.stub = self
+        self.onion = f"{host}:{self.server.server_address[1]}"
+        self.url = f"http://{self.onion}"
+        self._lock = threading.Lock()
+        self._thread = None
+        self._original = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return (self)
+
+    def stop(self):
+        self.restore()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def redirect(self, workdir):
+        # Dojo settings are written to a temporary api_keys.conf so the
+        # user's settings are not changed
+        from thewarden.node import utils
+        from thewarden.pricing_engine.pricing import api_keys_class
+        self._original = (api_keys_class.filename, utils.OXT_URL)
+        api_keys_class.filename = os.path.join(workdir, 'api_keys.conf')
+        settings = api_keys_class.loader()
+        settings['dojo'] = {'onion': self.onion, 'api_key': API_KEY,
+                            'token': 'error'}
+        api_keys_class.saver(settings)
+        utils.OXT_URL = self.url + '/oxt'
+
+    def restore(self):
+        if self._original is None:
+            return
+        from thewarden.node import utils
+        from thewarden.pricing_engine.pricing import api_keys_class
+        api_keys_class.filename, utils.OXT_URL = self._original
+        self._original = None
+
+    @property
+    def total_requests(self):
+        return (sum(self.requests.values()))
+
+    def expire_tokens(self):
+        # Next requests get "Invalid JSON Web Token"
+        with self._lock:
+            self.tokens = {}
+
+    def handle(self, method, path, args):
+        # Returns (http status, json data)
+        route = path.rstrip('/')
+        name = route.split('/')[2] if route.count('/') >= 2 else route
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            with self._lock:
+                self.failures += 1
+            if self.random.random() < 0.5:
+                return 500, {'status': 'error', 'error': 'Injected failure'}
+            return 200, {'status': 'error', 'error': 'Injected failure'}
+
+        if route.startswith('/oxt/'):
+            return self.oxt(route[len('/oxt/'):])
+        if route == '/v2/auth/login' and method == 'POST':
+            return self.login(args)
+        if route == '/v2/auth/refresh' and method == 'POST':
+            return self.refresh(args)
+        if not self.valid(args.get('at')):
+            return 401, {'status': 'error', 'error': INVALID_TOKEN}
+        if route == '/v2/multiaddr':
+            return self.multiaddr(args)
+        if route == '/v2/txs':
+            return self.txs(args)
+        if route == '/v2/status':
+            return self.status()
+        if route == '/v2/xpub' and method == 'POST':
+            return 200, {'status': 'ok'}
+        if route.startswith('/v2/xpub/'):
+            return self.xpub(route[len('/v2/xpub/'):])
+        return 404, {'status': 'error', 'error': f'Unknown path {path}'}
+
+    # Auth
+    def _issue(self):
+        access = jwt('access-token', self.token_ttl)
+        refresh = jwt('refresh-token', self.token_ttl * 8)
+        with self._lock:
+            self.tokens[access] = time.time() + self.token_ttl
+            self.tokens[refresh] = time.time() + self.token_ttl * 8
+        return (access, refresh)
+
+    def valid(self, token):
+        with self._lock:
+            return (self.tokens.get(token, 0) > time.time())
+
+    def login(self, args):
+        if args.get('apikey') != API_KEY:
+            return 401, {'status': 'error', 'error': 'Invalid API key'}
+        access, refresh = self._issue()
+        return 200, {'authorizations': {'access_token': access,
+                                        'refresh_token': refresh}}
+
+    def refresh(self, args):
+        if not self.valid(args.get('rt')):
+            return 401, {'status': 'error', 'error': INVALID_TOKEN}
+        access, __ = self._issue()
+        return 200, {'authorizations': {'access_token': access}}
+
+    # Dojo
+    def multiaddr(self, args):
+        addresses = []
+        for wallet in args.get('active', '').split('|'):
+            if wallet not in self.wallets:
+                continue
+            txs = self.wallets.transactions(wallet)
+            addresses.append({
+                'address': wallet,
+                'final_balance': sum(tx['result'] for tx in txs),
+                'n_tx': len(txs)
+            })
+        return 200, {'addresses': addresses, 'txs': [],
+                     'info': {'latest_block': {'height': self.wallets.tip}}}
+
+    def txs(self, args):
+        wallet = args.get('active', '')
+        page = int(args.get('page', 0))
+        count = min(int(args.get('count', 10)), 100)
+        txs = self.wallets.transactions(wallet) if wallet in self.wallets \
+            else []
+        return 200, {'n_tx': len(txs), 'page': page, 'n_tx_page': count,
+                     'txs': txs[page * count:(page + 1) * count]}
+
+    def xpub(self, xpub):
+        if xpub not in self.wallets:
+            return 200, {'status': 'error', 'error': 'Unknown xpub'}
+        txs = self.wallets.transactions(xpub)
+        return 200, {'status': 'ok', 'data': {
+            'balance': sum(tx['result'] for tx in txs),
+            'n_tx': len(txs),
+            'unused': {'external': 0, 'internal': 0},
+            'derivation': 'BIP84',
+            'created': 1554000000
+        }}
+
+    def status(self):
+        return 200, {'uptime': '1:00:00:00', 'memory': '100 MiB',
+                     'blocks': self.wallets.tip,
+                     'indexer': {'type': 'local', 'maxHeight': self.wallets.tip}}
+
+    # OXT
+    def oxt(self, path):
+        if path == 'lastblock':
+            return 200, {'data': [{'height': self.wallets.tip}]}
+        if path.startswith('addresses/'):
+            address = path[len('addresses/'):]
+            if address not in self.wallets:
+                return 200, {'data': []}
+            txs = self.wallets.transactions(address)
+            return 200, {'data': [{'stats': {
+                'bl': sum(tx['result'] for tx in txs),
+                'nt': len(txs)}}]}
+        return 404, {'error': f'Unknown path {path}'}
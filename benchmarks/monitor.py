@@ -0,0 +1,216 @@
+# Benchmark for the Bitcoin address monitor (node subsystem)
+# Measures end to end refresh throughput of node/monitor.py and the
+# transaction sync of node/txcache.py against the local Dojo / OXT
+# stand-in (benchmarks/dojo_stub.py). Everything runs offline with a
+# temporary database and api_keys.conf.
+#
+# Scenarios:
+#   refresh_all       refresh of every monitored address and xpub
+#   refresh_changes   refresh after new transactions at --changes wallets
+#                     (checks that all changes were detected)
+#   token_expired     refresh right after Dojo expired all tokens
+#   txs_sync_cold     first sync of the largest xpub
+#   txs_sync_warm     incremental sync of the same xpub
+#
+# Run from the base folder (where config.ini is located):
+#     python -m benchmarks.monitor
+#     python -m benchmarks.monitor --addresses 5000 --latency 0.2
+#     python -m benchmarks.monitor --failure-rate 0.05 --oxt-share 0.1
+#     python -m benchmarks.monitor --save monitor_baseline
+#     python -m benchmarks.monitor --compare monitor_baseline
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from benchmarks.dojo_stub import DojoStub, SyntheticWallets
+from benchmarks.run import (BASELINE_FOLDER, USERNAME, compare, environment,
+                            measure, setup_app)
+
+
+def load_wallets(wallets, oxt_share):
+    # Monitored addresses (check method 1: Dojo, 2: OXT, 3: Dojo then OXT)
+    # and xpubs for the benchmark user
+    from thewarden import db
+    from thewarden.models import AccountInfo, BitcoinAddresses, User
+    BitcoinAddresses.query.filter_by(user_id=USERNAME).delete()
+    AccountInfo.query.filter_by(user_id=USERNAME).delete()
+    user = User.query.filter_by(username=USERNAME).first()
+    if user is None:
+        user = User(username=USERNAME, email=f"{USERNAME}@localhost",
+                    password='-')
+        db.session.add(user)
+    account = AccountInfo(user_id=USERNAME, account_longname='Benchmark',
+                          check_method='1', auto_check=True)
+    db.session.add(account)
+    db.session.flush()
+    n_oxt = int(len(wallets.addresses) * oxt_share)
+    rows = [{
+        'user_id': USERNAME,
+        'account_id': account.account_id,
+        'address_hash': address,
+        'auto_check': True,
+        'check_method': '2' if i < n_oxt else ('3' if i % 10 == 0 else '1')
+    } for i, address in enumerate(wallets.addresses)]
+    db.session.bulk_insert_mappings(BitcoinAddresses, rows)
+    db.session.bulk_insert_mappings(AccountInfo, [{
+        'user_id': USERNAME,
+        'account_longname': f"HD Wallet {i}",
+        'account_blockchain_id': xpub,
+        'auto_check': True,
+        'check_method': '1'
+    } for i, xpub in enumerate(wallets.xpubs)])
+    db.session.commit()
+    return (user)
+
+
+def clear_txcache(address):
+    from thewarden import db
+    from thewarden.models import AddressSyncCursor, BitcoinTransactions
+    from thewarden.node.txcache import ensure_tables
+    ensure_tables()
+    BitcoinTransactions.query.filter_by(address=address).delete()
+    AddressSyncCursor.query.filter_by(address=address).delete()
+    db.session.commit()
+
+
+def run(app, stub, args):
+    from thewarden.node.monitor import refresh_balances
+    from thewarden.node.txcache import sync_transactions
+
+    wallets = stub.wallets
+    n_wallets = len(wallets.addresses) + len(wallets.xpubs)
+    results = {}
+    checks = {}
+
+    def refresh_all():
+        return (refresh_balances(USERNAME))
+
+    def refresh_changes():
+        changed = wallets.receive(args.changes)
+        found = refresh_balances(USERNAME)
+        detected = [address for address in changed
+                    if found.get(address, {}).get('change')]
+        checks.setdefault('refresh_changes', []).append(
+            len(detected) == len(changed))
+
+    def token_expired():
+        stub.expire_tokens()
+        found = refresh_balances(USERNAME)
+        checks.setdefault('token_expired', []).append(
+            all(result.get('success') for result in found.values()))
+
+    xpub = max(wallets.xpubs, key=lambda x: wallets.n_txs[x]) \
+        if wallets.xpubs else None
+
+    def txs_sync_cold():
+        clear_txcache(xpub)
+        sync_transactions(xpub)
+
+    def txs_sync_warm():
+        sync_transactions(xpub)
+
+    scenarios = {
+        'refresh_all': refresh_all,
+        'refresh_changes': refresh_changes,
+        'token_expired': token_expired
+    }
+    if xpub is not None:
+        scenarios['txs_sync_cold'] = txs_sync_cold
+        scenarios['txs_sync_warm'] = txs_sync_warm
+
+    with app.app_context():
+        load_wallets(wallets, args.oxt_share)
+        # First login is not part of the measures
+        from thewarden.node.dojo_token import token_manager
+        token_manager.token(force=True)
+        for name, func in scenarios.items():
+            before = stub.total_requests
+            results[name] = measure(func, args.repeat)
+            # warm up + repeat + memory run
+            runs = args.repeat + 2
+            results[name]['requests'] = round(
+                (stub.total_requests - before) / runs, 1)
+            if name.startswith('refresh') or name == 'token_expired':
+                results[name]['wallets_per_s'] = round(
+                    n_wallets / max(results[name]['median_ms'], 0.001) *
+                    1000, 1)
+            status = ''
+            if name in checks:
+                status = '  ok' if all(checks[name]) else '  << FAILED'
+            print(f"{name:<16} median {results[name]['median_ms']:>10.1f} ms  " +
+                  f"peak {results[name]['peak_kb']:>10.1f} KB  " +
+                  f"requests {results[name]['requests']:>8}{status}")
+    results['_requests'] = dict(stub.requests)
+    results['_failures'] = stub.failures
+    failed = [name for name, passed in checks.items() if not all(passed)]
+    return results, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark for the Bitcoin address monitor")
+    parser.add_argument('--addresses', type=int, default=2000)
+    parser.add_argument('--xpubs', type=int, default=10)
+    parser.add_argument('--txs-per-address', type=int, default=5)
+    parser.add_argument('--txs-per-xpub', type=int, default=2000)
+    parser.add_argument('--oxt-share', type=float, default=0,
+                        help="fraction of addresses checked at OXT")
+    parser.add_argument('--changes', type=int, default=10,
+                        help="wallets with new transactions per run")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds added to each stub request")
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help="fraction of stub requests that fail")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', metavar='NAME',
+                        help="save results as benchmarks/baselines/NAME.json")
+    parser.add_argument('--compare', metavar='NAME',
+                        help="compare results with a saved baseline")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="ratio over baseline flagged as a regression")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BASELINE_FOLDER, args.compare + '.json')) as fp:
+            baseline = json.load(fp)
+
+    wallets = SyntheticWallets(args.addresses, args.xpubs,
+                               args.txs_per_address, args.txs_per_xpub,
+                               seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix='warden_benchmark_')
+    stub = DojoStub(wallets, latency=args.latency,
+                    failure_rate=args.failure_rate, seed=args.seed).start()
+    try:
+        app = setup_app(workdir)
+        stub.redirect(workdir)
+        results, failed = run(app, stub, args)
+    finally:
+        stub.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    results = {'monitor': results}
+
+    if args.save:
+        os.makedirs(BASELINE_FOLDER, exist_ok=True)
+        filename = os.path.join(BASELINE_FOLDER, args.save + '.json')
+        with open(filename, 'w') as fp:
+            json.dump({'environment': environment(),
+                       'options': vars(args),
+                       'results': results}, fp, indent=2)
+        print(f"\nBaseline saved to {filename}")
+
+    if baseline is not None:
+        if compare(results, baseline, args.threshold) > 0:
+            return (1)
+    # Injected failures make the checks fail by design
+    if failed and not args.failure_rate:
+        return (1)
+    return (0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+# Local stand-in for the CryptoCompare price provider
+# Serves the endpoints used by the pricing engine from a SyntheticPortfolio:
+#   /data/histoday          historical prices (ccdigital, ccfx)
+#   /data/price             realtime price (ccrealtime)
+#   /data/pricemultifull    multiple realtime prices (ccrealtimefull)
+# Any other path returns a CryptoCompare style error so the pricing
+# engine falls back as it would with a real provider.
+#
+# Usage:
+#     stub = ProviderStub(portfolio, latency=0.05)
+#     stub.start()
+#     stub.redirect()     # points PROVIDER_LIST to the stub
+#     ...
+#     stub.stop()         # restores PROVIDER_LIST and stops the server
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# PROVIDER_LIST keys redirected to the stub and the path they use
+REDIRECTS = {
+    'cc_digital': '/data/histoday',
+    'cc_fx': '/data/histoday',
+    'cc_realtime': '/data/price',
+    'cc_realtime_full': '/data/pricemultifull'
+}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.requests += 1
+        if stub.latency:
+            time.sleep(stub.latency)
+        url = urllib.parse.urlparse(self.path)
+        args = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        routes = {
+            '/data/histoday': stub.histoday,
+            '/data/price': stub.price,
+            '/data/pricemultifull': stub.pricemultifull
+        }
+        try:
+            data = routes[url.path](args)
+        except KeyError:
+            data = {'Response': 'Error', 'Message': f'Unknown path {url.path}'}
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ProviderStub():
+    def __init__(self, portfolio, host='127.0.0.1', port=0, latency=0):
+        # port=0 picks any free port. latency in seconds per request
+        self.portfolio = portfolio
+        self.latency = latency
+        self.requests = 0
+        self.server = ThreadingHTTPServer((host, port), StubHandler)
+        self.server.stub = self
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self._thread = None
+        self._original_urls = {}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return (self)
+
+    def stop(self):
+        self.restore()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def redirect(self):
+        from thewarden.pricing_engine.pricing import PROVIDER_LIST
+        for key, path in REDIRECTS.items():
+            self._original_urls[key] = PROVIDER_LIST[key].base_url
+            PROVIDER_LIST[key].base_url = self.url + path
+
+    def restore(self):
+        from thewarden.pricing_engine.pricing import PROVIDER_LIST
+        for key, url in self._original_urls.items():
+            PROVIDER_LIST[key].base_url = url
+        self._original_urls = {}
+
+    # Endpoints
+    def _series(self, ticker):
+        if ticker in self.portfolio.prices:
+            return (self.portfolio.prices[ticker])
+        return (self.portfolio.fx.get(ticker))
+
+    def histoday(self, args):
+        # ccdigital passes the ticker as fsym, ccfx as tsym (fsym=USD)
+        ticker = args.get('fsym', '').upper()
+        if ticker == 'USD':
+            ticker = args.get('tsym', '').upper()
+        df = self._series(ticker)
+        if df is None:
+            return {'Response': 'Error',
+                    'Message': f'There is no data for {ticker}'}
+        df = df.sort_index()
+        data = [{
+            'time': int(date.timestamp()),
+            'close': row.close,
+            'open': row.open,
+            'high': row.high,
+            'low': row.low
+        } for date, row in zip(df.index, df.itertuples())]
+        return {'Response': 'Success', 'Data': data}
+
+    def price(self, args):
+        price = self.portfolio.realtime(args.get('fsym', '').upper())
+        if price is None:
+            return {'Response': 'Error', 'Message': 'market does not exist'}
+        return {'USD': price}
+
+    def pricemultifull(self, args):
+        tickers = args.get('fsyms', '').upper().split(',')
+        fx_list = args.get('tsyms', 'USD').upper().split(',')
+        raw = {}
+        display = {}
+        now = int(time.time())
+        for ticker in tickers:
+            price_usd = self.portfolio.realtime(ticker)
+            if price_usd is None:
+                continue
+            raw[ticker] = {}
+            display[ticker] = {}
+            for fx in fx_list:
+                rate = self.portfolio.realtime(fx) or 1
+                price = price_usd * rate
+                raw[ticker][fx] = {
+                    'PRICE': price,
+                    'HIGHDAY': price * 1.02,
+                    'LOWDAY': price * 0.98,
+                    'CHANGEPCT24HOUR': 0.5,
+                    'LASTUPDATE': now
+                }
+                display[ticker][fx] = {
+                    'MKTCAP': f"{fx} {price * 1e6:,.0f}",
+                    'VOLUME24HOURTO': f"{fx} {price * 1e3:,.0f}",
+                    'LASTMARKET': 'Stub'
+                }
+        if not raw:
+            return {'Response': 'Error', 'Message': 'No data'}
+        return {'RAW': raw, 'DISPLAY': display}
@@ -0,0 +1,246 @@
+# Benchmark runner for the portfolio analytics hot paths
+# Runs each function against a synthetic portfolio at several scales and
+# reports wall time (perf_counter) and peak memory (tracemalloc).
+# Everything runs offline:
+#   . a temporary SQLite database holds the synthetic user and trades
+#   . historical prices are written to pricing_data as fixtures
+#   . realtime prices come from a local stand-in for CryptoCompare
+#
+# Run from the base folder (where config.ini is located):
+#     python -m benchmarks.run
+#     python -m benchmarks.run --scales small,medium --repeat 5
+#     python -m benchmarks.run --save baseline
+#     python -m benchmarks.run --compare baseline
+# Baselines are saved as json files at benchmarks/baselines/. They depend
+# on the machine - compare only against baselines saved on the same one.
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.provider_stub import ProviderStub
+from benchmarks.synthetic import SCALES, PriceFixtures, SyntheticPortfolio
+
+BASELINE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'baselines')
+USERNAME = 'warden_benchmark'
+
+# Hot paths measured. Each entry receives the SyntheticPortfolio and
+# returns a callable with no arguments.
+BENCHMARKS = {
+    'transactions_fx': lambda u, p: u.transactions_fx,
+    'positions': lambda u, p: u.positions,
+    'positions_dynamic': lambda u, p: u.positions_dynamic,
+    'cost_calculation': lambda u, p: lambda: u.cost_calculation(p.tickers[0]),
+    'generatenav': lambda u, p: lambda: u.generatenav(USERNAME, force=True),
+    'heatmap_generator': lambda u, p: u.heatmap_generator
+}
+
+
+def clear_caches():
+    # Results are memoized with MWT - clear so each run does the full work
+    from thewarden.users.decorators import MWT
+    for cache in MWT._caches.values():
+        cache.clear()
+
+
+def measure(func, repeat):
+    # Returns timing (ms) and peak memory (KB) for func
+    clear_caches()
+    func()  # warm up (imports, file system cache)
+    times = []
+    for _ in range(repeat):
+        clear_caches()
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    clear_caches()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'min_ms': round(min(times), 2),
+        'median_ms': round(statistics.median(times), 2),
+        'mean_ms': round(statistics.mean(times), 2),
+        'peak_kb': round(peak / 1024, 1),
+        'runs': repeat
+    }
+
+
+def setup_app(workdir):
+    # Creates the Flask app with a temporary database and keeps the
+    # pricing engine state files away from the user's ones
+    import thewarden
+    from thewarden import create_app, db
+    from thewarden.node import http_cache
+    from thewarden.pricing_engine import pricing, rate_limiter
+
+    # No requests should leave this machine
+    thewarden.TOR['status'] = False
+    pricing.router.filename = os.path.join(workdir, 'routing_table.json')
+    pricing.negative_cache.filename = os.path.join(workdir,
+                                                   'negative_cache.json')
+    pricing.negative_cache.entries = {}
+    rate_limiter.ledger.filename = os.path.join(workdir,
+                                                'provider_quota.json')
+    http_cache.cache.folder = os.path.join(workdir, 'http_cache')
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        "sqlite:///" + os.path.join(workdir, 'benchmark.db'))
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+    return (app)
+
+
+def load_portfolio(portfolio, fx):
+    from thewarden import db
+    from thewarden.models import Trades, User
+    Trades.query.filter_by(user_id=USERNAME).delete()
+    user = User.query.filter_by(username=USERNAME).first()
+    if user is None:
+        user = User(username=USERNAME, email=f"{USERNAME}@localhost",
+                    password='-')
+        db.session.add(user)
+    user.image_file = fx
+    db.session.bulk_insert_mappings(Trades, portfolio.trades(USERNAME))
+    db.session.commit()
+    return (user)
+
+
+def run_scale(app, scale, args):
+    from flask_login import login_user
+    from thewarden.pricing_engine.pricing import current_path
+    from thewarden.users import utils
+
+    n_tickers, n_trades, n_fx, years = SCALES[scale]
+    portfolio = SyntheticPortfolio(n_tickers, n_trades, n_fx, years,
+                                   seed=args.seed)
+    folder = os.path.join(current_path(),
+                          'thewarden/pricing_engine/pricing_data')
+    stub = ProviderStub(portfolio, latency=args.latency).start()
+    stub.redirect()
+    results = {}
+    try:
+        with PriceFixtures(portfolio, folder), app.test_request_context():
+            user = load_portfolio(portfolio, args.fx)
+            login_user(user)
+            for name in args.only:
+                func = BENCHMARKS[name](utils, portfolio)
+                results[name] = measure(func, args.repeat)
+                print(f"{scale:>8} {name:<20} " +
+                      f"median {results[name]['median_ms']:>10.1f} ms  " +
+                      f"peak {results[name]['peak_kb']:>10.1f} KB")
+            try:
+                os.remove(utils.nav_filename())
+            except FileNotFoundError:
+                pass
+    finally:
+        stub.stop()
+    results['_requests'] = stub.requests
+    return (results)
+
+
+def environment():
+    import numpy
+    import pandas
+    return {
+        'date': datetime.now().strftime('%Y-%m-%d %H:%M'),
+        'python': platform.python_version(),
+        'pandas': pandas.__version__,
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor()
+    }
+
+
+def compare(results, baseline, threshold):
+    # Returns the number of regressions found
+    regressions = 0
+    print(f"\nComparing with baseline from {baseline['environment']['date']}")
+    for scale, benchmarks in results.items():
+        for name, current in benchmarks.items():
+            if name.startswith('_'):
+                continue
+            try:
+                previous = baseline['results'][scale][name]
+            except KeyError:
+                print(f"{scale:>8} {name:<20} not in baseline")
+                continue
+            ratio = current['median_ms'] / max(previous['median_ms'], 0.001)
+            mem_ratio = current['peak_kb'] / max(previous['peak_kb'], 0.001)
+            flag = ''
+            if ratio > threshold or mem_ratio > threshold:
+                flag = '  << REGRESSION'
+                regressions += 1
+            print(f"{scale:>8} {name:<20} time x{ratio:5.2f}  " +
+                  f"memory x{mem_ratio:5.2f}{flag}")
+    return (regressions)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the portfolio analytics hot paths")
+    parser.add_argument('--scales', default='small,medium',
+                        help=f"comma separated list from {list(SCALES)}")
+    parser.add_argument('--only', default=','.join(BENCHMARKS),
+                        help="comma separated list of functions")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--fx', default='USD',
+                        help="portfolio currency for the synthetic user")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds added to each provider stub request")
+    parser.add_argument('--save', metavar='NAME',
+                        help="save results as benchmarks/baselines/NAME.json")
+    parser.add_argument('--compare', metavar='NAME',
+                        help="compare results with a saved baseline")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="ratio over baseline flagged as a regression")
+    args = parser.parse_args(argv)
+    args.only = [name.strip() for name in args.only.split(',')]
+    scales = [scale.strip() for scale in args.scales.split(',')]
+    for name in args.only:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark {name}")
+    for scale in scales:
+        if scale not in SCALES:
+            parser.error(f"Unknown scale {scale}")
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BASELINE_FOLDER, args.compare + '.json')) as fp:
+            baseline = json.load(fp)
+
+    workdir = tempfile.mkdtemp(prefix='warden_benchmark_')
+    try:
+        app = setup_app(workdir)
+        results = {scale: run_scale(app, scale, args) for scale in scales}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        os.makedirs(BASELINE_FOLDER, exist_ok=True)
+        filename = os.path.join(BASELINE_FOLDER, args.save + '.json')
+        with open(filename, 'w') as fp:
+            json.dump({'environment': environment(),
+                       'scales': {s: SCALES[s] for s in scales},
+                       'results': results}, fp, indent=2)
+        print(f"\nBaseline saved to {filename}")
+
+    if baseline is not None:
+        if compare(results, baseline, args.threshold) > 0:
+            return (1)
+    return (0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+# Synthetic portfolio generator used by the benchmarks
+# Creates a reproducible portfolio (same seed = same data) with:
+#   . N tickers with random walk daily prices
+#   . M trades spread over Y years
+#   . K currencies (trades are booked in these currencies)
+# Prices are written in the same pickle format used by PriceData
+# (<TICKER>_<provider.name>.price) so the analytics run fully offline.
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# Scales used by the benchmark runner
+# name: (tickers, trades, currencies, years)
+SCALES = {
+    'small': (5, 200, 1, 2),
+    'medium': (20, 2000, 3, 5),
+    'large': (50, 10000, 5, 10)
+}
+
+# Currencies are real tickers so the user fx and the currency list
+# (static/json_files/currency.json) work as usual
+CURRENCIES = ['USD', 'EUR', 'GBP', 'JPY', 'BRL', 'CAD', 'CHF', 'AUD']
+
+
+class SyntheticPortfolio():
+    def __init__(self, tickers=5, trades=200, currencies=1, years=2,
+                 seed=42, end_date=None):
+        self.n_tickers = tickers
+        self.n_trades = trades
+        self.n_currencies = min(currencies, len(CURRENCIES))
+        self.years = years
+        self.seed = seed
+        self.random = np.random.RandomState(seed)
+        self.end_date = pd.Timestamp(end_date or datetime.now().date())
+        self.start_date = self.end_date - pd.DateOffset(years=years)
+        self.dates = pd.date_range(self.start_date, self.end_date, freq='D')
+        self.tickers = [f"SYN{i:03d}" for i in range(tickers)]
+        self.currencies = CURRENCIES[:self.n_currencies]
+        self.prices = {ticker: self._random_walk(
+            start=self.random.uniform(5, 5000), vol=0.04)
+            for ticker in self.tickers}
+        # FX prices are quoted as currency units per USD
+        self.fx = {currency: self._random_walk(
+            start=self.random.uniform(0.5, 150), vol=0.006)
+            for currency in self.currencies if currency != 'USD'}
+
+    def _random_walk(self, start, vol):
+        returns = self.random.normal(0, vol, len(self.dates))
+        close = start * np.exp(np.cumsum(returns))
+        spread = np.abs(self.random.normal(0, vol, len(self.dates)))
+        df = pd.DataFrame({
+            'close': close,
+            'open': np.roll(close, 1),
+            'high': close * (1 + spread),
+            'low': close * (1 - spread)
+        }, index=pd.Index(self.dates, name='date'))
+        df.iloc[0, df.columns.get_loc('open')] = close[0]
+        # PriceData saves files with the latest date first
+        return (df.sort_index(ascending=False))
+
+    def trades(self, user_id):
+        # Returns a list of dicts that can be passed to models.Trades
+        # The first trade for each ticker is a buy so positions start
+        # positive. Sells never exceed the position at that date.
+        n = max(self.n_trades, self.n_tickers)
+        tickers = np.concatenate([
+            self.tickers,
+            self.random.choice(self.tickers, n - self.n_tickers)])
+        offsets = np.sort(self.random.randint(0, len(self.dates) - 1, n))
+        # Make sure the first trade of each ticker is early in the period
+        offsets[:self.n_tickers] = np.arange(self.n_tickers)
+        currencies = self.random.choice(self.currencies, n)
+        positions = dict.fromkeys(self.tickers, 0.0)
+        trades = []
+        for i in np.argsort(offsets, kind='stable'):
+            ticker = tickers[i]
+            date = self.dates[offsets[i]]
+            price_usd = float(self.prices[ticker].at[date, 'close'])
+            currency = currencies[i]
+            fx = 1.0
+            if currency != 'USD':
+                fx = float(self.fx[currency].at[date, 'close'])
+            quantity = round(self.random.uniform(0.1, 10), 4)
+            if positions[ticker] > quantity and self.random.rand() < 0.3:
+                quantity = -quantity
+            positions[ticker] += quantity
+            price = price_usd * fx
+            fees = round(abs(quantity * price) * 0.001, 2)
+            trades.append({
+                'user_id': user_id,
+                'trade_date': date.to_pydatetime() + timedelta(hours=12),
+                'trade_currency': currency,
+                'trade_asset_ticker': ticker,
+                'trade_account': f"account{i % 3}",
+                'trade_quantity': quantity,
+                'trade_operation': "B" if quantity > 0 else "S",
+                'trade_price': price,
+                'trade_fees': fees,
+                'trade_reference_id': f"synthetic-{self.seed}-{i}",
+                'cash_value': quantity * price + fees
+            })
+        return (trades)
+
+    def price_files(self):
+        # Returns {filename: df} in the PriceData format
+        files = {}
+        for ticker, df in self.prices.items():
+            files[f"{ticker}_ccdigital.price"] = df
+        for currency, df in self.fx.items():
+            files[f"{currency}_ccfx.price"] = df
+        return (files)
+
+    def realtime(self, ticker):
+        # Last close for a ticker (or currency) - used by the provider stub
+        if ticker in self.prices:
+            return (float(self.prices[ticker].close.iloc[0]))
+        if ticker in self.fx:
+            return (float(self.fx[ticker].close.iloc[0]))
+        if ticker == 'USD':
+            return (1.0)
+        return (None)
+
+
+class PriceFixtures():
+    # Writes the synthetic price files to the pricing_data folder.
+    # Any existing file with the same name is moved aside and restored
+    # when the fixtures are removed, so real price files are not lost.
+    def __init__(self, portfolio, folder):
+        self.portfolio = portfolio
+        self.folder = folder
+        self.backup = os.path.join(folder, '.benchmark_backup')
+        self.written = []
+
+    def __enter__(self):
+        os.makedirs(self.backup, exist_ok=True)
+        for filename, df in self.portfolio.price_files().items():
+            path = os.path.join(self.folder, filename)
+            if os.path.exists(path):
+                shutil.move(path, os.path.join(self.backup, filename))
+            df.to_pickle(path)
+            self.written.append(filename)
+        return (self)
+
+    def __exit__(self, *args):
+        for filename in self.written:
+            path = os.path.join(self.folder, filename)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            saved = os.path.join(self.backup, filename)
+            if os.path.exists(saved):
+                shutil.move(saved, path)
+        shutil.rmtree(self.backup, ignore_errors=True)
+        self.written = []
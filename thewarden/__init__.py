@@ -152,6 +152,16 @@ def create_app(config_class=Config):
     app.register_blueprint(errors)
     app.register_blueprint(node)
 
+    # Request and database spans (see users/metrics.py)
+    from thewarden.users import metrics
+    metrics.init_app(app)
+    # Per request profiler (developer mode only - see users/profiler.py)
+    from thewarden.users import profiler
+    profiler.init_app(app)
+    # Background balance checks of auto_check addresses (node/watcher.py)
+    from thewarden.node import watcher
+    watcher.init_app(app)
+
     # This will run only once at the first request
     @app.before_first_request
     def before_first_request():
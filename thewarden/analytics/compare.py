@@ -0,0 +1,199 @@
+# Comparison engine for portfolio_compare_json and scatter_json
+# A panel with the NAV and the prices of every ticker requested so far
+# (one column per ticker, aligned to the NAV dates) is kept for each user
+# and NAV version. Requesting a new ticker adds one column - the NAV and
+# the other tickers are not merged again.
+#
+# Statistics for a set of tickers and date range are computed with
+# matrix operations (returns, period stats, correlation, beta and alpha
+# against a market ticker) and cached by (user, tickers, range).
+#
+# Usage:
+#     panel = get_panel(user_key, nav)
+#     messages = panel.ensure(tickers, price_loader)
+#     result = compare(panel, tickers, start, end, market='BTC')
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from thewarden.analytics.stats import ANNUAL_DAYS, nav_version, period_stats
+
+PANEL_CACHE_SIZE = 4
+RESULT_CACHE_SIZE = 32
+
+_panels = OrderedDict()
+_results = OrderedDict()
+_lock = threading.Lock()
+
+
+class ComparePanel():
+    def __init__(self, nav):
+        self.version = nav_version(nav)
+        self.prices = pd.DataFrame({'NAV_fx': nav['NAV_fx'].astype(float)})
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def has(self, ticker):
+        return (ticker + '_price') in self.prices.columns
+
+    def add(self, ticker, prices):
+        # prices: Series indexed by date (already converted to user fx)
+        prices = prices[~prices.index.duplicated(keep='first')]
+        column = prices.astype(float).reindex(self.prices.index)
+        # Same fill used before: backfill then forward fill
+        column = column.fillna(method='bfill').fillna(method='ffill')
+        with self._lock:
+            self.prices[ticker + '_price'] = column
+            self.errors.pop(ticker, None)
+
+    def ensure(self, tickers, loader):
+        # Adds any missing ticker using loader(ticker) -> Series or None
+        # Returns a messages dict {ticker: "ok" or error}
+        messages = {}
+        for ticker in tickers:
+            if ticker == 'NAV':
+                continue
+            if not self.has(ticker):
+                prices = loader(ticker)
+                if prices is None:
+                    self.errors[ticker] = f"Could not get prices for {ticker}"
+                    messages[ticker] = self.errors[ticker]
+                    continue
+                self.add(ticker, prices)
+            messages[ticker] = "ok"
+        return (messages)
+
+    def frame(self, tickers, start=None, end=None):
+        columns = ['NAV_fx'] + [ticker + '_price' for ticker in tickers]
+        with self._lock:
+            frame = self.prices[columns]
+        mask = np.ones(len(frame), dtype=bool)
+        if start is not None:
+            mask &= frame.index >= start
+        if end is not None:
+            mask &= frame.index <= end
+        return (frame.loc[mask])
+
+
+def get_panel(user_key, nav):
+    # Panel for this user - rebuilt when the NAV changes
+    version = nav_version(nav)
+    with _lock:
+        panel = _panels.get(user_key)
+        if panel is not None and panel.version == version:
+            _panels.move_to_end(user_key)
+            return (panel)
+        panel = ComparePanel(nav)
+        _panels[user_key] = panel
+        while len(_panels) > PANEL_CACHE_SIZE:
+            _panels.popitem(last=False)
+    return (panel)
+
+
+def regression(returns, market_column):
+    # Beta and alpha of every column against market_column
+    # returns: 2D array without NaN. alpha is daily, ann_alpha annualized
+    demeaned = returns - returns.mean(axis=0)
+    market = demeaned[:, market_column]
+    variance = (market @ market) / (len(market) - 1)
+    covariance = (demeaned.T @ market) / (len(market) - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = covariance / variance
+    alpha = returns.mean(axis=0) - beta * returns[:, market_column].mean()
+    return beta, alpha
+
+
+def correlation(returns, labels):
+    # Pearson correlation - matrix operation when there are no gaps,
+    # pandas pairwise correlation otherwise
+    if len(returns) > 1 and np.isfinite(returns).all():
+        with np.errstate(divide='ignore', invalid='ignore'):
+            matrix = np.corrcoef(returns, rowvar=False)
+        matrix = np.atleast_2d(matrix)
+        return pd.DataFrame(matrix, index=labels, columns=labels)
+    return pd.DataFrame(returns, columns=labels).corr(method="pearson")
+
+
+def compare(panel, tickers, start=None, end=None, market=None, key=None):
+    # Returns a dict with:
+    #   frame   NAV and prices, normalized prices and returns (same
+    #           columns as the previous nav_only table)
+    #   table   stats for NAV and each ticker
+    #   corr    correlation matrix (DataFrame) of the returns
+    #   returns DataFrame with the _ret columns
+    if key is not None:
+        with _lock:
+            if key in _results:
+                _results.move_to_end(key)
+                return (_results[key])
+    frame = panel.frame(tickers, start, end)
+    names = ['NAV'] + list(tickers)
+    values = frame.to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm = values / values[0] * 100
+        returns = np.full(values.shape, np.nan)
+        returns[1:] = norm[1:] / norm[:-1] - 1
+    norm_columns = [name + '_norm' for name in names]
+    ret_columns = [name + '_ret' for name in names]
+    # Column order: NAV_fx, tickers prices, then _norm and _ret pairs
+    output = frame.copy()
+    for position, name in enumerate(names):
+        output[norm_columns[position]] = norm[:, position]
+        output[ret_columns[position]] = returns[:, position]
+
+    table = {}
+    table["meta"] = {
+        "start_date": frame.index[0].strftime("%m-%d-%Y"),
+        "end_date": frame.index[-1].strftime("%m-%d-%Y"),
+        "number_of_days": (frame.index[-1] - frame.index[0]).days,
+        "count_of_points": float(frame["NAV_fx"].count())
+    }
+    period = period_stats(values)
+    fields = ["start", "end", "return", "avg_return", "ann_std_dev"]
+    for position, name in enumerate(names):
+        table[name] = {field: period[field][position] for field in fields}
+        if name != 'NAV':
+            table[name]["comp2nav"] = (table[name]["return"] -
+                                       table["NAV"]["return"])
+
+    returns_df = pd.DataFrame(returns, index=frame.index,
+                              columns=ret_columns)
+    corr = correlation(returns[1:], ret_columns)
+
+    if market is not None and market in names and len(values) > 2:
+        clean = np.nan_to_num(returns[1:])
+        beta, alpha = regression(clean, names.index(market))
+        for position, name in enumerate(names):
+            table[name]["beta"] = beta[position]
+            table[name]["alpha"] = alpha[position]
+            table[name]["ann_alpha"] = alpha[position] * ANNUAL_DAYS
+            table[name]["correlation"] = corr.iat[position,
+                                                  names.index(market)]
+
+    result = {'frame': output, 'table': table, 'corr': corr,
+              'returns': returns_df}
+    if key is not None:
+        with _lock:
+            _results[key] = result
+            while len(_results) > RESULT_CACHE_SIZE:
+                _results.popitem(last=False)
+    return (result)
+
+
+def scatter_series(result, market, tickers):
+    # HighCharts scatter series: x = market returns, y = ticker returns
+    returns = result['returns'].fillna(0)
+    x = returns[market + '_ret'].to_numpy()
+    series = []
+    for ticker in tickers:
+        if ticker == market:
+            continue
+        y = returns[ticker + '_ret'].to_numpy()
+        series.append({
+            "name": "x: " + market + ", y: " + ticker,
+            "regression": 1,
+            "data": np.column_stack([x, y]).tolist()
+        })
+    return (series)
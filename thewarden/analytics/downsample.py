@@ -0,0 +1,70 @@
+# Downsampling of daily series for charts and compact API responses
+# Period end resampling keeps the last row of each week or month (the
+# value at the end of the period - ex: the allocation on that date).
+# Positions are found with a single pass over integer period codes, so the
+# frame is never grouped.
+# LTTB (Largest Triangle Three Buckets) keeps a target number of points
+# chosen to preserve the shape of a chart line.
+#
+# Usage:
+#     weekly = downsample(nav, 'weekly')
+#     chart = nav.iloc[lttb(nav['NAV_fx'].values, 2000)]
+import numpy as np
+
+# Resolution name: pandas period frequency (None = keep every row)
+RESOLUTIONS = {
+    'daily': None,
+    'weekly': 'W',
+    'monthly': 'M'
+}
+
+
+def period_end(index, freq):
+    # Positions of the last row of each period in a sorted DatetimeIndex
+    if freq is None or len(index) == 0:
+        return (np.arange(len(index)))
+    codes = index.to_period(freq).asi8
+    last = np.flatnonzero(codes[1:] != codes[:-1])
+    return (np.append(last, len(index) - 1))
+
+
+def downsample(frame, resolution='daily'):
+    # frame is a DataFrame (or Series) indexed by date
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution: {resolution}")
+    positions = period_end(frame.index, RESOLUTIONS[resolution])
+    return (frame.iloc[positions])
+
+
+def epoch_ms(index):
+    # Dates as milliseconds since epoch (same as DataFrame.to_json)
+    return (index.asi8 // 1000000).tolist()
+
+
+def lttb(values, threshold):
+    # Largest Triangle Three Buckets - positions of the threshold points
+    # that best keep the visual shape of the series (first and last
+    # points are always kept). Rows are assumed equally spaced (daily).
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return (np.arange(n))
+    y = np.where(np.isfinite(values), values, 0)
+    x = np.arange(n, dtype=float)
+    # threshold - 2 buckets between the first and last points
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # Average of the next bucket (the last point for the last bucket)
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) -
+                      (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[bucket + 1] = a
+    return (selected)
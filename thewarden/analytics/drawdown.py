@@ -0,0 +1,88 @@
+# Drawdown engine
+# Finds every drawdown episode of a price (or NAV) series in a single
+# vectorized pass:
+#   peak      position of the high where the episode starts
+#   trough    position of the lowest value before a new high (the last
+#             one if the low is repeated)
+#   recovery  last position before a new high (or the last position of
+#             the series if the high was never recovered)
+#   depth     drawdown at the trough (ex: -0.25 = 25% below the peak)
+# An episode starts every time a new high is made, so episodes with
+# depth = 0 (new highs on consecutive days) are included.
+#
+# Usage:
+#     top_drawdowns(df.index, df.close.values, n=2)
+import numpy as np
+
+
+def episodes(values):
+    # Returns a dict of arrays (one item per episode)
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n == 0:
+        empty = np.array([], dtype=int)
+        return {'peak': empty, 'trough': empty, 'recovery': empty,
+                'depth': np.array([]), 'recovered': np.array([], dtype=bool)}
+    running_max = np.maximum.accumulate(values)
+    # A new episode starts at each new high
+    new_high = np.empty(n, dtype=bool)
+    new_high[0] = True
+    new_high[1:] = values[1:] > running_max[:-1]
+    peak = np.flatnonzero(new_high)
+    episode = np.cumsum(new_high) - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drawdown = values / running_max - 1
+    depth = np.minimum.reduceat(drawdown, peak)
+    # Trough: last position where the episode reaches its depth
+    positions = np.arange(n)
+    at_bottom = drawdown == depth[episode]
+    trough = np.maximum.reduceat(np.where(at_bottom, positions, -1), peak)
+    recovery = np.append(peak[1:] - 1, n - 1)
+    recovered = np.append(np.ones(len(peak) - 1, dtype=bool), False)
+    return {'peak': peak, 'trough': trough, 'recovery': recovery,
+            'depth': depth, 'recovered': recovered}
+
+
+def top_episodes(values, n):
+    # Returns the episodes dict and the positions of the n deepest
+    # episodes (deepest first). Uses a partial sort.
+    found = episodes(values)
+    depth = found['depth']
+    n = min(n, len(depth))
+    if n <= 0:
+        return found, np.array([], dtype=int)
+    if n < len(depth):
+        selected = np.argpartition(depth, n - 1)[:n]
+    else:
+        selected = np.arange(len(depth))
+    selected = selected[np.argsort(depth[selected], kind='stable')]
+    return found, selected
+
+
+def top_drawdowns(index, values, n=2):
+    # List of dicts for the n largest drawdowns
+    # index is a DatetimeIndex with the same length as values
+    values = np.asarray(values, dtype=float)
+    valid = np.isfinite(values)
+    if not valid.all():
+        index = index[valid]
+        values = values[valid]
+    found, selected = top_episodes(values, n)
+    result = []
+    for position in selected:
+        peak = found['peak'][position]
+        trough = found['trough'][position]
+        recovery = found['recovery'][position]
+        result.append({
+            'dd': found['depth'][position],
+            'start_date': index[peak].strftime("%Y-%m-%d"),
+            'start_value': values[peak],
+            'end_date': index[trough].strftime("%Y-%m-%d"),
+            'end_value': values[trough],
+            'recovery_date': index[recovery].strftime("%Y-%m-%d"),
+            'recovered': bool(found['recovered'][position]),
+            'days_to_bottom': (index[trough] - index[peak]).days,
+            'days_to_recovery': (index[recovery] - index[peak]).days,
+            'days_bottom_to_recovery': (index[recovery] - index[trough]).days
+        })
+    return (result)
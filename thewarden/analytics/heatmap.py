@@ -0,0 +1,104 @@
+# Monthly returns heatmap
+# Vectorized replacement for the vendored monthly-returns-heatmap module
+# (mhp.get) + the summary stats at heatmap_generator. Daily returns are
+# converted to log returns and summed with np.bincount on integer
+# year * 12 + month codes, so compounding a month (or a year) is a single
+# expm1 of the sum.
+#
+# The result is a single DataFrame indexed by year (string, ex: '2019')
+# with columns Jan..Dec, eoy and the stats columns:
+# MAX, MIN, POSITIVES, NEGATIVES, POS_MEAN, NEG_MEAN, MEAN
+# Months without data are 0 and are ignored by the stats (same as before).
+#
+# Results are cached by key (ex: the NAV version or ticker + last date).
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+          'Oct', 'Nov', 'Dec']
+COLUMNS = MONTHS + ['eoy']
+CACHE_SIZE = 16
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _masked(grid, mask, reducer):
+    # reducer over the masked values of each row, NaN when row is empty
+    count = mask.sum(axis=1)
+    if reducer == 'max':
+        values = np.where(mask, grid, -np.inf).max(axis=1)
+    elif reducer == 'min':
+        values = np.where(mask, grid, np.inf).min(axis=1)
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where(mask, grid, 0).sum(axis=1) / count
+    return np.where(count > 0, values, np.nan)
+
+
+def monthly_returns(index, returns):
+    # index: DatetimeIndex, returns: array of daily returns (NaN allowed)
+    returns = np.asarray(returns, dtype=float)
+    years = index.year.values
+    first_year = years.min()
+    codes = (years - first_year) * 12 + index.month.values - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_returns = np.where(np.isnan(returns), 0, np.log1p(returns))
+    n_years = years.max() - first_year + 1
+    sums = np.bincount(codes, weights=log_returns,
+                       minlength=n_years * 12).reshape(n_years, 12)
+    # Only the years with data (same as the previous pivot)
+    present = np.unique(years) - first_year
+    sums = sums[present]
+    grid = np.expm1(sums)
+    eoy = np.expm1(sums.sum(axis=1))
+    return (present + first_year), grid, eoy
+
+
+def build_heatmap(index, returns):
+    years, grid, eoy = monthly_returns(index, returns)
+    nonzero = grid != 0
+    positive = grid > 0
+    negative = grid < 0
+    heatmap = pd.DataFrame(grid, columns=MONTHS,
+                           index=pd.Index([str(y) for y in years],
+                                          name='Year'))
+    heatmap.columns.name = 'Month'
+    heatmap['eoy'] = eoy
+    heatmap['MAX'] = _masked(grid, nonzero, 'max')
+    heatmap['MIN'] = _masked(grid, nonzero, 'min')
+    heatmap['POSITIVES'] = positive.sum(axis=1)
+    heatmap['NEGATIVES'] = negative.sum(axis=1)
+    heatmap['POS_MEAN'] = _masked(grid, positive, 'mean')
+    heatmap['NEG_MEAN'] = _masked(grid, negative, 'mean')
+    heatmap['MEAN'] = _masked(grid, nonzero, 'mean')
+    return (heatmap)
+
+
+def heatmap(index, returns, key=None):
+    # Returns a copy of the (cached) heatmap DataFrame
+    if key is None:
+        return build_heatmap(index, returns)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key].copy()
+    result = build_heatmap(index, returns)
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result.copy()
+
+
+def price_heatmap(prices, key=None):
+    # prices: Series of prices sorted by date
+    values = prices.to_numpy(dtype=float)
+    returns = np.empty(len(values))
+    returns[:1] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns[1:] = values[1:] / values[:-1] - 1
+    return heatmap(prices.index, returns, key)
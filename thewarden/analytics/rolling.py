@@ -0,0 +1,218 @@
+# Rolling window analytics
+# Rolling volatility, Sharpe ratio, beta and correlation (against a
+# benchmark, ex: BTC) for any number of windows, computed from prefix sums
+# of the daily returns. Each window is a difference of two rows of the
+# prefix table, so every metric is O(n) regardless of the window size.
+#
+# Engines are cached. When the series changes (a new day is appended or
+# today's value moves with realtime prices) only the rows from the first
+# changed date onwards are recomputed - prefix sums and the cached metric
+# arrays are truncated there and extended.
+#
+# Metrics (annualized with ANNUAL_DAYS, no risk free rate):
+#   vol     standard deviation of returns in %  (same as histvol)
+#   sharpe  mean return / standard deviation
+#   beta    cov(returns, benchmark) / var(benchmark)
+#   corr    Pearson correlation with the benchmark
+#
+# Usage:
+#     engine = rolling_engine(key, nav.index, nav['NAV_fx'], btc_prices)
+#     engine.metric('vol', 30)
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from thewarden.analytics.stats import ANNUAL_DAYS
+
+METRICS = ['vol', 'sharpe', 'beta', 'corr']
+BENCHMARK_METRICS = ['beta', 'corr']
+CACHE_SIZE = 8
+
+# Columns of the prefix sum table. j* are sums over the dates where both
+# the series and the benchmark have returns.
+N, X, XX, NJ, JX, JY, JXX, JYY, JXY = range(9)
+
+
+def price_returns(values, start=1):
+    # Daily returns of positions start..n-1 (position 0 has no return)
+    start = max(start, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = values[start:] / values[start - 1:-1] - 1
+    returns[~np.isfinite(returns)] = np.nan
+    return (returns)
+
+
+def _terms(x, y):
+    # One row per return with the values added to the prefix table
+    valid = np.isfinite(x)
+    xc = np.where(valid, x, 0)
+    if y is None:
+        joint = np.zeros(len(x), dtype=bool)
+        y = np.zeros(len(x))
+    else:
+        joint = valid & np.isfinite(y)
+    xj = np.where(joint, x, 0)
+    yj = np.where(joint, y, 0)
+    return np.column_stack([valid, xc, xc * xc, joint, xj, yj, xj * xj,
+                            yj * yj, xj * yj]).astype(float)
+
+
+def _first_change(old, new):
+    # First position where two arrays differ (NaN == NaN)
+    length = min(len(old), len(new))
+    same = (old[:length] == new[:length]) | (np.isnan(old[:length]) &
+                                             np.isnan(new[:length]))
+    changed = np.flatnonzero(~same)
+    return (int(changed[0]) if len(changed) else length)
+
+
+class RollingEngine():
+    def __init__(self, index, values, benchmark=None):
+        self._lock = threading.Lock()
+        self._build(index, values, benchmark)
+
+    def _build(self, index, values, benchmark):
+        self.index = index
+        self.values = np.asarray(values, dtype=float)
+        self.benchmark = (None if benchmark is None else
+                          np.asarray(benchmark, dtype=float))
+        self.returns = np.concatenate([[np.nan],
+                                       price_returns(self.values)])
+        self.bench_returns = (None if self.benchmark is None else
+                              np.concatenate([[np.nan],
+                                              price_returns(self.benchmark)]))
+        terms = _terms(self.returns, self.bench_returns)
+        self._prefix = np.vstack([np.zeros((1, terms.shape[1])),
+                                  np.cumsum(terms, axis=0)])
+        self._metrics = {}
+
+    def update(self, index, values, benchmark=None):
+        # Recomputes only from the first changed position
+        # Returns the number of rows recomputed
+        values = np.asarray(values, dtype=float)
+        benchmark = (None if benchmark is None else
+                     np.asarray(benchmark, dtype=float))
+        with self._lock:
+            old_n = len(self.values)
+            rebuild = (len(values) < old_n or
+                       (benchmark is None) != (self.benchmark is None) or
+                       not index[:old_n].equals(self.index))
+            if not rebuild:
+                start = _first_change(self.values, values)
+                if benchmark is not None:
+                    start = min(start, _first_change(self.benchmark,
+                                                     benchmark))
+                rebuild = start == 0
+            if rebuild:
+                self._build(index, values, benchmark)
+                return (len(values))
+            if start == len(values):
+                return (0)
+            self.index = index
+            self.values = values
+            self.benchmark = benchmark
+            # Returns at positions >= start change
+            self.returns = np.concatenate([self.returns[:start],
+                                           price_returns(values, start)])
+            if benchmark is not None:
+                self.bench_returns = np.concatenate(
+                    [self.bench_returns[:start],
+                     price_returns(benchmark, start)])
+                tail_bench = self.bench_returns[start:]
+            else:
+                tail_bench = None
+            terms = _terms(self.returns[start:], tail_bench)
+            prefix = self._prefix[:start + 1]
+            self._prefix = np.vstack(
+                [prefix, prefix[-1] + np.cumsum(terms, axis=0)])
+            for key, result in self._metrics.items():
+                self._metrics[key] = np.concatenate(
+                    [result[:start], self._compute(key[0], key[1], start)])
+            return (len(values) - start)
+
+    def _compute(self, metric, window, start=0):
+        # Metric for positions start..n-1 (NaN when the window is not full)
+        n = len(self.returns)
+        out = np.full(n - start, np.nan)
+        ends = np.arange(start, n) + 1
+        full = ends - window >= 0
+        if window < 2 or not full.any():
+            return (out)
+        sums = (self._prefix[ends[full]] -
+                self._prefix[ends[full] - window])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if metric in BENCHMARK_METRICS:
+                count = sums[:, NJ]
+                cov = (sums[:, JXY] - sums[:, JX] * sums[:, JY] / count)
+                var_x = (sums[:, JXX] - sums[:, JX] ** 2 / count)
+                var_y = (sums[:, JYY] - sums[:, JY] ** 2 / count)
+                if metric == 'beta':
+                    result = cov / var_y
+                else:
+                    result = cov / np.sqrt(np.maximum(var_x * var_y, 0))
+            else:
+                count = sums[:, N]
+                mean = sums[:, X] / count
+                var = (sums[:, XX] - sums[:, X] ** 2 / count) / (count - 1)
+                std = np.sqrt(np.maximum(var, 0))
+                if metric == 'vol':
+                    result = std * math.sqrt(ANNUAL_DAYS) * 100
+                else:
+                    result = mean / std * math.sqrt(ANNUAL_DAYS)
+        # Windows with missing values are NaN (pandas min_periods=window)
+        result[count < window] = np.nan
+        result[~np.isfinite(result)] = np.nan
+        out[full] = result
+        return (out)
+
+    def metric(self, metric, window):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown rolling metric: {metric}")
+        if metric in BENCHMARK_METRICS and self.benchmark is None:
+            raise ValueError(f"{metric} requires a benchmark")
+        with self._lock:
+            key = (metric, window)
+            if key not in self._metrics:
+                self._metrics[key] = self._compute(metric, window)
+            return (self._metrics[key])
+
+
+def summary(values):
+    # mean, max, min and last value of a rolling series (NaN ignored)
+    values = np.asarray(values, dtype=float)
+    finite = values[np.isfinite(values)]
+    if len(finite) == 0:
+        return {'mean': np.nan, 'max': np.nan, 'min': np.nan,
+                'last': values[-1] if len(values) else np.nan,
+                'lastvsmean': np.nan}
+    mean = finite.mean()
+    return {
+        'mean': mean,
+        'max': finite.max(),
+        'min': finite.min(),
+        'last': values[-1],
+        'lastvsmean': ((values[-1] / mean) - 1) * 100
+    }
+
+
+_engines = OrderedDict()
+_engines_lock = threading.Lock()
+
+
+def rolling_engine(key, index, values, benchmark=None):
+    # Cached engine for key (ex: user and currency), updated in place
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is not None:
+            _engines.move_to_end(key)
+    if engine is None:
+        engine = RollingEngine(index, values, benchmark)
+        with _engines_lock:
+            _engines[key] = engine
+            while len(_engines) > CACHE_SIZE:
+                _engines.popitem(last=False)
+    else:
+        engine.update(index, values, benchmark)
+    return (engine)
@@ -0,0 +1,176 @@
+# Portfolio statistics computed from the NAV table (see generatenav)
+# The full bundle (returns for each horizon, extremes and their dates,
+# volatility and drawdowns) is computed once for each version of the NAV
+# and kept in a small LRU cache. Endpoints then only look up values.
+#
+# A NAV version is identified by its length, first and last dates and
+# last values - any change to trades or prices generates a new version.
+#
+# Usage:
+#     stats = nav_stats(generatenav(current_user.username))
+#     stats.returns['1d'], stats.extremes['max_nav']
+# Rolling window metrics are at analytics/rolling
+import math
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+# Number of NAV versions kept in cache (one per user and currency is
+# usually enough)
+CACHE_SIZE = 8
+# Days used to annualize volatility (crypto trades every day)
+ANNUAL_DAYS = 365
+
+# Horizons in number of rows counting back from the last row
+# (same convention used by portstats: 1d = [-2], 1wk = [-7], ...)
+HORIZONS = {'1d': 2, '1wk': 7, '30d': 30, '90d': 90}
+
+
+def nearest_position(index, date):
+    # Position of the closest date in a sorted DatetimeIndex
+    # Same result as index.get_loc(date, method="nearest")
+    date = pd.Timestamp(date)
+    pos = index.searchsorted(date)
+    if pos == 0:
+        return (0)
+    if pos >= len(index):
+        return (len(index) - 1)
+    if (date - index[pos - 1]) <= (index[pos] - date):
+        return (pos - 1)
+    return (pos)
+
+
+def daily_returns(values):
+    # Same as pd.Series.pct_change() - first value is NaN
+    values = np.asarray(values, dtype=float)
+    returns = np.empty(len(values))
+    returns[:1] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns[1:] = values[1:] / values[:-1] - 1
+    return (returns)
+
+
+def period_stats(values):
+    # Statistics for each column of a 2D array of prices (rows = dates)
+    # Returns a dict of arrays: start, end, return, avg_return, ann_std_dev
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = values[1:] / values[:-1] - 1
+    returns[~np.isfinite(returns)] = np.nan
+    count = np.sum(~np.isnan(returns), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.nansum(returns, axis=0) / count
+        std = np.sqrt(np.nansum((returns - mean) ** 2, axis=0) / (count - 1))
+        total_return = values[-1] / values[0] - 1
+    mean[count == 0] = np.nan
+    std[count < 2] = np.nan
+    return {
+        'start': values[0],
+        'end': values[-1],
+        'return': total_return,
+        'avg_return': mean,
+        'ann_std_dev': std * math.sqrt(ANNUAL_DAYS)
+    }
+
+
+class NavStats():
+    def __init__(self, nav):
+        self.index = nav.index
+        self.nav = nav['NAV_fx'].to_numpy(dtype=float)
+        self.port = nav['PORT_fx_pos'].to_numpy(dtype=float)
+        self.returns_daily = daily_returns(self.nav)
+        self.extremes = self._extremes()
+        self.returns = self._returns()
+        # Drawdown from the running maximum at each date
+        running_max = np.maximum.accumulate(self.nav)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.drawdown = self.nav / running_max - 1
+        valid = self.returns_daily[np.isfinite(self.returns_daily)]
+        self.volatility = {
+            'avg_return': valid.mean() if len(valid) else np.nan,
+            'ann_std_dev': (valid.std(ddof=1) * math.sqrt(ANNUAL_DAYS)
+                            if len(valid) > 1 else np.nan)
+        }
+
+    def _date(self, position):
+        return (self.index[position])
+
+    def _extremes(self):
+        # argmax / argmin return the first occurrence - same as the
+        # previous boolean scans data[data.x == data.x.max()].index[0]
+        max_nav = int(np.argmax(self.nav))
+        min_nav = int(np.argmin(self.nav))
+        max_port = int(np.argmax(self.port))
+        min_port = int(np.argmin(self.port))
+        return {
+            'start_date': self._date(0),
+            'end_date': self._date(-1),
+            'start_nav': self.nav[0],
+            'end_nav': self.nav[-1],
+            'max_nav': self.nav[max_nav],
+            'max_nav_date': self._date(max_nav),
+            'min_nav': self.nav[min_nav],
+            'min_nav_date': self._date(min_nav),
+            'end_portvalue': self.port[-1],
+            'max_portvalue': self.port[max_port],
+            'max_port_date': self._date(max_port),
+            'min_portvalue': self.port[min_port],
+            'min_port_date': self._date(min_port)
+        }
+
+    def _returns(self):
+        # None when there's not enough history for the horizon
+        end = self.nav[-1]
+        returns = {'SI': end / self.nav[0] - 1,
+                   'ATH': end / self.extremes['max_nav'] - 1}
+        for name, rows in HORIZONS.items():
+            returns[name] = (end / self.nav[-rows] - 1
+                             if len(self.nav) >= rows else None)
+        yr_ago = datetime.today() - relativedelta(years=1)
+        returns['1yr'] = end / self.nav[nearest_position(self.index,
+                                                         yr_ago)] - 1
+        ytd = self.index.searchsorted(pd.Timestamp(datetime.today().year, 1, 1))
+        returns['YTD'] = (end / self.nav[ytd - 1] - 1 if ytd > 0
+                          else returns['SI'])
+        return (returns)
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def nav_version(nav):
+    # Cheap fingerprint of a NAV table
+    if nav is None or len(nav) == 0:
+        return (None)
+    return (len(nav), nav.index[0], nav.index[-1],
+            float(nav['NAV_fx'].iat[-1]), float(nav['PORT_fx_pos'].iat[-1]),
+            float(nav['PORT_fx_pos'].sum()))
+
+
+def nav_stats(nav):
+    # Returns the cached NavStats for this NAV version
+    version = nav_version(nav)
+    if version is None:
+        return (None)
+    with _cache_lock:
+        if version in _cache:
+            _cache.move_to_end(version)
+            return (_cache[version])
+    stats = NavStats(nav)
+    with _cache_lock:
+        _cache[version] = stats
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return (stats)
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -1,9 +1,9 @@
 import csv
 import json
 import logging
-import math
 import os
 import secrets
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 import numpy as np
@@ -12,25 +12,44 @@ import requests
 import simplejson
 from bitmex import bitmex
 from dateutil import parser
-from dateutil.relativedelta import relativedelta
-from flask import Blueprint, flash, jsonify, render_template, request
+from flask import (Blueprint, Response, abort, flash, jsonify,
+                   render_template, request, send_file)
 from flask_login import current_user, login_required
 
 from thewarden import db
-from thewarden import mhp as mrh
 from thewarden import test_tor
+from thewarden.analytics.compare import compare, get_panel, scatter_series
+from thewarden.analytics.downsample import (RESOLUTIONS, downsample,
+                                            epoch_ms, lttb)
+from thewarden.analytics.drawdown import top_drawdowns
+from thewarden.analytics.heatmap import COLUMNS as HEATMAP_COLUMNS
+from thewarden.analytics.heatmap import price_heatmap
+from thewarden.analytics.rolling import BENCHMARK_METRICS
+from thewarden.analytics.rolling import METRICS as ROLLING_METRICS
+from thewarden.analytics.rolling import RollingEngine, rolling_engine
+from thewarden.analytics.rolling import summary as rolling_summary
+from thewarden.analytics.stats import nav_stats
 from thewarden.models import (AccountInfo, BitcoinAddresses, Trades,
                               listofcrypto)
+from thewarden.node import watcher
+from thewarden.node.monitor import is_hd, refresh_balances
 from thewarden.node.utils import (dojo_auth, dojo_get_hd, dojo_get_settings,
                                   dojo_get_txs, dojo_multiaddr,
-                                  oxt_get_address, tor_request)
+                                  oxt_get_address)
 from thewarden.pricing_engine.pricing import (PROVIDER_LIST, PriceData,
-                                              api_keys_class, price_data_fx,
-                                              price_data_rt, search_engine)
+                                              api_keys_class, negative_cache,
+                                              price_data_fx, price_data_rt,
+                                              router, search_engine)
+from thewarden.pricing_engine.rate_limiter import (governed_request,
+                                                   governor_status)
+from thewarden.users import metrics, profiler
 from thewarden.users.decorators import MWT
+from thewarden.users.serializers import (columnar, frame_to_dict,
+                                         encoded_response, json_response)
 from thewarden.users.utils import (cost_calculation, current_path, fxsymbol,
                                    generatenav, heatmap_generator,
-                                   positions_dynamic, regenerate_nav,
+                                   nav_status, positions_dynamic,
+                                   regenerate_nav, trade_blockchain_ids,
                                    transactions_fx)
 
 api = Blueprint("api", __name__)
@@ -134,11 +153,12 @@ def histvol():
             return render_template("empty.html")
 
         data = generatenav(current_user.username)
-        data["vol"] = (data["NAV_fx"].pct_change().rolling(q).std() *
-                       (365 ** 0.5) * 100)
-        # data.set_index('date', inplace=True)
-        vollist = data[["vol"]]
-        vollist.index = vollist.index.strftime("%Y-%m-%d")
+        # Rolling vol is updated incrementally (analytics/rolling)
+        vol = nav_rolling(data).metric('vol', q)
+        vollist = pd.DataFrame({"vol": vol},
+                               index=data.index.strftime("%Y-%m-%d"))
+        if metadata is not None:
+            return json.dumps(rolling_summary(vol))
         datajson = vollist.to_json()
 
     if ticker:
@@ -154,10 +174,9 @@ def histvol():
                 ).T
                 prices["4b. close (USD)"] = prices["4b. close (USD)"].astype(
                     np.float)
-                prices["vol"] = (
-                    prices["4b. close (USD)"].pct_change().rolling(q).std() *
-                    (365 ** 0.5) * 100
-                )
+                prices["vol"] = RollingEngine(
+                    prices.index,
+                    prices["4b. close (USD)"].values).metric('vol', q)
                 pricelist = prices[["vol"]]
                 datajson = pricelist.to_json()
 
@@ -179,6 +198,81 @@ def histvol():
     return datajson
 
 
+# Rolling engine for the NAV of the current user. When a benchmark ticker
+# is sent, its prices (aligned to the NAV dates by the comparison panel)
+# are used for beta and correlation.
+def nav_rolling(nav, benchmark=None):
+    user_key = (current_user.username, current_user.fx())
+    bench_values = None
+    if benchmark == "NAV":
+        bench_values = nav["NAV_fx"].to_numpy(dtype=float)
+    elif benchmark:
+        panel = get_panel(user_key, nav)
+        messages = panel.ensure([benchmark], converted_close)
+        if messages.get(benchmark) == "ok":
+            bench_values = panel.prices[benchmark + "_price"].to_numpy(
+                dtype=float)
+    return rolling_engine(user_key + (benchmark,), nav.index,
+                          nav["NAV_fx"].to_numpy(dtype=float), bench_values)
+
+
+@api.route("/rolling_json", methods=["GET"])
+@login_required
+# Rolling window analytics for the portfolio NAV
+# Takes arguments:
+# windows   - comma separated list of windows in days (default 30)
+# metrics   - comma separated list of vol, sharpe, beta, corr (default vol)
+# benchmark - ticker used for beta and corr (default BTC)
+# Returns {dates: [], series: {vol_30: [], ...}, summary: {vol_30: {}}}
+def rolling_json():
+    windows = []
+    for window in (request.args.get("windows") or "30").split(","):
+        try:
+            window = int(window)
+        except ValueError:
+            continue
+        if window >= 2 and window not in windows:
+            windows.append(window)
+    if not windows:
+        windows = [30]
+    metrics = [metric for metric in
+               (request.args.get("metrics") or "vol").lower().split(",")
+               if metric in ROLLING_METRICS]
+    if not metrics:
+        metrics = ["vol"]
+    benchmark = (request.args.get("benchmark") or "BTC").upper()
+
+    transactions = Trades.query.filter_by(user_id=current_user.username)
+    if transactions.count() == 0:
+        return jsonify({"error": "No transactions found"})
+
+    nav = generatenav(current_user.username)
+    needs_benchmark = any(metric in BENCHMARK_METRICS for metric in metrics)
+    engine = nav_rolling(nav, benchmark if needs_benchmark else None)
+    messages = {}
+    if needs_benchmark and engine.benchmark is None:
+        messages[benchmark] = f"Could not get prices for {benchmark}"
+        metrics = [metric for metric in metrics
+                   if metric not in BENCHMARK_METRICS]
+
+    series = {}
+    summary = {}
+    for metric in metrics:
+        for window in windows:
+            name = f"{metric}_{window}"
+            values = engine.metric(metric, window)
+            series[name] = values
+            summary[name] = rolling_summary(values)
+
+    return json_response({
+        "dates": nav.index.strftime("%Y-%m-%d").tolist(),
+        "series": series,
+        "summary": summary,
+        "benchmark": benchmark if needs_benchmark else None,
+        "messages": messages
+    })
+
+
 @api.route("/tradedetails", methods=["GET"])
 @login_required
 # Function that returns a json with trade details given an id
@@ -215,81 +309,79 @@ def portstats():
     # YTD), average daily return. Best day, worse day. Std dev of daily ret,
     # Higher NAV, Lower NAV + dates. Higher Port Value (date).
     data = generatenav(current_user.username)
-    meta["start_date"] = (data.index.min()).date().strftime("%B %d, %Y")
-    meta["end_date"] = data.index.max().date().strftime("%B %d, %Y")
-    meta["start_nav"] = data["NAV_fx"][0]
-    meta["end_nav"] = data["NAV_fx"][-1].astype(float)
-    meta["max_nav"] = data["NAV_fx"].max().astype(float)
-    meta["max_nav_date"] = data[data["NAV_fx"] == data["NAV_fx"].max()].index.strftime(
-        "%B %d, %Y")[0]
-    meta["min_nav"] = data["NAV_fx"].min().astype(float)
-    meta["min_nav_date"] = data[data["NAV_fx"] == data["NAV_fx"].min()].index.strftime(
-        "%B %d, %Y")[0]
-    meta["end_portvalue"] = data["PORT_fx_pos"][-1].astype(float)
+    # Age of the NAV used (may be stale while a new one is generated)
+    meta["nav_status"] = nav_status()
+    # Statistics are computed once for each NAV version (analytics/stats.py)
+    stats = nav_stats(data)
+    extremes = stats.extremes
+    date_fields = ["start_date", "end_date", "max_nav_date", "min_nav_date",
+                   "max_port_date", "min_port_date"]
+    for field, value in extremes.items():
+        if field in date_fields:
+            value = value.strftime("%B %d, %Y")
+        meta[field] = value
+    meta["min_portvalue"] = round(extremes["min_portvalue"], 0)
     meta["end_portvalue_usd"] = meta["end_portvalue"] / current_user.fx_rate_USD()
-    meta["max_portvalue"] = data["PORT_fx_pos"].max().astype(float)
-    meta["max_port_date"] = data[
-        data["PORT_fx_pos"] == data["PORT_fx_pos"].max()
-    ].index.strftime("%B %d, %Y")[0]
-    meta["min_portvalue"] = round(data["PORT_fx_pos"].min(), 0).astype(float)
-    meta["min_port_date"] = data[
-        data["PORT_fx_pos"] == data["PORT_fx_pos"].min()
-    ].index.strftime("%B %d, %Y")[0]
-    meta["return_SI"] = (meta["end_nav"] / meta["start_nav"]) - 1
-    # Temporary fix for an issue with portfolios that are just too new
-    # Create a function to handle this
-    try:
-        meta["return_1d"] = (meta["end_nav"] / data["NAV_fx"][-2]) - 1
-    except IndexError:
-        meta["return_1d"] = "-"
+    # Returns for each horizon - "-" when the portfolio is too new
+    for horizon in ["SI", "1d", "1wk", "30d", "90d", "ATH", "1yr", "YTD"]:
+        value = stats.returns[horizon]
+        meta["return_" + horizon] = "-" if value is None else value
 
-    try:
-        meta["return_1wk"] = (meta["end_nav"] / data["NAV_fx"][-7]) - 1
-    except IndexError:
-        meta["return_1wk"] = "-"
+    # create chart data for a small NAV chart
+    return simplejson.dumps(meta, ignore_nan=True)
 
-    try:
-        meta["return_30d"] = (meta["end_nav"] / data["NAV_fx"][-30]) - 1
-    except IndexError:
-        meta["return_30d"] = "-"
 
+# Applies the NAV view arguments sent with the request:
+# columns    - comma separated list of columns (unknown names are ignored)
+# start      - start date in the format YYYY-MM-DD
+# end        - end date in the format YYYY-MM-DD
+# resolution - daily (default), weekly or monthly (period end rows)
+# points     - maximum number of rows, selected with LTTB on line_column
+def nav_view(nav, columns=None, line_column="NAV_fx"):
+    requested = request.args.get("columns")
+    if requested:
+        columns = [col for col in requested.split(",") if col in nav.columns]
+    if columns:
+        nav = nav[columns]
+    mask = np.ones(len(nav), dtype=bool)
     try:
-        meta["return_90d"] = (meta["end_nav"] / data["NAV_fx"][-90]) - 1
-    except IndexError:
-        meta["return_90d"] = "-"
-
+        mask &= nav.index >= datetime.strptime(request.args.get("start"),
+                                               "%Y-%m-%d")
+    except (ValueError, TypeError):
+        pass
     try:
-        meta["return_ATH"] = (meta["end_nav"] / meta["max_nav"]) - 1
-    except IndexError:
-        meta["return_ATH"] = "-"
-
+        mask &= nav.index <= datetime.strptime(request.args.get("end"),
+                                               "%Y-%m-%d")
+    except (ValueError, TypeError):
+        pass
+    if not mask.all():
+        nav = nav.loc[mask]
+    resolution = (request.args.get("resolution") or "daily").lower()
+    if resolution in RESOLUTIONS:
+        nav = downsample(nav, resolution)
     try:
-        yr_ago = pd.to_datetime(datetime.today() - relativedelta(years=1))
-        yr_ago_NAV = data.NAV_fx[data.index.get_loc(yr_ago, method="nearest")]
-        meta["return_1yr"] = meta["end_nav"] / yr_ago_NAV - 1
-    except IndexError:
-        meta["return_1yr"] = "-"
-
-    # create chart data for a small NAV chart
-    return simplejson.dumps(meta, ignore_nan=True)
+        points = int(request.args.get("points"))
+    except (ValueError, TypeError):
+        points = None
+    if points and points < len(nav):
+        if line_column not in nav.columns:
+            line_column = nav.columns[0]
+        nav = nav.iloc[lttb(nav[line_column].to_numpy(dtype=float), points)]
+    return (nav)
 
 
 @MWT(20)
 @api.route("/navchartdatajson", methods=["GET", "POST"])
 @login_required
 #  Creates a table with dates and NAV values
+#  Accepts the start, end, resolution and points arguments (see nav_view)
 def navchartdatajson():
     data = generatenav(current_user.username)
-    # Generate data for NAV chart
-    navchart = data[["NAV_fx"]]
-    # dates need to be in Epoch time for Highcharts
-    navchart.index = (navchart.index - datetime(1970, 1, 1)).total_seconds()
-    navchart.index = navchart.index * 1000
-    navchart.index = navchart.index.astype(np.int64)
-    navchart = navchart.to_dict()
-    navchart = navchart["NAV_fx"]
-    navchart = json.dumps(navchart)
-    return navchart
+    # Generate data for NAV chart - dates in Epoch time (ms) for Highcharts
+    navchart = nav_view(data, columns=["NAV_fx"])["NAV_fx"]
+    navchart = dict(zip(epoch_ms(navchart.index),
+                        navchart.to_numpy(dtype=float).tolist()))
+    return json_response(navchart)
 
 
 @api.route("/manage_custody", methods=["GET"])
@@ -558,6 +650,41 @@ def manage_custody():
     return json.dumps(tradedetails)
 
 
+# Close prices converted to the user's currency (None if not found)
+def converted_close(ticker):
+    data = price_data_fx(ticker)
+    if data is None:
+        return (None)
+    return (data['close_converted'])
+
+
+# Loads NAV and ticker prices into the comparison panel (one column per
+# ticker, see analytics/compare) and returns the cached comparison for
+# these tickers and dates. Tickers without prices are reported at messages.
+def compare_tickers(tickers, start_date, end_date, market=None):
+    nav = generatenav(current_user.username)
+    user_key = (current_user.username, current_user.fx())
+    panel = get_panel(user_key, nav)
+    messages = panel.ensure(tickers, converted_close)
+    merged = [ticker for ticker in tickers if messages.get(ticker) == "ok"]
+    if market != "NAV" and market not in merged:
+        market = None
+    if start_date == 0:
+        start_date = None
+    key = (user_key, panel.version, tuple(merged), start_date,
+           end_date.date(), market)
+    result = compare(panel, merged, start_date, end_date, market=market,
+                     key=key)
+    return result, messages
+
+
+def corr_table_html(result):
+    corr_matrix = result['corr'].round(2)
+    return corr_matrix.to_html(
+        classes="table small text-center", border=0, justify="center"
+    )
+
+
 @api.route("/portfolio_compare_json", methods=["GET"])
 @login_required
 # Compare portfolio performance to a list of assets
@@ -571,7 +698,7 @@ def manage_custody():
 def portfolio_compare_json():
     if request.method == "GET":
         tickers = request.args.get("tickers").upper()
-        tickers = tickers.split(",")
+        tickers = list(OrderedDict.fromkeys(tickers.split(",")))
         start_date = request.args.get("start")
         method = request.args.get("method")
 
@@ -595,105 +722,26 @@ def portfolio_compare_json():
                 "setting end_date to now"
             )
             end_date = datetime.now()
-    data = {}
-
-    logging.info(
-        "[portfolio_compare_json] NAV requested in list of " +
-        "tickers, requesting generatenav."
-    )
-    nav = generatenav(current_user.username)
-    nav_only = nav["NAV_fx"]
 
-    # Now go over tickers and merge into nav_only df
-    messages = {}
+    # Aligned panel, normalized prices, returns, table and correlation
+    # are built by the comparison engine (analytics/compare)
+    result, messages = compare_tickers(tickers, start_date, end_date)
     meta_data = {}
-    for ticker in tickers:
-        if ticker == "NAV":
-            # Ticker was NAV, skipped
-            continue
-
-        # Generate price Table now for the ticker and trim to match portfolio
-        data = price_data_fx(ticker)
-        # If notification is an error, skip this ticker
-        if data is None:
-            messages = data.errors
-            return jsonify(messages)
-        data = data.rename(columns={'close_converted': ticker+'_price'})
-        data = data[ticker+'_price']
-        nav_only = pd.merge(nav_only, data, on="date", how="left")
-        nav_only[ticker + "_price"].fillna(method="bfill", inplace=True)
-        messages[ticker] = "ok"
-        logging.info(
-            f"[portfolio_compare_json] {ticker}: Success - Merged OK")
-
-    nav_only.fillna(method="ffill", inplace=True)
-
-    # Trim this list only to start_date to end_date:
-    mask = (nav_only.index >= start_date) & (nav_only.index <= end_date)
-    nav_only = nav_only.loc[mask]
-
-    # Now create the list of normalized Returns for the available period
-    # Plus create a table with individual analysis for each ticker and NAV
-    nav_only["NAV_norm"] = (nav_only["NAV_fx"] / nav_only["NAV_fx"][0]) * 100
-    nav_only["NAV_ret"] = nav_only["NAV_norm"].pct_change()
-    table = {}
-    table["meta"] = {}
-    table["meta"]["start_date"] = (nav_only.index[0]).strftime("%m-%d-%Y")
-    table["meta"]["end_date"] = nav_only.index[-1].strftime("%m-%d-%Y")
-    table["meta"]["number_of_days"] = (
-        (nav_only.index[-1] - nav_only.index[0])).days
-    table["meta"]["count_of_points"] = nav_only["NAV_fx"].count().astype(float)
-    table["NAV"] = {}
-    table["NAV"]["start"] = nav_only["NAV_fx"][0]
-    table["NAV"]["end"] = nav_only["NAV_fx"][-1]
-    table["NAV"]["return"] = (nav_only["NAV_fx"][-1] / nav_only["NAV_fx"][0]) - 1
-    table["NAV"]["avg_return"] = nav_only["NAV_ret"].mean()
-    table["NAV"]["ann_std_dev"] = nav_only["NAV_ret"].std() * math.sqrt(365)
-    for ticker in tickers:
-        if messages[ticker] == "ok":
-            # Include new columns for return and normalized data
-            nav_only[ticker + "_norm"] = (
-                nav_only[ticker + "_price"] / nav_only[ticker + "_price"][0]
-            ) * 100
-            nav_only[ticker + "_ret"] = nav_only[ticker + "_norm"].pct_change()
-            # Create Metadata
-            table[ticker] = {}
-            table[ticker]["start"] = nav_only[ticker + "_price"][0]
-            table[ticker]["end"] = nav_only[ticker + "_price"][-1]
-            table[ticker]["return"] = (
-                nav_only[ticker + "_price"][-1] /
-                nav_only[ticker + "_price"][0]
-            ) - 1
-            table[ticker]["comp2nav"] = table[ticker]["return"] - \
-                table["NAV"]["return"]
-            table[ticker]["avg_return"] = nav_only[ticker + "_ret"].mean()
-            table[ticker]["ann_std_dev"] = nav_only[ticker + "_ret"].std() * math.sqrt(
-                365
-            )
-
     logging.info("[portfolio_compare_json] Success")
 
-    # Create Correlation Matrix
-    filter_col = [col for col in nav_only if col.endswith("_ret")]
-    nav_matrix = nav_only[filter_col]
-    corr_matrix = nav_matrix.corr(method="pearson").round(2)
-    corr_html = corr_matrix.to_html(
-        classes="table small text-center", border=0, justify="center"
-    )
-
     # Now, let's return the data in the correct format as requested
     if method == "chart":
-        return jsonify(
+        return json_response(
             {
-                "data": nav_only.to_json(),
+                "data": result['frame'],
                 "messages": messages,
                 "meta_data": meta_data,
-                "table": table,
-                "corr_html": corr_html,
+                "table": result['table'],
+                "corr_html": corr_table_html(result),
             }
         )
 
-    return nav_only.to_json()
+    return encoded_response(result['frame'].to_json())
 
 
 @MWT(20)
@@ -703,6 +751,8 @@ def portfolio_compare_json():
 # Takes 2 arguments:
 # force=False (default) : Forces the NAV generation without reading saved file
 # filter=None (default): Filter to be applied to Pandas df (df.query(filter))
+# Also accepts columns, start, end, resolution and points (see nav_view)
+# and format=columnar ({index: [epoch ms], columns: {column: [values]}})
 def generatenav_json():
     if request.method == "GET":
         filter = request.args.get("filter")
@@ -711,8 +761,36 @@ def generatenav_json():
             filter = ""
         if not force:
             force = False
-        nav = generatenav(current_user.username, force, filter)
-        return nav.to_json()
+        nav = nav_view(generatenav(current_user.username, force, filter))
+        if request.args.get("format") == "columnar":
+            return json_response(columnar(nav))
+        return encoded_response(nav.to_json())
+
+
+@api.route("/allocation_history_json", methods=["GET"])
+@login_required
+# Historical allocation (% of portfolio value) of each ticker
+# Takes arguments:
+# resolution - daily (default), weekly or monthly. Weekly and monthly
+#              return the allocation at the end of each period
+# Returns columnar data:
+# {dates: [epoch ms], tickers: [], allocation: {ticker: [% values]}}
+def allocation_history_json():
+    resolution = (request.args.get("resolution") or "daily").lower()
+    if resolution not in RESOLUTIONS:
+        return jsonify({"error": f"Unknown resolution: {resolution}"})
+    nav = generatenav(current_user.username)
+    columns = [col for col in nav.columns if col.endswith("_fx_perc")]
+    allocation = downsample(nav[columns], resolution)
+    values = (allocation.to_numpy(dtype=float) * 100).round(2)
+    tickers = [col[:-len("_fx_perc")] for col in columns]
+    return json_response({
+        "resolution": resolution,
+        "dates": epoch_ms(allocation.index),
+        "tickers": tickers,
+        "allocation": {ticker: values[:, position]
+                       for position, ticker in enumerate(tickers)}
+    })
 
 
 @MWT(10)
@@ -742,16 +820,19 @@ def portfolio_tickers_json():
 # method   - "chart": returns NAV only data for charts
 #          - "all": returns all data (prices and NAV)
 #          - "meta": returns metadata information
+# The table includes beta, alpha (daily and annualized) and correlation
+# of NAV and each ticker against the market
 def scatter_json():
     if request.method == "GET":
         tickers = request.args.get("tickers").upper()
         tickers = tickers.split(",")
         start_date = request.args.get("start")
-        market = request.args.get("market").upper()
+        market = request.args.get("market")
 
         # Check if market was sent. If not, default=BTC
         if not market:
             market = "BTC"
+        market = market.upper()
 
         # Check if start and end dates exist, if not assign values
         try:
@@ -769,96 +850,14 @@ def scatter_json():
             logging.info(
                 f"[scatter_json] Error: {e}, " + "setting end_date to now")
             end_date = datetime.now()
-    data = {}
 
-    logging.info(
-        "[scatter_json] NAV requested in list of " +
-        "tickers, requesting generatenav."
-    )
-    nav = generatenav(current_user.username)
-    nav_only = nav["NAV_fx"]
     # Append market ticker to list of tickers, remove duplicates
-    tickers.append(market)
-    tickers = list(set(tickers))
-    # Now go over tickers and merge into nav_only df
-    messages = {}
+    tickers = list(OrderedDict.fromkeys(tickers + [market]))
+    result, messages = compare_tickers(tickers, start_date, end_date,
+                                       market=market)
     meta_data = {}
-    for ticker in tickers:
-        if ticker == "NAV":
-            # Ticker was NAV, skipped
-            continue
-        data = price_data_fx(ticker)
-        # If notification is an error, skip this ticker
-        if data is None:
-            messages = data.errors
-            return jsonify(messages)
-
-        data = data.rename(columns={'close_converted': ticker + '_price'})
-        data = data[[ticker + '_price']]
-        data = data.astype(float)
-
-        # Fill dailyNAV with prices for each ticker
-        nav_only = pd.merge(nav_only, data, on="date", how="left")
-        nav_only[ticker + "_price"].fillna(method="bfill", inplace=True)
-        messages[ticker] = "ok"
-        logging.info(f"[scatter_json] {ticker}: Success - Merged OK")
-
-    nav_only.fillna(method="ffill", inplace=True)
-
-    # Trim this list only to start_date to end_date:
-    mask = (nav_only.index >= start_date) & (nav_only.index <= end_date)
-    nav_only = nav_only.loc[mask]
-
-    # Now create the scatter plot data
-    # Plus create a table with individual analysis for each ticker and NAV
-    nav_only["NAV_norm"] = (nav_only["NAV_fx"] / nav_only["NAV_fx"][0]) * 100
-    nav_only["NAV_ret"] = nav_only["NAV_norm"].pct_change()
-    table = {}
-    table["meta"] = {}
-    table["meta"]["start_date"] = (nav_only.index[0]).strftime("%m-%d-%Y")
-    table["meta"]["end_date"] = nav_only.index[-1].strftime("%m-%d-%Y")
-    table["meta"]["number_of_days"] = (
-        (nav_only.index[-1] - nav_only.index[0])).days
-    table["meta"]["count_of_points"] = nav_only["NAV_fx"].count().astype(float)
-    table["NAV"] = {}
-    table["NAV"]["start"] = nav_only["NAV_fx"][0]
-    table["NAV"]["end"] = nav_only["NAV_fx"][-1]
-    table["NAV"]["return"] = (nav_only["NAV_fx"][-1] / nav_only["NAV_fx"][0]) - 1
-    table["NAV"]["avg_return"] = nav_only["NAV_ret"].mean()
-    table["NAV"]["ann_std_dev"] = nav_only["NAV_ret"].std() * math.sqrt(365)
-    # Include avg return + and -
-    for ticker in tickers:
-        if messages[ticker] == "ok":
-            # Include new columns for return and normalized data
-            nav_only[ticker + "_norm"] = (
-                nav_only[ticker + "_price"] / nav_only[ticker + "_price"][0]
-            ) * 100
-            nav_only[ticker + "_ret"] = nav_only[ticker + "_norm"].pct_change()
-            # Create Metadata
-            table[ticker] = {}
-            table[ticker]["start"] = nav_only[ticker + "_price"][0]
-            table[ticker]["end"] = nav_only[ticker + "_price"][-1]
-            table[ticker]["return"] = (
-                nav_only[ticker + "_price"][-1] /
-                nav_only[ticker + "_price"][0]
-            ) - 1
-            table[ticker]["comp2nav"] = table[ticker]["return"] - \
-                table["NAV"]["return"]
-            table[ticker]["avg_return"] = nav_only[ticker + "_ret"].mean()
-            table[ticker]["ann_std_dev"] = nav_only[ticker + "_ret"].std() * math.sqrt(
-                365
-            )
-
     logging.info("[scatter_json] Success")
 
-    # Create Correlation Matrix
-    filter_col = [col for col in nav_only if col.endswith("_ret")]
-    nav_matrix = nav_only[filter_col]
-    corr_matrix = nav_matrix.corr(method="pearson").round(2)
-    corr_html = corr_matrix.to_html(
-        classes="table small text-center", border=0, justify="center"
-    )
-
     # Create series data for HighCharts in scatter plot format
     # series : [{
     #           name: 'NAV / BTC',
@@ -866,30 +865,20 @@ def scatter_json():
     #           data: [[-0.01,-0.02], [0.02, 0.04]]
     # },{
     #           name: .....}]
-    series_hc = []
-    # Append NAV ticker to list of tickers, remove duplicates
-    tickers.append("NAV")
-    tickers = list(set(tickers))
-    for ticker in tickers:
-        tmp_dict = {}
-        if ticker == market:
-            continue
-        tmp_dict["name"] = "x: " + market + ", y: " + ticker
-        tmp_dict["regression"] = 1
-        tmp_df = nav_matrix[[market + "_ret", ticker + "_ret"]]
-        tmp_df.fillna(0, inplace=True)
-        tmp_dict["data"] = list(
-            zip(tmp_df[market + "_ret"], tmp_df[ticker + "_ret"]))
-        series_hc.append(tmp_dict)
+    plotted = [ticker for ticker in tickers if messages.get(ticker) == "ok"]
+    if messages.get(market) == "ok" or market == "NAV":
+        series_hc = scatter_series(result, market, plotted + ["NAV"])
+    else:
+        series_hc = []
 
     # Now, let's return the data in the correct format as requested
-    return jsonify(
+    return json_response(
         {
             "chart_data": series_hc,
             "messages": messages,
             "meta_data": meta_data,
-            "table": table,
-            "corr_html": corr_html,
+            "table": result['table'],
+            "corr_html": corr_table_html(result),
         }
     )
 
@@ -1019,11 +1008,11 @@ def transactionsandcost_json():
     daily_df.loc[daily_df.q_cum_sum <= 0.009, "impact_on_cost_per"] = np.NaN
 
     return_dict = {}
-    return_dict["data"] = daily_df.to_json()
+    return_dict["data"] = daily_df
     return_dict["message"] = message
     return_dict["fx"] = fxsymbol(current_user.fx())
     logging.info(f"[transactionandcost_json] Success generating data")
-    return jsonify(return_dict)
+    return json_response(return_dict)
 
 
 @api.route("/heatmapbenchmark_json", methods=["GET"])
@@ -1066,59 +1055,15 @@ def heatmapbenchmark_json():
     data = data.rename(columns={'close_converted': ticker+'_price'})
     data = data[[ticker+'_price']]
     data.sort_index(ascending=True, inplace=True)
-    data["pchange"] = (data / data.shift(1)) - 1
-    # Run the mrh function to generate heapmap table
-    heatmap = mrh.get(data["pchange"], eoy=True)
+    # Heatmap and stats in a single pass (analytics/heatmap.py)
+    prices = data[ticker + '_price']
+    heatmap = price_heatmap(prices, key=(ticker, current_user.fx(),
+                                         len(prices), prices.index[0],
+                                         prices.index[-1],
+                                         float(prices.iat[-1])))
     heatmap_stats = heatmap
-    cols = [
-        "Jan",
-        "Feb",
-        "Mar",
-        "Apr",
-        "May",
-        "Jun",
-        "Jul",
-        "Aug",
-        "Sep",
-        "Oct",
-        "Nov",
-        "Dec",
-        "eoy",
-    ]
-    cols_months = [
-        "Jan",
-        "Feb",
-        "Mar",
-        "Apr",
-        "May",
-        "Jun",
-        "Jul",
-        "Aug",
-        "Sep",
-        "Oct",
-        "Nov",
-        "Dec",
-    ]
+    cols = HEATMAP_COLUMNS
     years = heatmap.index.tolist()
-    # Create summary stats for the Ticker
-    heatmap_stats["MAX"] = heatmap_stats[heatmap_stats[cols_months] != 0].max(
-        axis=1)
-    heatmap_stats["MIN"] = heatmap_stats[heatmap_stats[cols_months] != 0].min(
-        axis=1)
-    heatmap_stats["POSITIVES"] = heatmap_stats[heatmap_stats[cols_months] > 0].count(
-        axis=1
-    )
-    heatmap_stats["NEGATIVES"] = heatmap_stats[heatmap_stats[cols_months] < 0].count(
-        axis=1
-    )
-    heatmap_stats["POS_MEAN"] = heatmap_stats[heatmap_stats[cols_months] > 0].mean(
-        axis=1
-    )
-    heatmap_stats["NEG_MEAN"] = heatmap_stats[heatmap_stats[cols_months] < 0].mean(
-        axis=1
-    )
-    heatmap_stats["MEAN"] = heatmap_stats[heatmap_stats[cols_months] != 0].mean(
-        axis=1)
 
     # Create the difference between the 2 df - Pandas is cool!
     heatmap_difference = heatmap_gen - heatmap
@@ -1198,52 +1143,9 @@ def drawdown_json():
     # Trim the df only to start_date to end_date:
     mask = (data.index >= start_date) & (data.index <= end_date)
     data = data.loc[mask]
-    # # Calculate drawdowns
-    # df = 100 * (1 + data / 100).cumprod()
-
-    df = pd.DataFrame()
-    df["close"] = data['close']
-    df["ret"] = df.close / df.close[0]
-    df["modMax"] = df.ret.cummax()
-    df["modDD"] = (df.ret / df["modMax"]) - 1
-    # Starting date of the currency modMax
-    df["end_date"] = df.index
-    # is this the first occurence of this modMax?
-    df["dup"] = df.duplicated(["modMax"])
-
-    # Now, exclude the drawdowns that have overlapping data, keep only highest
-    df_group = df.groupby(["modMax"]).min().sort_values(
-        by="modDD", ascending=True)
-    # Trim to fit n_dd
-    df_group = df_group.head(n_dd)
-    # Format a dict for return
-    return_list = []
-    for index, row in df_group.iterrows():
-        # access data using column names
-        tmp_dict = {}
-        tmp_dict["dd"] = row["modDD"]
-        tmp_dict["start_date"] = row["end_date"].strftime("%Y-%m-%d")
-        tmp_dict["end_value"] = row["close"]
-        tmp_dict["recovery_date"] = (
-            df[df.modMax == index].tail(1).end_date[0].strftime("%Y-%m-%d")
-        )
-        tmp_dict["end_date"] = (
-            df[df.close == row["close"]].tail(
-                1).end_date[0].strftime("%Y-%m-%d")
-        )
-        tmp_dict["start_value"] = df[df.index ==
-                                     row["end_date"]].tail(1).close[0]
-        tmp_dict["days_to_recovery"] = (
-            df[df.modMax == index].tail(1).end_date[0] - row["end_date"]
-        ).days
-        tmp_dict["days_to_bottom"] = (
-            df[df.close == row["close"]].tail(1).end_date[0] - row["end_date"]
-        ).days
-        tmp_dict["days_bottom_to_recovery"] = (
-            df[df.modMax == index].tail(1).end_date[0] -
-            df[df.close == row["close"]].tail(1).end_date[0]
-        ).days
-        return_list.append(tmp_dict)
+    # Find all drawdown episodes in a single pass (analytics/drawdown.py)
+    # and keep the n_dd largest
+    return_list = top_drawdowns(data.index, data['close'].values, n_dd)
 
     if chart:
         start_date = data.index.min()
@@ -1463,6 +1365,10 @@ def get_address():
                     logging.error("Error when passing Dojo data as json")
 
             else:
+                # A failed sync still returns the cached rows - their
+                # balance may be stale so the check is not a success
+                if dojo.get("error"):
+                    raise KeyError(dojo["error"])
                 dojo_balance = s_to_f(dojo["balance"])
         except (KeyError, TypeError):
             if address_data.check_method == "3":
@@ -1526,6 +1432,36 @@ def get_address():
     return "error"
 
 
+@api.route("/refresh_addresses", methods=["POST"])
+@login_required
+# Refreshes the balances of many addresses and xpubs at once using
+# batched Dojo multiaddr requests (see node/monitor.py)
+# Takes the form field addresses (comma separated). When empty, all
+# addresses and xpubs of the user are refreshed.
+# Returns {results: {address: {address_data, change, success, method}}}
+def refresh_addresses():
+    addresses = request.form.get("addresses")
+    if addresses:
+        addresses = [address.strip() for address in addresses.split(",")
+                     if address.strip()]
+    else:
+        addresses = None
+    results = refresh_balances(current_user.username, addresses,
+                               on_change=regenerate_nav)
+    return json_response({"results": results})
+
+
+@api.route("/watcher_json", methods=["GET"])
+@login_required
+# Status of the background balance watcher and the recent balance
+# changes it found for the current user (see node/watcher.py)
+def watcher_json():
+    return json_response({
+        "status": watcher.watcher.status(),
+        "events": watcher.watcher.recent_events(current_user.username)
+    })
+
+
 @api.route("/getprice_ondate", methods=["GET"])
 @login_required
 # Return the price of a ticker on a given date
@@ -1552,72 +1488,83 @@ def getprice_ondate():
 def import_transaction():
     # Convert to json
     jsonData = request.get_json()
-    # Import into the database
+    # Transactions already in the database (single query)
+    existing = trade_blockchain_ids()
+    new_trades = []
+    failures = []
+    # Rows are validated here so a bad row does not fail the whole commit
     for item in jsonData:
+        row = jsonData[item]
         # Check if in database
-        transaction_id = jsonData[item]["trade_blockchain_id"]
-        find_match = (
-            Trades.query.filter_by(user_id=current_user.username)
-            .filter_by(trade_blockchain_id=transaction_id)
-            .first()
-        )
-        if find_match is not None:
+        transaction_id = row.get("trade_blockchain_id")
+        label = str(transaction_id)[0:6]
+        if transaction_id in existing:
             flash(
-                f"Transaction not imported. Exists in database: {transaction_id[0:6]}...",
+                f"Transaction not imported. Exists in database: {label}...",
                 "danger",
             )
             continue
+        if "trade_price" not in row:
+            failures.append(f"{label}: no price found")
+            continue
 
         try:
-            try:
-                price = float(jsonData[item]["trade_price"].replace(",", ""))
-            except KeyError:
-                flash(
-                    f"Error: No price found when importing transaction {jsonData[item]['trade_blockchain_id'][0:6]}",
-                    "danger",
-                )
-                continue
-            quant = jsonData[item]["trade_quantity"]
+            price = float(str(row["trade_price"]).replace(",", ""))
+            quant = float(row["trade_quantity"])
+            fees = float(row["trade_fees"] or 0)
             cv = price * quant
-        except (AttributeError, ValueError):
-            cv = 0
+            # Check if date in epoch or not
+            try:
+                trade_date = datetime.fromtimestamp(
+                    int(row["trade_date"]))  # Epoch worked
+            except ValueError:
+                trade_date = parser.parse(row["trade_date"])
+            for field in ["trade_operation", "trade_currency",
+                          "trade_asset_ticker", "trade_account"]:
+                if not row[field]:
+                    raise ValueError(f"{field} is empty")
+            # Create the database object
+            new_trade = Trades(
+                user_id=current_user.username,
+                trade_inputon=parser.parse(row["trade_inputon"]),
+                trade_quantity=quant,
+                trade_operation=row["trade_operation"],
+                trade_currency=row["trade_currency"],
+                trade_fees=fees,
+                trade_asset_ticker=row["trade_asset_ticker"],
+                trade_price=price,
+                trade_date=trade_date,  # epoch date to dateTime
+                trade_blockchain_id=row["trade_blockchain_id"],
+                trade_account=row["trade_account"],
+                trade_notes=row.get("trade_notes"),
+                cash_value=cv,
+                trade_reference_id=secrets.token_hex(21),
+            )
+        except KeyError as e:
+            failures.append(f"{label}: missing field {e}")
+            continue
+        except (OverflowError, TypeError, ValueError) as e:
+            failures.append(f"{label}: {e}")
+            continue
 
-        # Create the database object
-        # Check if date in epoch or not
-        try:
-            trade_date = datetime.fromtimestamp(
-                int(jsonData[item]["trade_date"]))  # Epoch worked
-        except ValueError:
-            trade_date = parser.parse(jsonData[item]["trade_date"])
-
-        new_trade = Trades(
-            user_id=current_user.username,
-            trade_inputon=parser.parse(jsonData[item]["trade_inputon"]),
-            trade_quantity=quant,
-            trade_operation=jsonData[item]["trade_operation"],
-            trade_currency=jsonData[item]["trade_currency"],
-            trade_fees=jsonData[item]["trade_fees"],
-            trade_asset_ticker=jsonData[item]["trade_asset_ticker"],
-            trade_price=price,
-            trade_date=trade_date,  # epoch date to dateTime
-            trade_blockchain_id=jsonData[item]["trade_blockchain_id"],
-            trade_account=jsonData[item]["trade_account"],
-            trade_notes=jsonData[item]["trade_notes"],
-            cash_value=cv,
-            trade_reference_id=secrets.token_hex(21),
-        )
+        new_trades.append(new_trade)
+        if transaction_id:
+            existing.add(transaction_id)
+
+    for failure in failures:
+        flash(f"Error importing transaction {failure}", "danger")
 
+    # Valid transactions are included in a single commit and NAV is
+    # regenerated once
+    if new_trades:
         try:
-            db.session.add(new_trade)
+            db.session.add_all(new_trades)
             db.session.commit()
             regenerate_nav()
-            flash(
-                f"Transaction included. {transaction_id[0:6]}...", "success")
+            flash(f"{len(new_trades)} transactions included.", "success")
         except Exception as e:
-            flash(
-                f"Error: {e} when importing transaction {jsonData[item]['trade_blockchain_id'][0:6]}",
-                "danger",
-            )
+            db.session.rollback()
+            flash(f"Error: {e} when importing transactions", "danger")
 
     logging.info("Import done")
     # logging.info(get_flashed_messages())
@@ -1655,29 +1602,32 @@ def addresses_importer():
     if "error" in dojo:
         return json.dumps(meta)
     meta["status"] = {}
-    # Loop through addresses found in Dojo and include in monitor database
+    # Existing addresses and xpubs are loaded once and compared in memory
+    # (xpubs against accounts, loose addresses against addresses)
+    existing_addresses = set(
+        address for (address,) in db.session.query(
+            BitcoinAddresses.address_hash).filter_by(
+                user_id=current_user.username))
+    existing_accounts = set(
+        address for (address,) in db.session.query(
+            AccountInfo.account_blockchain_id).filter_by(
+                user_id=current_user.username))
+    # HD addresses are included as accounts (since they can hold pubkey
+    # addresses), pubkey addresses are included in the bitcoinaddress table
+    new_items = []
     counter = 0
     for item in dojo["addresses"]:
-        address_info = {}
-        address_info["message"] = "Found and Imported"
-        # Is this a pubkey address or HD address?
-        # HD addresses are included as accounts (since they can hold pubkey addresses)
-        # pubkey addresses included in the bitcoinaddress table
-        hd_address_list = ("xpub", "ypub", "zpub")
         address = item["address"]
-
-        # HD Address Handling
-        if address.lower().startswith(hd_address_list):
-            address_info["hd"] = True
-            search_add = AccountInfo.query.filter_by(
-                user_id=current_user.username
-            ).filter_by(account_blockchain_id=address)
-            if search_add.count() > 0:
-                address_info["message"] = "NOT imported. Already in database."
-                meta["status"][item["address"]] = address_info
-                continue
+        hd = is_hd(address)
+        existing = existing_accounts if hd else existing_addresses
+        if address in existing:
+            meta["status"][address] = {
+                "hd": hd, "message": "NOT imported. Already in database."}
+            continue
+        existing.add(address)
+        if hd:
             counter += 1
-            bitcoin_address = AccountInfo(
+            new_items.append(AccountInfo(
                 user_id=current_user.username,
                 account_longname="HD Wallet " + str(counter),
                 check_method="1",
@@ -1686,19 +1636,9 @@ def addresses_importer():
                 last_check=datetime.now(),
                 last_balance=s_to_f(item["final_balance"]),
                 notes="Account imported using the Dojo through multi address import page",
-            )
-        # Bitcoin Address Handling - Not HD
+            ))
         else:
-            # check if this address is already in the database
-            address_info["hd"] = False
-            search_add = BitcoinAddresses.query.filter_by(
-                user_id=current_user.username
-            ).filter_by(address_hash=address)
-            if search_add.count() > 0:
-                address_info["message"] = "NOT imported. Already in database."
-                meta["status"][item["address"]] = address_info
-                continue
-            bitcoin_address = BitcoinAddresses(
+            new_items.append(BitcoinAddresses(
                 user_id=current_user.username,
                 address_hash=address,
                 check_method="1",
@@ -1708,17 +1648,25 @@ def addresses_importer():
                 last_check=datetime.now(),
                 last_balance=s_to_f(item["final_balance"]),
                 notes="Imported using the Dojo through multi address import page",
-            )
+            ))
+        meta["status"][address] = {"hd": hd, "message": "Found and Imported"}
 
+    # Single transaction for all new addresses
+    # (NAV is not regenerated - addresses do not change trades)
+    if new_items:
         try:
-            db.session.add(bitcoin_address)
+            db.session.add_all(new_items)
             db.session.commit()
-            regenerate_nav()
-            address_info["message"] = "Found and Imported"
         except Exception as e:
+            db.session.rollback()
             logging.info(f"Error importing: {e}")
-            address_info["message"] = f"NOT imported. Error: {e}."
-        meta["status"][item["address"]] = address_info
+            for new_item in new_items:
+                address = getattr(new_item, "address_hash", None) or \
+                    new_item.account_blockchain_id
+                meta["status"][address]["message"] = \
+                    f"NOT imported. Error: {e}."
+    logging.info(f"[Importer] {len(new_items)} of {len(address_list)} " +
+                 "addresses imported")
 
     # return a list of addresses not found in the Dojo
     for add in address_list:
@@ -1744,21 +1692,25 @@ def test_aakey():
         globalURL = baseURL + api_key
         try:
             logging.info(f"[ALPHAVANTAGE] Requesting URL: {globalURL}")
-            api_request = tor_request(globalURL).json()
-            data["status"] = "success"
+            response = governed_request('alphavantage', globalURL)
         except requests.exceptions.ConnectionError:
-            data["status"] = "failed"
-            data["message"] = "Connection Error"
+            response = "Connection Error"
+        # Strings are errors from the governor / tor_request
+        if isinstance(response, str):
+            data["message"] = response
+            return data
         try:
+            api_request = response.json()
+            data["status"] = "success"
             data["message"] = api_request
             # Success - store this in database
             api_keys_json = api_keys_class.loader()
             api_keys_json['alphavantage']['api_key'] = api_key
             api_keys_class.saver(api_keys_json)
 
-        except AttributeError:
+        except ValueError:
             data["status"] = "failed"
-            data["message"] = api_request
+            data["message"] = "Invalid response from Alphavantage"
     return data
 
 
@@ -1852,14 +1804,13 @@ def positions_json():
     # Get all transactions and cost details
     # This serves the main page
     dfdyn, piedata = positions_dynamic()
-    dfdyn = dfdyn.to_dict(orient='index')
     json_dict = {
-        'positions': dfdyn,
+        'positions': frame_to_dict(dfdyn, orient='index'),
         'piechart': piedata,
         'user': current_user.fx_rate_data(),
         'btc': price_data_rt("BTC") * current_user.fx_rate_USD()
     }
-    return simplejson.dumps(json_dict, ignore_nan=True)
+    return json_response(json_dict)
 
 
 @api.route("/accounting_json", methods=["GET"])
@@ -1906,6 +1857,75 @@ def test_price():
     return(data)
 
 
+@api.route("/pricing_quota_json", methods=["GET"])
+# Returns the status of the rate limit governor for each provider
+# (tokens available, queued requests and today's request counters)
+def pricing_quota_json():
+    return simplejson.dumps(governor_status())
+
+
+@api.route("/pricing_routes_json", methods=["GET"])
+# Returns the provider routing table (latency and error rate for each
+# provider and the providers that last succeeded for each ticker)
+def pricing_routes_json():
+    return simplejson.dumps(router.table())
+
+
+@api.route("/negative_cache_json", methods=["GET"])
+# Returns the tickers that could not be priced by any provider and that
+# are being skipped until the entry expires
+def negative_cache_json():
+    return simplejson.dumps(negative_cache.list())
+
+
+@api.route("/negative_cache_clear", methods=["POST"])
+@login_required
+# Removes a ticker from the negative cache so it is requested again.
+# If no ticker is passed, all entries are removed.
+def negative_cache_clear():
+    ticker = request.form.get("ticker") or None
+    removed = negative_cache.clear(ticker)
+    return json.dumps({'removed': removed})
+
+
+@api.route("/debug/metrics", methods=["GET"])
+# Instrumentation data - histograms for each span and the recent traces.
+# Use ?format=prometheus to get the histograms in Prometheus text format.
+# Only available from this machine.
+def debug_metrics():
+    if request.remote_addr not in ["127.0.0.1", "::1"]:
+        abort(403)
+    if request.args.get("format") == "prometheus":
+        return Response(metrics.prometheus(),
+                        mimetype="text/plain; version=0.0.4")
+    traces = request.args.get("traces", 20, type=int)
+    return simplejson.dumps(metrics.snapshot(traces), ignore_nan=True)
+
+
+@api.route("/debug/profiles", methods=["GET"])
+# Lists the profiled requests (slowest first). Requests are profiled
+# when WARDEN_STATUS="developer" and the X-Warden-Profile header or
+# _profile argument is sent. See users/profiler.py
+def debug_profiles():
+    if not profiler.enabled() or request.remote_addr not in [
+            "127.0.0.1", "::1"]:
+        abort(403)
+    return render_template("debug_profiles.html",
+                           title="Profiles",
+                           profiles=profiler.slowest_profiles())
+
+
+@api.route("/debug/profiles/<profile_id>", methods=["GET"])
+def debug_profile_download(profile_id):
+    if not profiler.enabled() or request.remote_addr not in [
+            "127.0.0.1", "::1"]:
+        abort(403)
+    filename = profiler.profile_path(profile_id)
+    if filename is None or not os.path.exists(filename):
+        abort(404)
+    return send_file(filename, as_attachment=True)
+
+
 @api.route("/search", methods=["GET"])
 def search():
     ticker = request.args.get("ticker")
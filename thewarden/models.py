@@ -153,3 +153,28 @@ class BitcoinAddresses(db.Model):
     check_method = db.Column(db.String(255))
     imported_from_hdaddress = db.Column(db.String(255))
     notes = db.Column(db.Text)
+
+
+class BitcoinTransactions(db.Model):
+    # Local cache of the transactions of a monitored address or xpub
+    # (see node/txcache.py). block_height is None while unconfirmed.
+    __table_args__ = (db.UniqueConstraint("address", "txid"),)
+    id = db.Column(db.Integer, primary_key=True)
+    address = db.Column(db.String(256), nullable=False, index=True)
+    txid = db.Column(db.String(64), nullable=False)
+    time = db.Column(db.Integer)
+    result = db.Column(db.Float)
+    block_height = db.Column(db.Integer)
+
+    def __repr__(self):
+        return f"BitcoinTransactions('{self.address}', '{self.txid}', \
+                        '{self.block_height}', '{self.result}')"
+
+
+class AddressSyncCursor(db.Model):
+    # Last block height synced for an address or xpub. Transactions
+    # confirmed up to this height are already at BitcoinTransactions.
+    address = db.Column(db.String(256), primary_key=True)
+    block_height = db.Column(db.Integer, default=0)
+    n_tx = db.Column(db.Integer, default=0)
+    last_sync = db.Column(db.DateTime)
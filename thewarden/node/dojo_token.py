@@ -0,0 +1,203 @@
+# Dojo authentication token manager
+# Keeps the access and refresh tokens in memory with their expiry (read
+# from the JWT exp claim). Access tokens are renewed before they expire
+# using the refresh token (POST /v2/auth/refresh) and only fall back to a
+# new login (POST /v2/auth/login) when the refresh token also expired or
+# was rejected. See:
+# https://github.com/Samourai-Wallet/samourai-dojo/blob/develop/doc/POST_auth_login.md
+# https://github.com/Samourai-Wallet/samourai-dojo/blob/develop/doc/POST_auth_refresh.md
+#
+# All requests share the same manager (thread safe - a single request
+# renews the token while the others wait for it). api_keys.conf is only
+# written when the access token changes.
+#
+# Usage:
+#     at = token_manager.token()
+#     token_manager.invalidate()  # after an "Invalid JSON Web Token" error
+import base64
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from thewarden.node.tor import transport
+
+# Tokens are renewed this many seconds before they expire
+EXPIRY_MARGIN = 60
+# Used when the token has no exp claim (Dojo defaults)
+ACCESS_TTL = 900
+REFRESH_TTL = 7200
+# Seconds before trying to login again after an error
+FAILURE_BACKOFF = 30
+TIME_OUT = 20
+INVALID_TOKEN = "Invalid JSON Web Token"
+
+
+def token_expiry(token, default_ttl):
+    # exp claim of a JWT (epoch seconds)
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return time.time() + default_ttl
+
+
+class DojoTokenManager():
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._settings = None
+        self._settings_mtime = None
+        self.access_token = None
+        self.refresh_token = None
+        self.access_expiry = 0
+        self.refresh_expiry = 0
+        self.last_response = None
+        self.last_failure = 0
+
+    def _reset(self):
+        self.access_token = self.refresh_token = None
+        self.access_expiry = self.refresh_expiry = 0
+        self.last_failure = 0
+
+    def settings(self):
+        # api_keys.conf is read again only when the file changes
+        from thewarden.pricing_engine.pricing import api_keys_class
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(api_keys_class.filename)
+            except OSError:
+                mtime = None
+            if self._settings is None or mtime != self._settings_mtime:
+                settings = api_keys_class.loader()
+                previous = self._settings
+                self._settings = settings
+                self._settings_mtime = mtime
+                # New onion address or API key - tokens are not valid
+                if previous is not None and (
+                        previous['dojo']['onion'] !=
+                        settings['dojo']['onion'] or
+                        previous['dojo']['api_key'] !=
+                        settings['dojo']['api_key']):
+                    self._reset()
+            return (self._settings)
+
+    def _save(self, token):
+        # Writes api_keys.conf only if the token changed
+        from thewarden.pricing_engine.pricing import api_keys_class
+        settings = self.settings()
+        if settings['dojo'].get('token') == token:
+            return
+        settings['dojo']['token'] = token
+        api_keys_class.saver(settings)
+        try:
+            self._settings_mtime = os.path.getmtime(api_keys_class.filename)
+        except OSError:
+            self._settings_mtime = None
+
+    def _store(self, authorizations):
+        self.access_token = authorizations['access_token']
+        self.access_expiry = token_expiry(self.access_token, ACCESS_TTL)
+        if authorizations.get('refresh_token'):
+            self.refresh_token = authorizations['refresh_token']
+            self.refresh_expiry = token_expiry(self.refresh_token,
+                                               REFRESH_TTL)
+        self.last_failure = 0
+        self._save(self.access_token)
+
+    def _post(self, path, fields):
+        onion_address = self.settings()['dojo']['onion']
+        url = "http://" + onion_address + path
+        try:
+            response = transport.post(url, fields, timeout=TIME_OUT).json()
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.InvalidURL,
+                requests.exceptions.ReadTimeout,
+                requests.exceptions.InvalidSchema, UnicodeError,
+                ValueError) as e:
+            logging.info(f"[Dojo Token] Error: {e}")
+            response = {"status": "error", "error": f"Error: {e}"}
+        return (response)
+
+    def _refresh(self):
+        logging.info("[Dojo Token] Refreshing access token")
+        response = self._post("/v2/auth/refresh", {"rt": self.refresh_token})
+        try:
+            self._store(response['authorizations'])
+            self.last_response = {"authorizations": {
+                "access_token": self.access_token,
+                "refresh_token": self.refresh_token}}
+            return (True)
+        except (KeyError, TypeError):
+            logging.info(f"[Dojo Token] Refresh failed: {response}")
+            self.refresh_token = None
+            self.refresh_expiry = 0
+            return (False)
+
+    def _login(self):
+        logging.info("[Dojo Token] Login")
+        settings = self.settings()['dojo']
+        if (settings.get('onion') is None) or (
+                settings.get('api_key') is None):
+            self.last_response = {"status": "error",
+                                  "error": "missing config"}
+            self._fail()
+            return
+        response = self._post("/v2/auth/login",
+                              {"apikey": settings['api_key']})
+        self.last_response = response
+        try:
+            self._store(response['authorizations'])
+        except (KeyError, TypeError):
+            logging.info(f"[Dojo Token] Login failed: {response}")
+            self._fail()
+
+    def _fail(self):
+        self.access_token = None
+        self.access_expiry = 0
+        self.last_failure = time.time()
+        self._save("error")
+
+    def token(self, force=False):
+        # Returns a valid access token or "error"
+        with self._lock:
+            self.settings()
+            now = time.time()
+            if not force:
+                if (self.access_token and
+                        now < self.access_expiry - EXPIRY_MARGIN):
+                    return (self.access_token)
+                if now - self.last_failure < FAILURE_BACKOFF:
+                    return ("error")
+            if (self.refresh_token and
+                    now < self.refresh_expiry - EXPIRY_MARGIN and
+                    self._refresh()):
+                return (self.access_token)
+            self._login()
+            return (self.access_token or "error")
+
+    def auth(self, force=False):
+        # Same format returned by /v2/auth/login
+        with self._lock:
+            token = self.token(force)
+            if token != "error":
+                return {"authorizations": {
+                    "access_token": self.access_token,
+                    "refresh_token": self.refresh_token}}
+            return (self.last_response or
+                    {"status": "error", "error": "Unable to get token"})
+
+    def invalidate(self, token=None):
+        # The token was rejected by Dojo - next call renews it
+        # (ignored if the token was already renewed by another request)
+        with self._lock:
+            if token is None or token == self.access_token:
+                self.access_token = None
+                self.access_expiry = 0
+                self.last_failure = 0
+
+
+token_manager = DojoTokenManager()
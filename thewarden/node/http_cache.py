@@ -0,0 +1,251 @@
+# Persistent HTTP response cache for provider calls
+# Sits beneath tor_request: GET responses of known endpoints are saved to
+# disk and returned while fresh, so restarts and repeated analytics do
+# not download the same data again.
+#
+# Freshness depends on the endpoint class (ENDPOINT_CLASSES): realtime
+# quotes for seconds, daily history for hours, metadata (coin lists) for
+# days. Endpoints not listed are never cached.
+# Expired entries that came with an ETag or Last-Modified header are
+# revalidated with a conditional request - a 304 renews the entry without
+# downloading the body again.
+#
+# Only successful responses are stored: HTTP errors, connection errors
+# and provider error messages (throttle notes, invalid ticker, ...) are
+# never cached. The folder is kept under HTTP_CACHE_MB (config.ini), the
+# least recently used entries are removed first.
+#
+# Entries are saved under a hash of the url (urls may include api keys).
+#
+# Usage:
+#     response = cache.fresh(url)            # None if not cached / expired
+#     headers = cache.conditional_headers(url)
+#     response = cache.store(url, response)  # handles 304 and failures
+import configparser
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+try:
+    HTTP_CACHE_MB = float(config['MAIN']['HTTP_CACHE_MB'])
+except (KeyError, ValueError):
+    HTTP_CACHE_MB = 50
+    logging.info("Could not find HTTP_CACHE_MB at config.ini." +
+                 " Defaulting to 50 MB.")
+
+# Endpoint class: (seconds fresh, url fragments)
+ENDPOINT_CLASSES = {
+    'realtime': (30, ('/data/price', 'CURRENCY_EXCHANGE_RATE',
+                      'GLOBAL_QUOTE', 'real-time-price', '/lastblock')),
+    'historical': (6 * 3600, ('/data/histoday', 'DIGITAL_CURRENCY_DAILY',
+                              'TIME_SERIES_DAILY', 'FX_DAILY',
+                              'historical-price-full')),
+    'metadata': (7 * 86400, ('/all/coinlist',))
+}
+# Headers kept with the entry
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Date')
+# After an eviction the folder is trimmed to this fraction of the cap
+EVICT_TO = 0.9
+
+
+def endpoint_class(url):
+    for name, (ttl, fragments) in ENDPOINT_CLASSES.items():
+        if any(fragment in url for fragment in fragments):
+            return name, ttl
+    return None, None
+
+
+def is_failure(response):
+    # True for HTTP errors and for provider error messages sent with a
+    # 200 status (Alphavantage notes, CryptoCompare errors, ...)
+    if getattr(response, 'status_code', None) != 200:
+        return (True)
+    try:
+        data = response.json()
+    except ValueError:
+        return (False)
+    if not isinstance(data, dict):
+        return (False)
+    if data.get('Response') == 'Error' or data.get('status') == 'error':
+        return (True)
+    return (any(field in data for field in
+                ('Error Message', 'Note', 'Information', 'error')))
+
+
+class HTTPCache():
+    def __init__(self, folder, max_mb=HTTP_CACHE_MB):
+        self.folder = folder
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _key(self, url):
+        return (hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def _path(self, key):
+        return (os.path.join(self.folder, key + '.json'))
+
+    def _load_index(self):
+        # {key: [size, last access]} - built from the folder on first use
+        if self._index is None:
+            self._index = {}
+            try:
+                for filename in os.listdir(self.folder):
+                    if filename.endswith('.json'):
+                        stat = os.stat(os.path.join(self.folder, filename))
+                        self._index[filename[:-5]] = [stat.st_size,
+                                                      stat.st_mtime]
+            except OSError:
+                pass
+        return (self._index)
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), 'r') as fp:
+                return (json.load(fp))
+        except (OSError, ValueError):
+            return (None)
+
+    def _write(self, key, entry):
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            data = json.dumps(entry)
+            with open(self._path(key), 'w') as fp:
+                fp.write(data)
+        except (OSError, TypeError, ValueError) as e:
+            logging.error(f"[HTTP Cache] Could not save entry: {e}")
+            return
+        index = self._load_index()
+        index[key] = [len(data), time.time()]
+        self._evict(index)
+
+    def _evict(self, index):
+        total = sum(size for size, __ in index.values())
+        if total <= self.max_bytes:
+            return
+        for key, (size, __) in sorted(index.items(),
+                                      key=lambda item: item[1][1]):
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            del index[key]
+            total -= size
+            if total <= self.max_bytes * EVICT_TO:
+                break
+
+    def _response(self, url, entry):
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = entry['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.headers['X-Warden-Cache'] = 'hit'
+        return (response)
+
+    def _touch(self, key):
+        index = self._load_index()
+        if key in index:
+            index[key][1] = time.time()
+
+    def fresh(self, url):
+        # Cached response if still fresh, otherwise None
+        name, __ = endpoint_class(url)
+        if name is None:
+            return (None)
+        key = self._key(url)
+        with self._lock:
+            entry = self._read(key)
+            if entry is None or entry['expires'] < time.time():
+                self.misses += 1
+                return (None)
+            self.hits += 1
+            self._touch(key)
+        return (self._response(url, entry))
+
+    def conditional_headers(self, url):
+        # If-None-Match / If-Modified-Since for an expired entry
+        if endpoint_class(url)[0] is None:
+            return ({})
+        with self._lock:
+            entry = self._read(self._key(url))
+        if entry is None:
+            return ({})
+        headers = {}
+        if entry['headers'].get('ETag'):
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return (headers)
+
+    def store(self, url, response):
+        # Saves a successful response. A 304 renews the stored entry and
+        # returns it. Anything else is returned unchanged.
+        name, ttl = endpoint_class(url)
+        if name is None or not isinstance(response,
+                                          requests.models.Response):
+            return (response)
+        key = self._key(url)
+        if response.status_code == 304:
+            with self._lock:
+                entry = self._read(key)
+                if entry is None:
+                    return (response)
+                entry['expires'] = time.time() + ttl
+                self._write(key, entry)
+                self.revalidated += 1
+            return (self._response(url, entry))
+        cache_control = response.headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control or is_failure(response):
+            return (response)
+        entry = {
+            'class': name,
+            'stored': time.time(),
+            'expires': time.time() + ttl,
+            'headers': {field: response.headers[field]
+                        for field in KEPT_HEADERS
+                        if field in response.headers},
+            'body': response.text
+        }
+        with self._lock:
+            self._write(key, entry)
+        return (response)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._load_index()):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._index = {}
+
+    def status(self):
+        with self._lock:
+            index = self._load_index()
+            return {
+                'entries': len(index),
+                'size_mb': round(sum(size for size, __ in index.values()) /
+                                 1024 / 1024, 2),
+                'max_mb': round(self.max_bytes / 1024 / 1024, 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated
+            }
+
+
+cache = HTTPCache(os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'pricing_engine', 'http_cache'))
@@ -0,0 +1,221 @@
+# Batch balance refresh for the Bitcoin monitor
+# Loose addresses and xpubs of a user are grouped into a few Dojo
+# /v2/multiaddr calls (Dojo accepts pipe separated lists, see
+# https://github.com/Samourai-Wallet/samourai-dojo/blob/develop/doc/GET_multiaddr.md)
+# instead of one /v2/txs or /v2/xpub call for each address.
+#
+# Addresses set to OXT (check_method 2), and Dojo then OXT addresses
+# (check_method 3) that Dojo did not return, are checked one by one at
+# OXT - there's no batch endpoint there.
+#
+# Without a pause, batches and OXT checks run in parallel over isolated
+# Tor circuits (node/tor.py). With a pause (background watcher) they are
+# spread one at a time.
+#
+# All balances are updated in a single transaction and on_change (ex:
+# regenerate_nav) is called at most once, only if a balance changed.
+#
+# Usage:
+#     results = refresh_balances(current_user.username,
+#                                on_change=regenerate_nav)
+import logging
+import random
+import time
+from datetime import datetime
+
+import requests
+
+from thewarden import db
+from thewarden.models import AccountInfo, BitcoinAddresses
+from thewarden.node.dojo_token import INVALID_TOKEN, token_manager
+from thewarden.node.tor import transport
+from thewarden.node.utils import dojo_get_settings, oxt_get_address
+
+# Addresses (or xpubs) per multiaddr request - keeps the url short enough
+BATCH_SIZE = 100
+HD_PREFIXES = ("xpub", "ypub", "zpub")
+TIME_OUT = 60
+
+
+def is_hd(address):
+    return address.lower().startswith(HD_PREFIXES)
+
+
+def monitored(user_id, addresses=None):
+    # Returns {address: model} for the loose addresses and xpubs of a user
+    # Optionally only the ones in addresses - looked up in BATCH_SIZE
+    # chunks (SQLite allows at most 999 parameters per query)
+    if addresses is None:
+        chunks = [None]
+    else:
+        addresses = list(addresses)
+        chunks = [addresses[start:start + BATCH_SIZE]
+                  for start in range(0, len(addresses), BATCH_SIZE)]
+    found = {}
+    for chunk in chunks:
+        loose = BitcoinAddresses.query.filter_by(user_id=user_id)
+        accounts = AccountInfo.query.filter_by(user_id=user_id)
+        if chunk is not None:
+            loose = loose.filter(BitcoinAddresses.address_hash.in_(chunk))
+            accounts = accounts.filter(
+                AccountInfo.account_blockchain_id.in_(chunk))
+        found.update({item.address_hash: item for item in loose})
+        for account in accounts:
+            if account.account_blockchain_id and is_hd(
+                    account.account_blockchain_id):
+                found[account.account_blockchain_id] = account
+    return (found)
+
+
+def multiaddr_balances(addresses, onion_address, at):
+    # Returns ({address: balance in sats}, error) for one batch
+    url = "http://" + onion_address + "/v2/multiaddr"
+    try:
+        response = transport.get(url, params={"active": "|".join(addresses),
+                                              "at": at}, timeout=TIME_OUT)
+        data = response.json()
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout, ValueError) as e:
+        logging.error(f"[Monitor] Dojo multiaddr error: {e}")
+        return {}, f"Connection Error: {e}"
+    if "error" in data:
+        return {}, data["error"]
+    balances = {}
+    for item in data.get("addresses", []):
+        try:
+            balances[item["address"]] = float(item["final_balance"])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return balances, None
+
+
+def jitter(pause):
+    # Random wait between requests (up to pause seconds)
+    if pause:
+        time.sleep(random.uniform(0, pause))
+
+
+def each(func, items, pause=0):
+    # Results of func for each item. With a pause, requests are spread
+    # one at a time - otherwise they run in parallel over isolated Tor
+    # circuits (see node/tor.py)
+    if not pause:
+        return (transport.map(func, items))
+    results = []
+    for position, item in enumerate(items):
+        if position:
+            jitter(pause)
+        results.append(func(item))
+    return (results)
+
+
+def dojo_balances(addresses, pause=0):
+    # Balances for all addresses using as few requests as possible
+    settings = dojo_get_settings()
+    onion_address = settings.get("onion")
+    at = settings.get("token")
+    if not onion_address or not at or at == "error":
+        return {}, "Dojo not configured or token not available"
+    batches = [addresses[start:start + BATCH_SIZE]
+               for start in range(0, len(addresses), BATCH_SIZE)]
+
+    def fetch(batch):
+        found, error = multiaddr_balances(batch, onion_address, at)
+        if error == INVALID_TOKEN:
+            # Token expired or revoked - renew once and try again
+            token_manager.invalidate(at)
+            found, error = multiaddr_balances(batch, onion_address,
+                                              token_manager.token())
+        return found, error
+
+    balances = {}
+    errors = []
+    for found, error in each(fetch, batches, pause):
+        balances.update(found)
+        if error:
+            errors.append(error)
+    logging.info(f"[Monitor] Dojo returned {len(balances)} of " +
+                 f"{len(addresses)} balances in " +
+                 f"{-(-len(addresses) // BATCH_SIZE)} requests")
+    return balances, ("; ".join(errors) if errors else None)
+
+
+def oxt_balance(address):
+    oxt = oxt_get_address(address)
+    try:
+        return (float(oxt["data"][0]["stats"]["bl"]))
+    except (KeyError, TypeError, IndexError, ValueError):
+        return (None)
+
+
+def update_balance(item, balance, method):
+    # Store current check into previous fields to detect changes
+    # (an address never checked before had a balance of 0)
+    try:
+        previous_balance = float(item.last_balance or 0)
+    except ValueError:
+        previous_balance = 0.0
+    item.previous_check = item.last_check
+    item.previous_balance = previous_balance
+    item.last_check = datetime.now()
+    item.last_balance = balance
+    return {
+        "address_data": {
+            "previous_check": item.previous_check,
+            "previous_balance": previous_balance,
+            "last_check": item.last_check,
+            "last_balance": balance
+        },
+        "change": balance != previous_balance,
+        "success": True,
+        "method": method
+    }
+
+
+def refresh_balances(user_id, addresses=None, on_change=None, pause=0):
+    # Returns {address: result} where result has the same fields returned
+    # by /get_address (address_data, change, success, method) or
+    # {success: False, error: message}
+    # pause: maximum random wait (seconds) between requests
+    items = monitored(user_id, addresses)
+    results = {}
+    if addresses is not None:
+        for address in addresses:
+            if address not in items:
+                results[address] = {"success": False,
+                                    "error": "address not found"}
+
+    dojo_list = [address for address, item in items.items()
+                 if item.check_method in ("1", "3")]
+    balances, dojo_error = (dojo_balances(dojo_list, pause) if dojo_list
+                            else ({}, None))
+
+    # OXT for the ones Dojo did not return (check methods 2 and 3)
+    oxt_list = [address for address, item in items.items()
+                if address not in balances and
+                item.check_method in ("2", "3")]
+    oxt_balances = dict(zip(oxt_list, each(oxt_balance, oxt_list, pause)))
+
+    for address, item in items.items():
+        if address in balances:
+            results[address] = update_balance(item, balances[address],
+                                              "Dojo")
+            continue
+        if item.check_method in ("2", "3"):
+            balance = oxt_balances.get(address)
+            if balance is not None:
+                results[address] = update_balance(item, balance, "OXT")
+                continue
+            error = "OXT did not return a balance"
+        else:
+            error = dojo_error or "Dojo did not return a balance"
+        results[address] = {"success": False, "error": error}
+
+    db.session.commit()
+    changed = [address for address, result in results.items()
+               if result.get("change")]
+    if changed and on_change is not None:
+        on_change()
+    logging.info(f"[Monitor] Refreshed {len(items)} addresses for " +
+                 f"{user_id} - {len(changed)} changed")
+    return (results)
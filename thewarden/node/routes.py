@@ -52,7 +52,8 @@ def dojo_setup():
         api_keys_json['dojo']['api_key'] = form.dojo_apikey.data
         api_keys_json['dojo']['token'] = form.dojo_token.data
         api_keys_class.saver(api_keys_json)
-        at = dojo_auth()
+        # New settings - login again
+        at = dojo_auth(True)
     elif request.method == "GET":
         at = dojo_auth()
         api_keys_json = api_keys_class.loader()
@@ -63,7 +64,8 @@ def dojo_setup():
         except (KeyError, TypeError):
             form.dojo_token.data = "Error getting token"
 
-    last_block = tor_request("https://api.oxt.me/lastblock")
+    from thewarden.node.utils import OXT_URL
+    last_block = tor_request(OXT_URL + "/lastblock")
     if last_block == "ConnectionError":
         last_block = " - "
         progress = "unknown"
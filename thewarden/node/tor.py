@@ -0,0 +1,196 @@
+# Tor transport with isolated circuits
+# Tor builds a separate circuit for each SOCKS username/password pair
+# (IsolateSOCKSAuth - on by default). Requests are grouped by an
+# isolation key (the host name unless one is passed), and each key gets
+# its own pool of circuits, so requests to different providers are not
+# linkable to each other and parallel requests to the same host are
+# spread across several circuits instead of sharing the bandwidth of one.
+#
+# Each circuit keeps a moving average (EWMA) of its latency. Circuits
+# that are much slower than the others in the same pool, or that failed
+# several requests in a row, are retired - new credentials make Tor
+# build a new circuit.
+#
+# Requests to local hosts (a Dojo running on this machine or the
+# benchmark stand-ins) are sent directly.
+#
+# Set TOR_CIRCUITS at config.ini (circuits per isolation key).
+#
+# Usage:
+#     response = transport.get(url, timeout=15)
+#     responses = transport.map(lambda url: transport.get(url), urls)
+import configparser
+import logging
+import secrets
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+try:
+    TOR_CIRCUITS = int(config['MAIN']['TOR_CIRCUITS'])
+except (KeyError, ValueError):
+    TOR_CIRCUITS = 4
+    logging.info("Could not find TOR_CIRCUITS at config.ini." +
+                 " Defaulting to 4 circuits.")
+
+TOR_PROXY = "127.0.0.1:9150"
+# Hosts reached without Tor (local Dojo or test servers)
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+# Weight of the latest request at the latency average
+EWMA_ALPHA = 0.3
+# Requests before a circuit can be compared with the others
+MIN_SAMPLES = 3
+# Circuits slower than SLOW_FACTOR x the median of the pool are retired
+SLOW_FACTOR = 3
+# Consecutive failures before a circuit is retired
+MAX_FAILURES = 3
+
+
+def is_local(url):
+    return (urlparse(url).hostname in LOCAL_HOSTS)
+
+
+class Circuit():
+    def __init__(self, key, proxy):
+        self.key = key
+        # Random credentials - Tor opens a new circuit for these
+        credentials = f"{secrets.token_hex(8)}:{secrets.token_hex(8)}"
+        self.session = requests.session()
+        self.session.proxies = {
+            "http": f"socks5h://{credentials}@{proxy}",
+            "https": f"socks5h://{credentials}@{proxy}",
+        }
+        self.id = credentials[:8]
+        self.latency = None
+        self.samples = 0
+        self.requests = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.created = time.time()
+
+    def record(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = (EWMA_ALPHA * seconds +
+                            (1 - EWMA_ALPHA) * self.latency)
+        self.samples += 1
+
+    def status(self):
+        return {
+            "id": self.id,
+            "latency": self.latency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "age": time.time() - self.created
+        }
+
+
+class TorTransport():
+    def __init__(self, circuits=TOR_CIRCUITS, proxy=TOR_PROXY):
+        self.circuits = max(circuits, 1)
+        self.proxy = proxy
+        self.pools = {}
+        self.retired = 0
+        self.direct = requests.session()
+        self._lock = threading.Lock()
+
+    def _pool(self, key):
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = [Circuit(key, self.proxy) for _ in range(self.circuits)]
+            self.pools[key] = pool
+        return (pool)
+
+    def acquire(self, key):
+        # Least busy circuit - the fastest one if there's a tie
+        with self._lock:
+            circuit = min(self._pool(key),
+                          key=lambda c: (c.in_flight, c.latency or 0))
+            circuit.in_flight += 1
+            circuit.requests += 1
+        return (circuit)
+
+    def release(self, circuit, seconds=None):
+        # seconds=None when the request failed
+        with self._lock:
+            circuit.in_flight -= 1
+            if seconds is None:
+                circuit.failures += 1
+            else:
+                circuit.failures = 0
+                circuit.record(seconds)
+            if self._slow(circuit) or circuit.failures >= MAX_FAILURES:
+                self._retire(circuit)
+
+    def _slow(self, circuit):
+        if circuit.samples < MIN_SAMPLES:
+            return (False)
+        peers = [c.latency for c in self.pools.get(circuit.key, [])
+                 if c is not circuit and c.samples >= MIN_SAMPLES]
+        if not peers:
+            return (False)
+        return (circuit.latency > SLOW_FACTOR * statistics.median(peers))
+
+    def _retire(self, circuit):
+        pool = self.pools.get(circuit.key, [])
+        if circuit not in pool:
+            return
+        logging.info(f"[Tor] Retiring circuit {circuit.id} for " +
+                     f"{circuit.key} (latency {circuit.latency}, " +
+                     f"failures {circuit.failures})")
+        pool[pool.index(circuit)] = Circuit(circuit.key, self.proxy)
+        self.retired += 1
+        # Requests still in flight keep their connection until they finish
+        circuit.session.close()
+
+    def request(self, method, url, isolation=None, **kwargs):
+        # Same arguments and exceptions as requests.request
+        # isolation: requests with the same key share circuits
+        if is_local(url):
+            return (self.direct.request(method, url, **kwargs))
+        circuit = self.acquire(isolation or urlparse(url).hostname)
+        start = time.perf_counter()
+        try:
+            response = circuit.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.release(circuit)
+            raise
+        self.release(circuit, time.perf_counter() - start)
+        return (response)
+
+    def get(self, url, **kwargs):
+        return (self.request("get", url, **kwargs))
+
+    def post(self, url, data=None, **kwargs):
+        return (self.request("post", url, data=data, **kwargs))
+
+    def map(self, func, items, workers=None):
+        # Runs func for each item in parallel (one worker per circuit)
+        # Returns the results in the same order. func should handle its
+        # own request errors.
+        items = list(items)
+        if len(items) <= 1:
+            return ([func(item) for item in items])
+        workers = min(workers or self.circuits, len(items))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return (list(executor.map(func, items)))
+
+    def status(self):
+        with self._lock:
+            return {
+                "circuits_per_key": self.circuits,
+                "retired": self.retired,
+                "pools": {key: [c.status() for c in pool]
+                          for key, pool in self.pools.items()}
+            }
+
+
+transport = TorTransport()
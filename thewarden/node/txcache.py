@@ -0,0 +1,168 @@
+# Incremental transaction sync for monitored addresses and xpubs
+# Transactions downloaded from Dojo (/v2/txs) are stored at the
+# BitcoinTransactions table (one row per address and txid). A cursor
+# (AddressSyncCursor) keeps the highest block height already stored, so a
+# new sync pages through /v2/txs (newest first) only until it reaches
+# transactions older than the cursor.
+#
+# Unconfirmed transactions are stored without block height and replaced
+# on every sync (they either confirm at a height above the cursor or are
+# dropped).
+#
+# Tables are created on first use. Syncs use a session of their own so
+# they never commit or roll back the caller's work at db.session.
+#
+# Usage:
+#     added, error = sync_transactions(address)
+#     view = transactions_view(address)
+import logging
+from datetime import datetime
+
+import requests
+
+from thewarden import db
+from thewarden.models import AddressSyncCursor, BitcoinTransactions
+from thewarden.node.tor import transport
+
+# Transactions per page (Dojo maximum is 100)
+PAGE_SIZE = 100
+# Safety limit - 100k transactions
+MAX_PAGES = 1000
+TIME_OUT = 60
+
+_tables_ready = False
+
+
+def ensure_tables():
+    global _tables_ready
+    if not _tables_ready:
+        db.metadata.create_all(db.engine,
+                               tables=[BitcoinTransactions.__table__,
+                                       AddressSyncCursor.__table__])
+        _tables_ready = True
+
+
+def fetch_page(address, page, onion_address, at):
+    # Returns (data, error) for one page of /v2/txs
+    url = "http://" + onion_address + "/v2/txs"
+    try:
+        response = transport.get(url, params={"active": address,
+                                              "page": page,
+                                              "count": PAGE_SIZE, "at": at},
+                                 timeout=TIME_OUT)
+        data = response.json()
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.ReadTimeout, ValueError) as e:
+        logging.error(f"[TxCache] Error getting txs for {address}: {e}")
+        return None, f"Connection Error: {e}"
+    if "error" in data:
+        return None, data["error"]
+    return data, None
+
+
+def sync_transactions(address, at=None):
+    # Downloads only the transactions not yet stored for this address
+    # Returns (number of transactions stored, error message or None)
+    from thewarden.node.utils import dojo_get_settings
+    ensure_tables()
+    settings = dojo_get_settings()
+    onion_address = settings.get("onion")
+    if at is None:
+        at = settings.get("token")
+    if not onion_address or not at or at == "error":
+        return 0, "Dojo not configured or token not available"
+
+    # Separate session - closing it discards anything not committed
+    session = db.create_session({})()
+    try:
+        return (_sync(session, address, onion_address, at))
+    finally:
+        session.close()
+
+
+def _sync(session, address, onion_address, at):
+    # Pages through /v2/txs and commits the new rows and cursor at session
+    from thewarden.node.dojo_token import INVALID_TOKEN, token_manager
+    cursor = session.query(AddressSyncCursor).get(address)
+    if cursor is None:
+        cursor = AddressSyncCursor(address=address, block_height=0, n_tx=0)
+        session.add(cursor)
+    start_height = cursor.block_height or 0
+    # Confirmed transactions already stored (unconfirmed are replaced)
+    known = set(txid for (txid,) in session.query(
+        BitcoinTransactions.txid).filter(
+            BitcoinTransactions.address == address,
+            BitcoinTransactions.block_height.isnot(None)))
+
+    new_rows = {}
+    max_height = start_height
+    n_tx = cursor.n_tx
+    for page in range(MAX_PAGES):
+        data, error = fetch_page(address, page, onion_address, at)
+        if error == INVALID_TOKEN:
+            # Token expired or revoked - renew once and try again
+            token_manager.invalidate(at)
+            at = token_manager.token()
+            data, error = fetch_page(address, page, onion_address, at)
+        if error:
+            # Nothing is stored - next sync starts from the same cursor
+            session.rollback()
+            return 0, error
+        n_tx = data.get("n_tx", n_tx)
+        txs = data.get("txs", [])
+        reached_cursor = False
+        for tx in txs:
+            height = tx.get("block_height")
+            if height is not None and height < start_height:
+                reached_cursor = True
+                break
+            if height is not None and tx["hash"] in known:
+                continue
+            new_rows[tx["hash"]] = BitcoinTransactions(
+                address=address, txid=tx["hash"], time=tx.get("time"),
+                result=tx.get("result"), block_height=height)
+            if height is not None:
+                max_height = max(max_height, height)
+        if reached_cursor or len(txs) < PAGE_SIZE:
+            break
+
+    session.query(BitcoinTransactions).filter_by(
+        address=address, block_height=None).delete()
+    session.add_all(new_rows.values())
+    cursor.block_height = max_height
+    cursor.n_tx = n_tx
+    cursor.last_sync = datetime.now()
+    session.commit()
+    logging.info(f"[TxCache] {address}: {len(new_rows)} new transactions " +
+                 f"({page + 1} pages, cursor at block {max_height})")
+    return len(new_rows), None
+
+
+def cached_transactions(address):
+    # Columns of the stored transactions (newest first)
+    ensure_tables()
+    rows = BitcoinTransactions.query.filter_by(address=address).order_by(
+        BitcoinTransactions.time.desc())
+    transactions = {"time": [], "result": [], "hash": [], "block": []}
+    for row in rows:
+        transactions["time"].append(row.time)
+        transactions["result"].append(row.result)
+        transactions["hash"].append(row.txid)
+        transactions["block"].append(row.block_height)
+    return (transactions)
+
+
+def transactions_view(address, at=None):
+    # Syncs and returns the stored transactions:
+    # {n_tx, address, transactions: {time, result, hash, block}, balance,
+    #  error}
+    __, error = sync_transactions(address, at)
+    transactions = cached_transactions(address)
+    return {
+        "n_tx": len(transactions["hash"]),
+        "address": address,
+        "transactions": transactions,
+        "balance": float(sum(result or 0
+                             for result in transactions["result"])),
+        "error": error or ""
+    }
@@ -1,94 +1,88 @@
 import logging
+from urllib.parse import urlparse
 
-import pandas as pd
 import requests
 from flask import Markup, current_app, flash
 from flask_login import current_user
 
 from thewarden.models import User
+from thewarden.node.dojo_token import token_manager
+from thewarden.node.http_cache import cache as http_cache
+from thewarden.node.tor import transport
 from thewarden.users.decorators import MWT, memoized
+from thewarden.users.metrics import span
+
+# OXT api (the benchmarks point this to a local stand-in)
+OXT_URL = "https://api.oxt.me"
 
 
-@MWT(1)
-# Requests within 30sec of each other will return the same result
-# This is an optimization variable, too short and the app will run
-# slow, too high and the data refresh will suffer.
-# Default=20
 def tor_request(url, tor_only=False, method="get"):
     # Tor requests takes arguments:
     # url:       url to get or post
     # tor_only:  request will only be executed if tor is available
     # method:    'get or' 'post'
+    # GET responses of provider endpoints are kept at the http cache
+    # (node/http_cache.py) - errors are never cached
     from thewarden import TOR
 
-    logging.info(f"Starting request for url: {url}")
-    tor_check = TOR
-    if tor_check["status"] is True:
-        try:
-            # Activate TOR proxies
-            session = requests.session()
-            session.proxies = {
-                "http": "socks5h://127.0.0.1:9150",
-                "https": "socks5h://127.0.0.1:9150",
-            }
-            if method == "get":
-                request = session.get(url, timeout=15)
-            if method == "post":
-                request = session.post(url, timeout=15)
-
-        except (
-                requests.exceptions.ConnectionError,
-                requests.exceptions.ReadTimeout,
-        ) as e:
-            logging.error(f"Connection Error on tor request: {e}")
-            return "ConnectionError"
-    else:
-        if tor_only:
-            return "Tor not available"
-        try:
-            if method == "get":
-                request = requests.get(url, timeout=10)
-            if method == "post":
-                request = requests.post(url, timeout=10)
-
-        except requests.exceptions.ConnectionError:
-            logging.error("Connection Error on tor request")
-            return "ConnectionError"
-
-    logging.info("Tor Request: Success")
-    return request
+    headers = {}
+    if method == "get":
+        cached = http_cache.fresh(url)
+        if cached is not None:
+            logging.info(f"Cached response for url: {url}")
+            return cached
+        headers = http_cache.conditional_headers(url)
+
+    # Each request is recorded as an http span (see users/metrics.py)
+    with span(urlparse(url).netloc, 'http', method=method) as http_span:
+        logging.info(f"Starting request for url: {url}")
+        tor_check = TOR
+        if tor_check["status"] is True:
+            try:
+                # Isolated circuits for each host (see node/tor.py)
+                request = transport.request(method, url, timeout=15,
+                                            headers=headers)
+
+            except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ReadTimeout,
+            ) as e:
+                logging.error(f"Connection Error on tor request: {e}")
+                http_span.error = "ConnectionError"
+                return "ConnectionError"
+        else:
+            if tor_only:
+                http_span.error = "Tor not available"
+                return "Tor not available"
+            try:
+                if method == "get":
+                    request = requests.get(url, timeout=10, headers=headers)
+                if method == "post":
+                    request = requests.post(url, timeout=10)
+
+            except requests.exceptions.ConnectionError:
+                logging.error("Connection Error on tor request")
+                http_span.error = "ConnectionError"
+                return "ConnectionError"
+
+        logging.info("Tor Request: Success")
+        http_span.attrs['status'] = request.status_code
+        if method == "get":
+            request = http_cache.store(url, request)
+        return request
 
 
-@MWT(10)
 def dojo_get_settings(force=False):
-    # Get and test settings. If not working get a new at
-    logging.info("Getting Dojo settings")
-    # check if dojo_settings are already stored
-    from thewarden.pricing_engine.pricing import api_keys_class
-    api_keys_json = api_keys_class.loader()
-    onion_address = api_keys_json['dojo']['onion']
-    api_key = api_keys_json['dojo']['api_key']
-    at = dojo_auth()
-    try:
-        logging.info("Trying to get token")
-        logging.info(f"Received back from auth: {at}")
-        token = at["authorizations"]["access_token"]
-        api_keys_json['dojo']['token'] = token
-        api_keys_class.saver(api_keys_json)
-    except (KeyError, TypeError) as e:
-        logging.warn(f"Unable to get Dojo Token: {e}")
-        logging.warn(f"Received back from auth: {at}, setting token to error.")
-        token = "error"
-        api_keys_json['dojo']['token'] = token
-        api_keys_class.saver(api_keys_json)
-        logging.error(f"Error while getting token.")
-
-    logging.info(f"Current token: {token}")
-
-    return (api_keys_json['dojo'])
+    # Returns the Dojo settings (onion, api_key, token) with a valid token
+    # Tokens are kept and renewed by the token manager (node/dojo_token.py)
+    # so this does not login or write to disk on every call
+    settings = dict(token_manager.settings()['dojo'])
+    settings['token'] = token_manager.token(force)
+    if settings['token'] == "error":
+        logging.warning("Unable to get Dojo Token, setting token to error.")
+    return (settings)
 
 
-@memoized
 def dojo_auth(force=False):
     # Receives authentication token back from Dojo
     # https://github.com/Samourai-Wallet/samourai-dojo/blob/develop/doc/POST_auth_login.md
@@ -107,49 +101,9 @@ def dojo_auth(force=False):
     #   "status": "error",                      "status": "error",
     #   "error": "Invalid API key"              "error": "Connection Error"
     # }                                     }
-    # SET Default timeout to get a token. Too low timeouts could be a problem
-
-    TIME_OUT = 20
+    # force=True skips the current token and asks Dojo for a new one
     logging.info("Starting DOJO Auth")
-    # Check if variables are saved
-    from thewarden.pricing_engine.pricing import api_keys_class
-    api_keys_json = api_keys_class.loader()
-    onion_address = api_keys_json['dojo']['onion']
-    APIKey = api_keys_json['dojo']['api_key']
-    token = api_keys_json['dojo']['token']
-    if (onion_address is None) or (APIKey is None):
-        logging.info("DOJO Auth: No Onion Address or API Key")
-        auth_response = {"status": "error", "error": "missing config"}
-        try:
-            api_keys_json['dojo']['token'] = 'error'
-        except TypeError:
-            logging.info("Dojo_AUTH: Dojo Settings not found at database")
-        return auth_response
-
-    # Try to get the token
-    url = "http://" + onion_address + "/v2/auth/login"
-    session = requests.session()
-    session.proxies = {
-        "http": "socks5h://127.0.0.1:9150",
-        "https": "socks5h://127.0.0.1:9150",
-    }
-    post_fields = {"apikey": APIKey}
-    try:
-        logging.info("DOJO AUTH: Trying to get authorization")
-        auth_response = session.post(url, post_fields, timeout=TIME_OUT).json()
-        token = auth_response['authorizations']['access_token']
-    except (requests.exceptions.ConnectionError,
-            requests.exceptions.InvalidURL, KeyError,
-            requests.exceptions.ReadTimeout, requests.exceptions.InvalidSchema,
-            UnicodeError, requests.exceptions.InvalidSchema) as e:
-        logging.info(f"DOJO AUTH: Error: {e}")
-        auth_response = {"status": "error", "error": f"Error: {e}"}
-        token = 'error'
-    # Store for this session in Global Variable
-    api_keys_json['dojo']['token'] = token
-    api_keys_class.saver(api_keys_json)
-    logging.info(f"DOJO Settings updated")
-    return (auth_response)
+    return (token_manager.auth(force))
 
 
 @MWT(20)
@@ -163,13 +117,8 @@ def dojo_get_address(addr, at):
 
     url = "http://" + onion_address + "/v2/address/" + addr + "/info?at=" + at
 
-    session = requests.session()
-    session.proxies = {
-        "http": "socks5h://127.0.0.1:9150",
-        "https": "socks5h://127.0.0.1:9150",
-    }
     try:
-        auth_response = session.get(url)
+        auth_response = transport.get(url)
     except requests.exceptions.ConnectionError:
         auth_response = {"status": "error", "error": "Connection Error"}
     return auth_response
@@ -200,14 +149,9 @@ def dojo_multiaddr(addr, type, at):
         return auth_response
     url = "http://" + onion_address + "/v2/multiaddr"
     url = url + "?" + type + "=" + addr + "&at=" + at
-    session = requests.session()
-    session.proxies = {
-        "http": "socks5h://127.0.0.1:9150",
-        "https": "socks5h://127.0.0.1:9150",
-    }
     try:
         logging.info("Sending GET request [Tor]")
-        auth_response = session.get(url)
+        auth_response = transport.get(url)
         logging.info("GET request success")
     except requests.exceptions.ConnectionError:
         logging.warn("Connection Error")
@@ -222,13 +166,8 @@ def dojo_add_hd(xpub, type, at):
     onion_address = dojo_get_settings()["onion"]
     url = "http://" + onion_address + "/v2/xpub"
     post_fields = {"xpub": xpub, "type": type, "at": at, "force": "true"}
-    session = requests.session()
-    session.proxies = {
-        "http": "socks5h://127.0.0.1:9150",
-        "https": "socks5h://127.0.0.1:9150",
-    }
     try:
-        auth_response = session.post(url, post_fields)
+        auth_response = transport.post(url, post_fields)
     except requests.exceptions.ConnectionError:
         auth_response = {"status": "error", "error": "Connection Error"}
     return auth_response
@@ -240,14 +179,9 @@ def dojo_get_hd(xpub, at):
     # https://github.com/Samourai-Wallet/samourai-dojo/blob/master/doc/GET_xpub.md
     onion_address = dojo_get_settings()["onion"]
     url = "http://" + onion_address + "/v2/xpub/"
-    session = requests.session()
-    session.proxies = {
-        "http": "socks5h://127.0.0.1:9150",
-        "https": "socks5h://127.0.0.1:9150",
-    }
     try:
         url = url + xpub + "?at=" + at
-        auth_response = session.get(url)
+        auth_response = transport.get(url)
     except requests.exceptions.ConnectionError:
         auth_response = {"status": "error", "error": "Connection Error"}
     return auth_response
@@ -255,67 +189,30 @@ def dojo_get_hd(xpub, at):
 
 @MWT(20)
 def dojo_get_txs(addr, at):
-    # Request transactions of an active address and return a dataframe + metadata
-    onion_address = dojo_get_settings()["onion"]
-    url = "http://" + onion_address + "/v2/txs?active="
-    session = requests.session()
-    session.proxies = {
-        "http": "socks5h://127.0.0.1:9150",
-        "https": "socks5h://127.0.0.1:9150",
-    }
-    try:
-        url = url + addr + "&count=500&at=" + at
-        auth_response = session.get(url)
-        auth_response = auth_response.json()
-        meta = {}
-        meta["n_tx"] = auth_response["n_tx"]
-        meta["address"] = addr
-        txs = auth_response["txs"]
-        # Create dataframe
-        df_dict = pd.DataFrame.from_dict(txs)
-        # Now construct the tx table in a pandas df
-        tmp_list = []
-        for __, row in df_dict.iterrows():
-            tmp_list.append(
-                [row["time"], row["result"], row["hash"], row["block_height"]])
-
-        df = pd.DataFrame(tmp_list,
-                          columns=["time", "result", "hash", "block"])
-        if not df.empty:
-            meta["transactions"] = df.to_dict()
-            meta["balance"] = df["result"].sum().astype(float)
-        else:
-            meta["transactions"] = ""
-            meta["balance"] = ""
-        meta["raw"] = txs
-        return meta
-
-    except requests.exceptions.ConnectionError:
-        auth_response = {"status": "error", "error": "Connection Error"}
-        return auth_response
-
-    except KeyError:
-        if "error" in auth_response:
-            # If Token error, force a new token
-            if auth_response["error"] == "Invalid JSON Web Token":
-                at = dojo_auth(True)
-        return auth_response
+    # Request transactions of an active address and return metadata
+    # Transactions are synced incrementally into the local cache and
+    # returned from there (see node/txcache.py):
+    # {n_tx, address, transactions: {time, result, hash, block}, balance}
+    from thewarden.node.txcache import transactions_view
+    meta = transactions_view(addr, at)
+    if meta["error"] and meta["n_tx"] == 0:
+        return {"status": "error", "error": meta["error"]}
+    return meta
 
 
 @MWT(20)
 def oxt_get_address(addr):
     # Requests via TOR address details from OXT
-    url = "https://api.oxt.me/addresses/"
-    session = requests.session()
-    session.proxies = {
-        "http": "socks5h://127.0.0.1:9150",
-        "https": "socks5h://127.0.0.1:9150",
-    }
+    url = OXT_URL + "/addresses/"
     try:
         url = url + addr
-        auth_response = session.get(url).json()
-    except requests.exceptions.ConnectionError:
+        auth_response = transport.get(url, timeout=15).json()
+    except requests.exceptions.RequestException as e:
+        logging.info(f"[OXT] Error getting {addr}: {e}")
         auth_response = {"status": "error", "error": "Connection Error"}
+    except ValueError:
+        # Not a json response (i.e. an html error page)
+        auth_response = {"status": "error", "error": "Invalid response"}
     return auth_response
 
 
@@ -334,13 +231,8 @@ def dojo_status(token_test=None):
         token = token_test
 
     url = "http://" + onion_address + "/v2/status?at=" + token
-    session = requests.session()
-    session.proxies = {
-        "http": "socks5h://127.0.0.1:9150",
-        "https": "socks5h://127.0.0.1:9150",
-    }
     try:
-        auth_response = session.get(url)
+        auth_response = transport.get(url)
     except (
             requests.exceptions.ConnectionError,
             requests.exceptions.InvalidURL,
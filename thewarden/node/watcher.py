@@ -0,0 +1,177 @@
+# Background balance watcher
+# Refreshes every address and xpub with auto_check set, for all users,
+# without a browser tab open. Uses the batch engine at node/monitor.py
+# (batched Dojo multiaddr calls, OXT one at a time), so previous_balance /
+# last_balance are kept the same way as the manual checks.
+#
+# Runs are spread to avoid bursts of Tor requests:
+#   - the time between runs is WATCHER_INTERVAL minutes +/- JITTER
+#   - users are checked one after the other with a random pause between
+#     them and between requests (REQUEST_PAUSE)
+#
+# Each balance change generates an event. Events are kept in a ring
+# buffer (recent_events) and sent to subscribers:
+#     watcher.subscribe(lambda event: print(event))
+#
+# Set WATCHER_INTERVAL = 0 at config.ini to disable.
+import configparser
+import logging
+import os
+import random
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from thewarden.config import Config
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+try:
+    WATCHER_INTERVAL = int(config['MAIN']['WATCHER_INTERVAL'])
+except (KeyError, ValueError):
+    WATCHER_INTERVAL = 60
+    logging.info("Could not find WATCHER_INTERVAL at config.ini." +
+                 " Defaulting to 60 minutes.")
+
+# Fraction of the interval used as random jitter (0.2 = +/- 20%)
+JITTER = 0.2
+# Seconds before the first run (also jittered)
+STARTUP_DELAY = 120
+# Maximum random pause (seconds) between users and between requests
+REQUEST_PAUSE = 5
+MAX_EVENTS = 500
+
+
+class BalanceWatcher():
+    def __init__(self, app, interval=WATCHER_INTERVAL):
+        self.app = app
+        self.interval = interval * 60
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.subscribers = []
+        self.last_run = None
+        self.next_run = None
+        self.last_error = None
+        self.checked = 0
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _delay(self, seconds):
+        return seconds * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                         name="balance watcher")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        delay = self._delay(STARTUP_DELAY)
+        while True:
+            self.next_run = datetime.now() + timedelta(seconds=delay)
+            if self._stop.wait(delay):
+                return
+            try:
+                with self.app.app_context():
+                    self.run_once()
+            except Exception as e:
+                # Keep the thread alive - next run will try again
+                self.last_error = str(e)
+                logging.error(f"[Watcher] Error while checking balances: {e}")
+            delay = self._delay(self.interval)
+
+    def watched(self):
+        # {user_id: [addresses and xpubs with auto_check]}
+        from thewarden.models import AccountInfo, BitcoinAddresses
+        users = {}
+        for item in BitcoinAddresses.query.filter_by(auto_check=True):
+            users.setdefault(item.user_id, []).append(item.address_hash)
+        for account in AccountInfo.query.filter_by(auto_check=True):
+            if account.account_blockchain_id:
+                users.setdefault(account.user_id, []).append(
+                    account.account_blockchain_id)
+        return (users)
+
+    def run_once(self):
+        from thewarden.node.monitor import jitter, refresh_balances
+        users = self.watched()
+        checked = 0
+        for position, (user_id, addresses) in enumerate(users.items()):
+            if position:
+                jitter(REQUEST_PAUSE)
+            results = refresh_balances(user_id, addresses,
+                                       pause=REQUEST_PAUSE)
+            checked += len(results)
+            for address, result in results.items():
+                if result.get("change"):
+                    self.emit({
+                        "time": datetime.now(),
+                        "user_id": user_id,
+                        "address": address,
+                        "previous_balance":
+                            result["address_data"]["previous_balance"],
+                        "last_balance":
+                            result["address_data"]["last_balance"],
+                        "method": result["method"]
+                    })
+        self.checked = checked
+        self.last_run = datetime.now()
+        self.last_error = None
+        logging.info(f"[Watcher] Checked {checked} addresses for " +
+                     f"{len(users)} users")
+
+    def subscribe(self, callback):
+        with self._lock:
+            self.subscribers.append(callback)
+
+    def emit(self, event):
+        logging.info(f"[Watcher] Balance change at {event['address']}: " +
+                     f"{event['previous_balance']} -> " +
+                     f"{event['last_balance']}")
+        with self._lock:
+            self.events.append(event)
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                logging.error(f"[Watcher] Subscriber error: {e}")
+
+    def recent_events(self, user_id=None):
+        with self._lock:
+            events = list(self.events)
+        if user_id is not None:
+            events = [event for event in events
+                      if event["user_id"] == user_id]
+        return (list(reversed(events)))
+
+    def status(self):
+        return {
+            "enabled": self._thread is not None,
+            "interval_minutes": self.interval / 60,
+            "last_run": self.last_run,
+            "next_run": self.next_run,
+            "checked": self.checked,
+            "last_error": self.last_error
+        }
+
+
+watcher = None
+
+
+def init_app(app):
+    global watcher
+    watcher = BalanceWatcher(app)
+    if WATCHER_INTERVAL <= 0:
+        logging.info("[Watcher] Disabled at config.ini")
+        return
+    # With the Flask reloader (developer mode) only the child process
+    # runs the watcher
+    if (Config.WARDEN_STATUS == "developer" and
+            os.environ.get("WERKZEUG_RUN_MAIN") != "true"):
+        return
+    watcher.start()
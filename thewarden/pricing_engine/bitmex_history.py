@@ -0,0 +1,167 @@
+# Bitmex history
+# Paginated downloads from the Bitmex API (uses the bitmex library):
+#   . daily price bins (Trade_getBucketed) for PriceData
+#   . execution history (Execution_getTradeHistory) for the importer
+#
+# Both resume from the last stored timestamp, so only new rows are
+# requested, and pages are collected into a list and concatenated once.
+#
+# Requests go through the rate limit governor (bucket 'bitmex'). Bitmex
+# rate limit headers are respected: when x-ratelimit-remaining gets low
+# the bucket is paused until x-ratelimit-reset, and a 429 pauses it for
+# Retry-After seconds before the page is requested again.
+#
+# Usage:
+#     df = price_history('XBTUSD', credentials, existing=df)
+#     df = execution_history(api_key, api_secret, testnet=False)
+import hashlib
+import logging
+import os
+import pickle
+import time
+from datetime import timedelta
+
+import pandas as pd
+
+from thewarden.pricing_engine.rate_limiter import (THROTTLE_PAUSE, bucket_for,
+                                                   current_priority, ledger)
+
+# Rows per request (Bitmex maximum is 1000)
+PAGE_SIZE = 500
+# Safety limit - 500k rows
+MAX_PAGES = 1000
+# Pause the bucket when this number of requests is left in the window
+RATE_LIMIT_RESERVE = 2
+MAX_RETRIES = 3
+PRICE_COLUMNS = ['close', 'open', 'high', 'low', 'volume', 'vwap']
+EXECUTIONS_FOLDER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'pricing_data')
+
+
+def client(api_key, api_secret, testnet=False):
+    from bitmex import bitmex
+    return (bitmex(test=testnet, api_key=api_key, api_secret=api_secret))
+
+
+def respect_headers(bucket, headers):
+    # Pauses the bucket when the Bitmex window is almost used
+    try:
+        remaining = int(headers.get('x-ratelimit-remaining'))
+        reset = float(headers.get('x-ratelimit-reset'))
+    except (TypeError, ValueError):
+        return
+    if remaining <= RATE_LIMIT_RESERVE:
+        wait = max(reset - time.time(), 1)
+        logging.info(f"[Bitmex] {remaining} requests left - pausing " +
+                     f"for {wait:.0f}s")
+        bucket.pause(wait)
+
+
+def retry_after(error):
+    # Seconds to wait if this error is a throttle response (HTTP 429)
+    response = getattr(error, 'response', None)
+    if getattr(error, 'status_code', None) != 429 and getattr(
+            response, 'status_code', None) != 429:
+        return (None)
+    try:
+        return (float(response.headers.get('Retry-After', THROTTLE_PAUSE)))
+    except (AttributeError, TypeError, ValueError):
+        return (THROTTLE_PAUSE)
+
+
+def request_page(operation, **kwargs):
+    # One page of results. Raises the last error when it fails.
+    bucket = bucket_for('bitmex')
+    for attempt in range(MAX_RETRIES + 1):
+        if not bucket.acquire(current_priority()):
+            ledger.record(bucket.name, 'skipped')
+            raise TimeoutError("Throttled waiting for the Bitmex quota")
+        ledger.record(bucket.name, 'requests')
+        try:
+            rows, response = operation(**kwargs).result()
+        except Exception as e:
+            wait = retry_after(e)
+            if wait is None or attempt == MAX_RETRIES:
+                raise
+            logging.warning(f"[Bitmex] Throttled - retrying in {wait}s")
+            ledger.record(bucket.name, 'throttled')
+            bucket.pause(wait)
+            continue
+        respect_headers(bucket, getattr(response, 'headers', {}) or {})
+        return (rows)
+
+
+def fetch_all(operation, **kwargs):
+    # All pages from kwargs['startTime'] (oldest first)
+    pages = []
+    for page in range(MAX_PAGES):
+        rows = request_page(operation, count=PAGE_SIZE,
+                            start=page * PAGE_SIZE, reverse=False, **kwargs)
+        pages.append(rows)
+        if len(rows) < PAGE_SIZE:
+            break
+    else:
+        logging.error("[Bitmex] Page limit reached. Stopped download.")
+    return ([row for rows in pages for row in rows])
+
+
+def price_history(ticker, credentials, existing=None):
+    # Daily bins as a df (date index, PRICE_COLUMNS) - only bins after
+    # the last date in existing are downloaded
+    mex = client(credentials['api_key'], credentials['api_secret'],
+                 credentials.get('testnet', False))
+    kwargs = {'symbol': ticker, 'binSize': '1d'}
+    if existing is not None and not existing.empty:
+        kwargs['startTime'] = existing.index.max() + timedelta(days=1)
+    rows = fetch_all(mex.Trade.Trade_getBucketed, **kwargs)
+    logging.info(f"[Bitmex] Downloaded {len(rows)} new bins for {ticker}")
+    if not rows:
+        return (existing)
+    df = pd.DataFrame(rows).rename(columns={'timestamp': 'date'})
+    df = df.set_index('date')[PRICE_COLUMNS]
+    if existing is not None and not existing.empty:
+        df = pd.concat([existing[PRICE_COLUMNS], df], sort=False)
+        df = df[~df.index.duplicated(keep='last')]
+    return (df)
+
+
+def executions_filename(api_key, testnet):
+    # Saved under a hash of the api key
+    key_hash = hashlib.sha256(f"{api_key}{testnet}".encode(
+        'utf-8')).hexdigest()[:16]
+    return (os.path.join(EXECUTIONS_FOLDER,
+                         f"bitmex_executions_{key_hash}.pkl"))
+
+
+def execution_history(api_key, api_secret, testnet=False, full=False):
+    # All executions (newest first). Stored executions are kept and only
+    # the newer ones are requested, unless full=True.
+    filename = executions_filename(api_key, testnet)
+    existing = None
+    if not full:
+        try:
+            existing = pd.read_pickle(filename)
+        except (FileNotFoundError, ValueError, EOFError,
+                pickle.UnpicklingError) as e:
+            # Missing or corrupt file - full download (replaces the file)
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(f"[Bitmex] Could not read {filename}: {e}")
+            existing = None
+    kwargs = {}
+    if existing is not None and not existing.empty:
+        # Same timestamp may have more executions - duplicates are removed
+        kwargs['startTime'] = existing['timestamp'].max()
+    mex = client(api_key, api_secret, testnet)
+    rows = fetch_all(mex.Execution.Execution_getTradeHistory, **kwargs)
+    logging.info(f"[Bitmex] Downloaded {len(rows)} executions")
+    df = pd.DataFrame(rows)
+    if existing is not None and not existing.empty:
+        df = pd.concat([existing, df], sort=False, ignore_index=True)
+    if df.empty:
+        return (df)
+    df = df.drop_duplicates(subset='execID', keep='last')
+    df = df.sort_values('timestamp', ascending=False).reset_index(drop=True)
+    os.makedirs(EXECUTIONS_FOLDER, exist_ok=True)
+    df.to_pickle(filename + ".tmp")
+    os.replace(filename + ".tmp", filename)
+    return (df)
@@ -0,0 +1,95 @@
+# Negative result cache for tickers that no provider can price
+# When every provider in the historical priority list answers that it does
+# not know the ticker (delisted coins, custom tickers, typos from a CSV
+# import) the ticker is stored here with the failure reason for each
+# provider. Until the entry expires, price requests for that ticker return
+# immediately instead of walking the full provider list again.
+# The TTL (in minutes) is set in config.ini as NEGATIVE_CACHE_TTL.
+import configparser
+import json
+import logging
+import os
+import threading
+import time
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+try:
+    NEGATIVE_CACHE_TTL = int(config['MAIN']['NEGATIVE_CACHE_TTL'])
+except (KeyError, ValueError):
+    NEGATIVE_CACHE_TTL = 360
+    logging.info("Could not find NEGATIVE_CACHE_TTL at config.ini." +
+                 " Defaulting to 360 minutes.")
+
+
+class NegativeCache():
+    def __init__(self, filename, ttl=NEGATIVE_CACHE_TTL):
+        # ttl in minutes
+        self.filename = filename
+        self.ttl = ttl * 60
+        self._lock = threading.Lock()
+        try:
+            with open(self.filename, 'r') as fp:
+                self.entries = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(self.filename, 'w') as fp:
+                json.dump(self.entries, fp)
+        except OSError as e:
+            logging.error(f"[Negative Cache] Could not save file: {e}")
+
+    def add(self, ticker, failures):
+        # failures: {provider name: failure reason}
+        now = time.time()
+        with self._lock:
+            self.entries[ticker.upper()] = {
+                'failures': failures,
+                'created': int(now),
+                'expires': int(now + self.ttl)
+            }
+            self.save()
+        logging.warning(f"[Negative Cache] {ticker} could not be priced " +
+                        "by any provider. Skipping it for " +
+                        f"{int(self.ttl / 60)} minutes.")
+
+    def get(self, ticker):
+        # Returns the entry if the ticker is a known failure, None otherwise
+        ticker = ticker.upper()
+        with self._lock:
+            entry = self.entries.get(ticker)
+        if entry is None:
+            return None
+        if entry['expires'] < time.time():
+            self.clear(ticker)
+            return None
+        return entry
+
+    def clear(self, ticker=None):
+        # Clears a single ticker or, if none is passed, all entries
+        # Returns the number of entries removed
+        with self._lock:
+            if ticker is None:
+                removed = len(self.entries)
+                self.entries = {}
+            else:
+                removed = 1 if self.entries.pop(ticker.upper(), None) else 0
+            if removed:
+                self.save()
+        return removed
+
+    def list(self):
+        now = time.time()
+        with self._lock:
+            entries = sorted(self.entries.items())
+        return [{
+            'ticker': ticker,
+            'failures': entry['failures'],
+            'created': entry['created'],
+            'expires': entry['expires'],
+            'expires_in': int(entry['expires'] - now)
+        } for ticker, entry in entries
+            if entry['expires'] >= now]
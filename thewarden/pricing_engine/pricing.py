@@ -5,18 +5,36 @@
 # associate with the standardized field names for the dataframe
 # Standardized field names:
 # open, high, low, close, volume
+import atexit
+import configparser
 import json
+import logging
 import os
 import sys
+import time
 import urllib.parse
-from datetime import datetime, timedelta, timezone
+from datetime import datetime
 
 import pandas as pd
 import requests
 from flask_login import current_user
 
-from thewarden.node.utils import tor_request
-from thewarden.users.decorators import MWT, timing
+from thewarden.pricing_engine.negative_cache import NegativeCache
+from thewarden.pricing_engine.rate_limiter import governed_request
+from thewarden.pricing_engine.routing import ProviderRouter
+from thewarden.users.decorators import MWT, background_refresh, timing
+
+# Local price files from a previous day are served as stale while they are
+# refreshed in the background. Files older than PRICE_HARD_TTL (in days)
+# are refreshed before returning.
+config = configparser.ConfigParser()
+config.read('config.ini')
+try:
+    PRICE_HARD_TTL = int(config['MAIN']['PRICE_HARD_TTL'])
+except (KeyError, ValueError):
+    PRICE_HARD_TTL = 3
+    logging.info("Could not find PRICE_HARD_TTL at config.ini." +
+                 " Defaulting to 3 days.")
 
 # Generic Requests will try each of these before failing
 REALTIME_PROVIDER_PRIORITY = [
@@ -101,7 +119,6 @@ class PriceProvider:
             self.url_args = "&" + urllib.parse.urlencode(field_dict)
         self.errors = []
 
-    @MWT(timeout=1)
     def request_data(self, ticker):
         data = None
         if self.base_url is not None:
@@ -114,7 +131,13 @@ class PriceProvider:
                 if self.url_args[0] == '&':
                     self.url_args = self.url_args.replace('&', '?', 1)
                 globalURL = (self.base_url + "/" + ticker + self.url_args)
-            request = tor_request(globalURL)
+            # Requests are queued by the rate limit governor for this provider
+            request = governed_request(self.name, globalURL)
+            # HTTP errors are returned as no data (see router.record)
+            if getattr(request, 'status_code', 200) >= 400:
+                self.errors.append(
+                    f"HTTP error {request.status_code} from {self.name}")
+                return (data)
             try:
                 data = request.json()
             except Exception:
@@ -141,9 +164,15 @@ class PriceProvider:
 # btc.price_parser(): do not use directly. This is used to parse
 #                     the requested data from the API provider
 # btc.realtime(provider): returns realtime price (float)
+# btc.age:          Age of the local file in seconds (None if requested now)
+# btc.stale:        True if the local file is from a previous day and a
+#                   background refresh was requested
+# btc.transient:    True if the last request failed with a connection,
+#                   HTTP or throttle error (the ticker may still exist)
+# Pass fetch=False to only use the local file (no requests to the provider)
 class PriceData():
     # All methods related to a ticker
-    def __init__(self, ticker, provider):
+    def __init__(self, ticker, provider, fetch=True):
         # providers is a list of pricing providers
         # ex: ['alphavantage', 'Yahoo']
         self.ticker = ticker.upper()
@@ -154,16 +183,31 @@ class PriceData():
         self.errors = []
         # makesure file path exists
         os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self.age = None
+        self.stale = False
+        self.transient = False
         # Try to read from file and check how recent it is
+        # Files from today are used as is. Files from a previous day but
+        # within PRICE_HARD_TTL are returned and refreshed in background.
         try:
-            today = datetime.now().date()
+            now = datetime.now()
             filetime = datetime.fromtimestamp(os.path.getctime(self.filename))
-            if filetime.date() == today:
+            self.age = (now - filetime).total_seconds()
+            if filetime.date() == now.date():
                 self.df = pd.read_pickle(self.filename)
-            else:
+            elif (now.date() - filetime.date()).days <= PRICE_HARD_TTL:
+                self.df = pd.read_pickle(self.filename)
+                self.stale = True
+                if fetch:
+                    background_refresh(self.filename, self.update_history,
+                                       force=True)
+            elif fetch:
+                self.age = None
                 self.df = self.update_history()
+            else:
+                self.df = None
         except FileNotFoundError:
-            self.df = self.update_history()
+            self.df = self.update_history() if fetch else None
 
         try:
             self.last_update = self.df.index.max()
@@ -193,16 +237,26 @@ class PriceData():
                 pass
         # File not found ot not new. Need to update the matrix
         # Cycle through the provider list until there's satisfactory data
+        start = time.time()
+        self.transient = False
         price_request = self.provider.request_data(self.ticker)
         # Parse and save
         df = self.price_parser(price_request, self.provider)
+        # No data at all is a transport / HTTP / throttle error - data that
+        # could not be parsed is a ticker this provider does not support
+        if (df is None and price_request is None and
+                self.provider.base_url is not None):
+            self.transient = True
+        router.record(self.provider.name, self.ticker, time.time() - start,
+                      df is not None, error=self.transient)
         if df is None:
             self.errors.append(
                 f"Empty df for {self.ticker} using {self.provider.name}")
             return (None)
         df.sort_index(ascending=False, inplace=True)
         df.index = pd.to_datetime(df.index)
-        df.to_pickle(self.filename)
+        df.to_pickle(self.filename + ".tmp")
+        os.replace(self.filename + ".tmp", self.filename)
         # Refresh the class - reinitialize
         return (df)
 
@@ -340,18 +394,17 @@ class PriceData():
 
         if provider.name == 'bitmex':
             try:
-                df = bitmex_gethistory(self.ticker, provider)
+                # Resume from the saved file
+                try:
+                    existing = pd.read_pickle(self.filename)
+                except (FileNotFoundError, ValueError):
+                    existing = None
+                df = bitmex_gethistory(self.ticker, provider, existing)
                 if isinstance(df, str):
-                    if df.find('error') != -1:
-                        self.errors.append(df)
-                        df = None
-                        return (df)
-                df = df.rename(columns={'timestamp': 'date'})
-                df.set_index('date', inplace=True)
-                df_save = df[[
-                    'close', 'open', 'high', 'low', 'volume', 'vwap'
-                ]]
-                return (df_save)
+                    self.transient = df in ("ConnectionError", "Throttled")
+                    self.errors.append(df)
+                    df = None
+                return (df)
             except Exception as e:
                 self.errors.append(e)
                 df = None
@@ -362,6 +415,7 @@ class PriceData():
     def realtime(self, rt_provider):
         # This is the parser for realtime prices.
         # Data should be parsed so only the price is returned
+        start = time.time()
         price_request = rt_provider.request_data(self.ticker)
         price = None
         if rt_provider.name == 'ccrealtime':
@@ -395,10 +449,12 @@ class PriceData():
             except Exception as e:
                 self.errors.append(e)
 
+        router.record(rt_provider.name, self.ticker, time.time() - start,
+                      price is not None,
+                      error=(price is None and price_request is None))
         return price
 
 
-@timing
 class ApiKeys():
     # returns current stored keys in the api_keys.conf file
     # makesure file path exists
@@ -437,72 +493,87 @@ class ApiKeys():
 api_keys_class = ApiKeys()
 api_keys = api_keys_class.loader()
 
+# Routing table with provider performance - saved with the price files
+router = ProviderRouter(
+    os.path.join(current_path(),
+                 'thewarden/pricing_engine/pricing_data/routing_table.json'))
+atexit.register(router.save)
+
+# Tickers that could not be priced by any provider
+negative_cache = NegativeCache(
+    os.path.join(current_path(),
+                 'thewarden/pricing_engine/pricing_data/negative_cache.json'))
+
 # _____________________________________________
 #            Helper functions go here
 # _____________________________________________
 
 
 # Bitmex Helper Function (uses bitmex library instead of requests)
-# Returns a df with history
-def bitmex_gethistory(ticker, provider):
-    # Gets historical prices from bitmex
-    # Saves to folder
-    from bitmex import bitmex
+# Returns a df with history - only the bins after the ones at existing
+# are downloaded (see bitmex_history.py)
+def bitmex_gethistory(ticker, provider, existing=None):
+    from thewarden.pricing_engine.bitmex_history import price_history
     bitmex_credentials = provider.field_dict
-    if ("api_key" in bitmex_credentials) and (
-            "api_secret" in bitmex_credentials):
-        try:
-            mex = bitmex(api_key=bitmex_credentials['api_key'],
-                         api_secret=bitmex_credentials['api_secret'],
-                         test=bitmex_credentials['testnet'])
-            # Need to paginate results here to get all the history
-            # Bitmex API end point limits 750 results per call
-            start_bin = 0
-            resp = (mex.Trade.Trade_getBucketed(symbol=ticker,
-                                                binSize="1d",
-                                                count=500,
-                                                start=start_bin).result())[0]
-            df = pd.DataFrame(resp)
-            last_update = df['timestamp'].iloc[-1]
-
-            # If last_update is older than 3 days ago, keep building.
-            while last_update < (datetime.now(timezone.utc) -
-                                 timedelta(days=3)):
-                start_bin += 500
-                resp = (mex.Trade.Trade_getBucketed(
-                    symbol=ticker, binSize="1d", count=500,
-                    start=start_bin).result())[0]
-                df = df.append(resp)
-                last_update = df['timestamp'].iloc[-1]
-                # To avoid an infinite loop, check if start_bin
-                # is higher than 10000 and stop (i.e. 30+yrs of data)
-                if start_bin > 10000:
-                    break
-            return (df)
-        except Exception as e:
-            return (f"error: {e}")
-    else:
+    if (bitmex_credentials.get("api_key") is None) or (
+            bitmex_credentials.get("api_secret") is None):
         return ('error: no credentials found for Bitmex')
+    try:
+        return (price_history(ticker, bitmex_credentials, existing))
+    except TimeoutError:
+        return ("Throttled")
+    except requests.exceptions.ConnectionError:
+        return ("ConnectionError")
+    except Exception as e:
+        return (f"error: {e}")
+
+
+# Returns the priority list reordered by the router so the provider
+# most likely to succeed for this ticker is tried first
+def provider_order(ticker, priority_list):
+    candidates = [(key, PROVIDER_LIST[key].name) for key in priority_list]
+    return router.rank(ticker.upper(), candidates)
 
 
 # Loop through all providers to get the first non-empty df
+# Tickers that every provider answered as unknown are kept at the negative
+# cache and return an empty PriceData (df = None) until the entry expires.
+# Connection and throttle failures (Tor down, quota used) are not cached.
+@timing
 def price_data(ticker):
-    for provider in HISTORICAL_PROVIDER_PRIORITY:
+    order = provider_order(ticker, HISTORICAL_PROVIDER_PRIORITY)
+    known_failure = negative_cache.get(ticker)
+    if known_failure is not None:
+        price_data = PriceData(ticker, PROVIDER_LIST[order[0]], fetch=False)
+        if price_data.df is None:
+            price_data.errors.append(
+                f"{ticker.upper()} could not be priced by any provider. " +
+                "Skipped (negative cache).")
+            return (price_data)
+    failures = {}
+    transient = False
+    for provider in order:
         price_data = PriceData(ticker, PROVIDER_LIST[provider])
         if price_data.df is not None:
             break
+        transient = transient or price_data.transient
+        failures[PROVIDER_LIST[provider].name] = "; ".join(
+            str(e) for e in price_data.errors)[:250]
+    else:
+        if not transient:
+            negative_cache.add(ticker, failures)
     return (price_data)
 
 
 # Returns price data in current user's currency
+@timing
 def price_data_fx(ticker):
-    for provider in HISTORICAL_PROVIDER_PRIORITY:
-        price_data = PriceData(ticker, PROVIDER_LIST[provider])
-        if price_data.df is not None:
-            break
+    ticker_data = price_data(ticker)
+    if ticker_data.df is None:
+        return (None)
     # Loop through FX providers until a df is filled
     for provider in FX_PROVIDER_PRIORITY:
-        prices = price_data.df_fx(current_user.fx(), PROVIDER_LIST[provider])
+        prices = ticker_data.df_fx(current_user.fx(), PROVIDER_LIST[provider])
         if prices is not None:
             break
     return (prices)
@@ -510,12 +581,15 @@ def price_data_fx(ticker):
 
 # Returns realtime price for a ticker using the provider list
 # Price is returned in USD
+@timing
 def price_data_rt(ticker, priority_list=REALTIME_PROVIDER_PRIORITY):
-    for provider in priority_list:
+    price = None
+    for provider in provider_order(ticker, priority_list):
         price_data = PriceData(ticker, PROVIDER_LIST[provider])
-        if price_data.realtime(PROVIDER_LIST[provider]) is not None:
+        price = price_data.realtime(PROVIDER_LIST[provider])
+        if price is not None:
             break
-    return (price_data.realtime(PROVIDER_LIST[provider]))
+    return (price)
 
 
 @MWT(timeout=60)
@@ -540,6 +614,7 @@ def price_grabber_rt_full(ticker, priority_list=['cc','aa','fp']):
 
 
 @MWT(timeout=30)
+@timing
 def price_data_rt_full(ticker, provider):
     # Function to get a complete data set for realtime prices
     # Loop through the providers to get the following info:
@@ -591,7 +666,10 @@ def price_data_rt_full(ticker, provider):
             globalURL = 'https://www.alphavantage.co/query?function=GLOBAL_QUOTE&apikey='
             globalURL += api_keys['alphavantage'][
                 'api_key'] + '&symbol=' + ticker
-            data = tor_request(globalURL).json()
+            response = governed_request('alphavantage', globalURL)
+            if isinstance(response, str):
+                return None
+            data = response.json()
             price = float(data['Global Quote']
                           ['05. price']) * current_user.fx_rate_USD()
             high = float(
@@ -627,7 +705,10 @@ def price_data_rt_full(ticker, provider):
         try:
             globalURL = 'https://financialmodelingprep.com/api/v3/stock/real-time-price/'
             globalURL += ticker
-            data = tor_request(globalURL).json()
+            response = governed_request('fprealtimestock', globalURL)
+            if isinstance(response, str):
+                return None
+            data = response.json()
             price = float(data['price']) * current_user.fx_rate_USD()
             high = '-'
             low = '-'
@@ -678,11 +759,10 @@ def fx_rate(fx=None, base='USD'):
 # If a price for a security is not found, other rt providers will be used.
 def multiple_price_grab(tickers, fx):
     # tickers should be in comma sep string format like "BTC,ETH,LTC"
-    baseURL = \
-        "https://min-api.cryptocompare.com/data/pricemultifull?fsyms="\
-        + tickers + "&tsyms=" + fx
+    baseURL = PROVIDER_LIST['cc_realtime_full'].base_url +\
+        "?fsyms=" + tickers + "&tsyms=" + fx
     try:
-        request = tor_request(baseURL)
+        request = governed_request('ccrealtimefull', baseURL)
     except requests.exceptions.ConnectionError:
         return ("ConnectionError")
     try:
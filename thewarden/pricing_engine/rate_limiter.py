@@ -0,0 +1,364 @@
+# Rate limit governor for the price providers
+# Each provider (PriceProvider.name) is mapped to a token bucket. Providers
+# that share the same API key (i.e. all Alphavantage functions) share the
+# same bucket so the quota is respected across the whole application.
+#
+# Requests are queued when no tokens are available. Interactive requests
+# (the ones made while serving a browser request) are served before
+# background work (threads regenerating NAV, etc).
+#
+# When a provider answers with a throttle message (Alphavantage "Note",
+# CryptoCompare rate limit errors or an HTTP 429), the bucket is paused
+# and the request is retried after the wait instead of silently falling
+# back to the next provider. A daily limit message, or retries that run
+# out, return "Throttled" so the next provider is tried.
+#
+# Usage:
+#     response = governed_request('alphavantagestock', url)
+#     with background_priority():
+#         ... requests here are served after interactive ones
+import atexit
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import has_request_context
+
+from thewarden.node.http_cache import cache as http_cache
+from thewarden.node.utils import tor_request
+from thewarden.users.metrics import span
+
+# Priorities - lower numbers are served first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Maximum time (in seconds) a request waits in the queue before giving up
+MAX_WAIT = {INTERACTIVE: 65, BACKGROUND: 300}
+# Number of retries after a throttle response was received
+MAX_THROTTLE_RETRIES = 2
+# Pause applied to a bucket after a throttle response (seconds)
+THROTTLE_PAUSE = 60
+
+# Provider name to bucket name. Providers not listed here get a bucket
+# of their own using the DEFAULT_RATE_LIMIT
+PROVIDER_BUCKETS = {
+    'alphavantagedigital': 'alphavantage',
+    'alphavantagestock': 'alphavantage',
+    'alphavantagefx': 'alphavantage',
+    'aarealtime': 'alphavantage',
+    'aarealtimestock': 'alphavantage',
+    'ccdigital': 'cryptocompare',
+    'ccfx': 'cryptocompare',
+    'ccrealtime': 'cryptocompare',
+    'ccrealtimefull': 'cryptocompare',
+    'financialmodelingprep': 'financialmodelingprep',
+    'fprealtimestock': 'financialmodelingprep',
+    'bitmex': 'bitmex'
+}
+
+# Bucket name: (number of requests, per number of seconds)
+RATE_LIMITS = {
+    'alphavantage': (5, 60),
+    'cryptocompare': (20, 1),
+    'financialmodelingprep': (10, 1),
+    'bitmex': (30, 60)
+}
+DEFAULT_RATE_LIMIT = (10, 1)
+
+# Requests per calendar day. Once reached, requests fail fast so the next
+# provider in the priority list can be used.
+DAILY_QUOTA = {'alphavantage': 500}
+
+
+# Background work can be flagged explicitly with this context manager.
+# Otherwise requests made outside of a Flask request are background.
+_local = threading.local()
+
+
+@contextmanager
+def background_priority():
+    previous = getattr(_local, 'priority', None)
+    _local.priority = BACKGROUND
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    priority = getattr(_local, 'priority', None)
+    if priority is not None:
+        return priority
+    if has_request_context():
+        return INTERACTIVE
+    return BACKGROUND
+
+
+class TokenBucket():
+    # Token bucket with a priority queue of waiting requests
+    # rate tokens are refilled every per seconds
+    def __init__(self, name, rate, per):
+        self.name = name
+        self.capacity = float(rate)
+        self.fill_rate = float(rate) / float(per)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._cond = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        # Returns True when a token was taken, False on timeout
+        ticket = (priority, next(self._counter))
+        if timeout is None:
+            timeout = MAX_WAIT.get(priority, MAX_WAIT[BACKGROUND])
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    first = self._queue[0] == ticket
+                    if (first and now >= self.paused_until
+                            and self.tokens >= 1):
+                        self.tokens -= 1
+                        return True
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        return False
+                    wait = remaining
+                    if first:
+                        wait = max(self.paused_until - now,
+                                   (1 - self.tokens) / self.fill_rate)
+                        wait = min(max(wait, 0.01), remaining)
+                    self._cond.wait(wait)
+            finally:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+
+    def pause(self, seconds):
+        # Called after a throttle response - drains the bucket
+        with self._cond:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+            self.tokens = 0
+            self._cond.notify_all()
+
+    def status(self):
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'tokens': round(self.tokens, 2),
+                'capacity': self.capacity,
+                'queued': len(self._queue),
+                'paused_for': round(max(self.paused_until - now, 0), 1)
+            }
+
+
+class QuotaLedger():
+    # Persisted request counters per bucket and per calendar day
+    # Saved to disk at most every SAVE_INTERVAL seconds
+    SAVE_INTERVAL = 30
+    KEEP_DAYS = 30
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._last_save = 0
+        self._dirty = False
+        try:
+            with open(self.filename, 'r') as fp:
+                self.counters = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            self.counters = {}
+
+    def record(self, bucket, field, value=1):
+        today = datetime.now().strftime('%Y-%m-%d')
+        with self._lock:
+            day = self.counters.setdefault(bucket, {}).setdefault(
+                today, {'requests': 0, 'throttled': 0, 'skipped': 0,
+                        'waited_ms': 0})
+            day[field] = day.get(field, 0) + value
+            self._dirty = True
+        if time.time() - self._last_save > self.SAVE_INTERVAL:
+            self.save()
+
+    def today(self, bucket):
+        # Copy of today's counters for this bucket
+        today = datetime.now().strftime('%Y-%m-%d')
+        with self._lock:
+            return dict(self.counters.get(bucket, {}).get(today, {}))
+
+    def used_today(self, bucket):
+        return self.today(bucket).get('requests', 0)
+
+    def exhausted(self, bucket):
+        # True after the provider said the daily limit was reached
+        return bool(self.today(bucket).get('exhausted', 0))
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            # Trim old days
+            for bucket in self.counters:
+                days = sorted(self.counters[bucket])
+                for day in days[:-self.KEEP_DAYS]:
+                    del self.counters[bucket][day]
+            try:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                with open(self.filename, 'w') as fp:
+                    json.dump(self.counters, fp)
+                self._dirty = False
+            except OSError as e:
+                logging.error(f"[Governor] Could not save quota file: {e}")
+            self._last_save = time.time()
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+ledger = QuotaLedger(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'provider_quota.json'))
+atexit.register(ledger.save)
+
+
+def bucket_for(name):
+    # Accepts either a PriceProvider.name or a bucket name
+    bucket_name = PROVIDER_BUCKETS.get(name, name)
+    with _buckets_lock:
+        if bucket_name not in _buckets:
+            rate, per = RATE_LIMITS.get(bucket_name, DEFAULT_RATE_LIMIT)
+            _buckets[bucket_name] = TokenBucket(bucket_name, rate, per)
+        return _buckets[bucket_name]
+
+
+def throttle_delay(response):
+    # Returns the number of seconds to wait if this response is a throttle
+    # message from the provider. Returns None otherwise.
+    status_code = getattr(response, 'status_code', None)
+    if status_code == 429:
+        try:
+            return float(response.headers.get('Retry-After', THROTTLE_PAUSE))
+        except (TypeError, ValueError):
+            return THROTTLE_PAUSE
+    try:
+        data = response.json()
+    except Exception:
+        return None
+    if not isinstance(data, dict):
+        return None
+    # Alphavantage
+    for field in ['Note', 'Information']:
+        message = str(data.get(field, '')).lower()
+        if ('call frequency' in message) or ('rate limit' in message):
+            return THROTTLE_PAUSE
+    # CryptoCompare
+    if data.get('Response') == 'Error':
+        message = str(data.get('Message', '')).lower()
+        if 'rate limit' in message:
+            return THROTTLE_PAUSE
+    return None
+
+
+def daily_limit(response):
+    # True if the response says the daily quota is used (Alphavantage
+    # sends it as a Note / Information message with a 200 status). The
+    # per minute note also mentions the daily limit - that one is a
+    # throttle (see throttle_delay).
+    try:
+        data = response.json()
+    except Exception:
+        return False
+    if not isinstance(data, dict):
+        return False
+    for field in ['Note', 'Information']:
+        message = str(data.get(field, '')).lower()
+        if ('per day' in message) and ('per minute' not in message):
+            return True
+    return False
+
+
+def governed_request(name, url, method="get", priority=None):
+    # Same return values as tor_request. Returns the string "Throttled"
+    # if no token could be acquired in time or the daily quota is used.
+    # Recorded as a provider span - includes the time waiting for a token
+    with span(name, 'provider') as provider_span:
+        response = _governed_request(name, url, method, priority)
+        if isinstance(response, str):
+            provider_span.error = response
+    return response
+
+
+def _governed_request(name, url, method, priority):
+    bucket = bucket_for(name)
+    # Cached responses do not use the provider's quota
+    if method == "get":
+        cached = http_cache.fresh(url)
+        if cached is not None:
+            ledger.record(bucket.name, 'cached')
+            return cached
+    if priority is None:
+        priority = current_priority()
+    quota = DAILY_QUOTA.get(bucket.name)
+    # Interactive requests share one deadline across all attempts so a
+    # page is not kept waiting for several throttle pauses
+    deadline = None
+    if priority == INTERACTIVE:
+        deadline = time.monotonic() + MAX_WAIT[INTERACTIVE]
+    for attempt in range(MAX_THROTTLE_RETRIES + 1):
+        if ledger.exhausted(bucket.name) or (
+                quota is not None and ledger.used_today(bucket.name) >= quota):
+            logging.warning(f"[Governor] Daily quota reached for {bucket.name}")
+            ledger.record(bucket.name, 'skipped')
+            return "Throttled"
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0)
+        start = time.monotonic()
+        if not bucket.acquire(priority, timeout):
+            logging.warning(f"[Governor] Timed out waiting for {bucket.name}")
+            ledger.record(bucket.name, 'skipped')
+            return "Throttled"
+        ledger.record(bucket.name, 'waited_ms',
+                      int((time.monotonic() - start) * 1000))
+        response = tor_request(url, method=method)
+        ledger.record(bucket.name, 'requests')
+        if daily_limit(response):
+            logging.warning(f"[Governor] {bucket.name} daily limit reached")
+            ledger.record(bucket.name, 'exhausted')
+            return "Throttled"
+        delay = throttle_delay(response)
+        if delay is None:
+            return response
+        logging.warning(f"[Governor] {bucket.name} throttled the request " +
+                        f"(attempt {attempt + 1}). Pausing for {delay}s")
+        ledger.record(bucket.name, 'throttled')
+        bucket.pause(delay)
+    logging.warning(f"[Governor] {bucket.name} still throttled after " +
+                    f"{MAX_THROTTLE_RETRIES} retries")
+    return "Throttled"
+
+
+def governor_status():
+    # Returns current bucket status and today's counters
+    status = {}
+    for name in set(PROVIDER_BUCKETS.values()) | set(_buckets):
+        status[name] = bucket_for(name).status()
+        status[name]['today'] = ledger.today(name)
+        status[name]['daily_quota'] = DAILY_QUOTA.get(name)
+    return status
@@ -0,0 +1,131 @@
+# Adaptive routing for the price providers
+# The static priority lists at pricing.py are walked in order, so a stock
+# ticker always wastes requests on crypto providers before reaching a stock
+# provider. The router keeps:
+#   . the providers that last succeeded for each ticker
+#   . a rolling window of latency and errors for each provider
+# and reorders the priority list so the best candidate is tried first.
+# The table is saved next to the local price files (pricing_data folder).
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+# Number of requests kept in the rolling window for each provider
+WINDOW = 50
+# Minimum number of requests before the provider stats are used
+MIN_SAMPLES = 5
+# Latency buckets in seconds - providers within the same bucket keep
+# their original priority
+LATENCY_BUCKETS = [1, 5, 15]
+
+
+class ProviderRouter():
+    SAVE_INTERVAL = 60
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_save = 0
+        # ticker: {provider name: epoch of last success}
+        self.last_success = {}
+        # provider name: deque of [latency in seconds, no error]
+        self.stats = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as fp:
+                data = json.load(fp)
+            self.last_success = data.get('last_success', {})
+            for provider, samples in data.get('stats', {}).items():
+                self.stats[provider] = deque(samples, maxlen=WINDOW)
+        except (FileNotFoundError, ValueError, TypeError):
+            pass
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {
+                'last_success': self.last_success,
+                'stats': {k: list(v) for k, v in self.stats.items()}
+            }
+            try:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                with open(self.filename, 'w') as fp:
+                    json.dump(data, fp)
+                self._dirty = False
+            except OSError as e:
+                logging.error(f"[Router] Could not save routing table: {e}")
+            self._last_save = time.time()
+
+    def record(self, provider, ticker, latency, success, error=False):
+        # success: the provider returned a price for this ticker
+        # error: transport, HTTP or throttle error. An answer saying the
+        # ticker is not supported is not an error for the provider - it
+        # only means the ticker is not moved to this provider.
+        with self._lock:
+            self.stats.setdefault(provider, deque(maxlen=WINDOW)).append(
+                [round(latency, 3), not error])
+            if success:
+                self.last_success.setdefault(ticker, {})[provider] = int(
+                    time.time())
+            self._dirty = True
+        if time.time() - self._last_save > self.SAVE_INTERVAL:
+            self.save()
+
+    def provider_stats(self, provider):
+        # Returns (error rate, mean latency, number of samples)
+        # The deque is copied under the lock - record() may append to it
+        with self._lock:
+            samples = list(self.stats.get(provider, []))
+        if not samples:
+            return (0, 0, 0)
+        n = len(samples)
+        errors = sum(1 for _, ok in samples if not ok)
+        latency = sum(lat for lat, _ in samples) / n
+        return (errors / n, latency, n)
+
+    def _sort_key(self, provider, position):
+        error_rate, latency, n = self.provider_stats(provider)
+        if n < MIN_SAMPLES:
+            return (0, 0, position)
+        latency_bucket = sum(1 for limit in LATENCY_BUCKETS if latency > limit)
+        return (int(error_rate * 4), latency_bucket, position)
+
+    def rank(self, ticker, candidates):
+        # candidates: list of (key, provider name) in static priority order
+        # returns the list of keys in the order they should be tried
+        with self._lock:
+            ticker_history = dict(self.last_success.get(ticker, {}))
+        known = [(ticker_history[name], key) for key, name in candidates
+                 if name in ticker_history]
+        ordered = sorted(
+            enumerate(candidates),
+            key=lambda item: self._sort_key(item[1][1], item[0]))
+        ordered = [key for _, (key, _) in ordered]
+        if known:
+            best = max(known)[1]
+            ordered.remove(best)
+            ordered.insert(0, best)
+        return ordered
+
+    def table(self):
+        # Summary used for status pages
+        summary = {}
+        with self._lock:
+            providers = list(self.stats)
+            tickers = {ticker: dict(history) for ticker, history
+                       in self.last_success.items()}
+        for provider in providers:
+            error_rate, latency, n = self.provider_stats(provider)
+            summary[provider] = {
+                'error_rate': round(error_rate, 3),
+                'latency': round(latency, 3),
+                'samples': n
+            }
+        return {'providers': summary, 'tickers': tickers}
@@ -18,14 +18,17 @@ $(document).ready(function () {
     });
 });
 function run_ajax(tickers) {
-    // Ajax to get the NAV json
+    // Ajax to get the allocation history (columnar, only % allocations)
     $.ajax({
         type: "GET",
         dataType: 'json',
-        url: "/generatenav_json",
+        url: "/allocation_history_json",
+        data: {
+            resolution: 'daily'
+        },
         success: function (data) {
             $('#alerts').html("")
-            console.log("ajax request [NAV]: OK")
+            console.log("ajax request [Allocation]: OK")
             handle_ajax_data(data, tickers);
 
         },
@@ -61,16 +64,15 @@ function handle_ajax_data(data, tickers) {
     // // Looping through Tickers (only ones that downloaded ok)
     $.each(tickers, function (key_ticker) {
         ticker = tickers[key_ticker]
-        if (data[ticker + '_pos']) {
-            // if (ticker != "USD") {
+        if (data.allocation[ticker]) {
             // Prep data for chart
             tmp_dict = {};
             tmp_dict['name'] = ticker;
             tmp_dict['type'] = 'area';
             tmp_dict['turboThreshold'] = 0;
-            // The line below maps in a format that HighCharts can understand. the *1 (for date) is necessary for some weird reason.
-            // it maps to (date, value)
-            tmp_dict['data'] = Object.keys(data[ticker + '_fx_perc']).map((key) => [((key * 1)), data[ticker + '_fx_perc'][key] * 100]);
+            // maps to (date, value) - dates are already in epoch ms
+            values = data.allocation[ticker];
+            tmp_dict['data'] = data.dates.map((date, i) => [date, values[i]]);
             tmp_dict['yAxis'] = 0;
             chart_data_list.push(tmp_dict);
         }
@@ -53,29 +53,64 @@ $(document).ready(function () {
     $(".xbuttons").hide();
 
     // Get variables - look how many are checked from class address_check
-    var checked = 0;
-    var progress = 100 / count;
     $("#status_bar").html("Checking a total of " + count + " addresses...");
 
-    // Loop through list of addresses
+    // All selected addresses are refreshed in a single batch request
+    var elements = {};
     $(".address_check:checkbox:checked").each(function () {
-      // Show if address is being checked
       address = $(this).attr("id");
-      $("#status_bar").html("Checking address: " + address + "...");
       $(this)
         .closest("tr")
         .children("#check")
         .html("Checking...");
-      // Store current balance in Satoshis
-      balance = $(this)
-        .closest("tr")
-        .children("#balance")
-        .data("balance");
-      check_address(address, this, progress);
+      elements[address] = this;
     });
+    check_addresses(elements);
   });
 });
 
+function check_addresses(elements) {
+  var addresses = Object.keys(elements);
+  $.ajax({
+    type: "POST",
+    url: "/refresh_addresses",
+    timeout: 900000,
+    dataType: "json",
+    data: {
+      addresses: addresses.join(",")
+    },
+    success: function (data_return) {
+      $("#status_bar").html(
+        "Received back data for " + addresses.length + " addresses..."
+      );
+      $.each(addresses, function (index, address) {
+        var result = data_return["results"][address];
+        if (result == null || result["success"] != true) {
+          show_result(elements[address], address, "error");
+        } else {
+          show_result(elements[address], address, result);
+        }
+      });
+      increment_progress(100);
+    },
+    error: function (xhr, status, error) {
+      increment_progress(100);
+      $("#status_bar").html("Batch check FAILED. Error: " + error);
+      console.log("ERROR on AJAX");
+      console.log(status);
+      console.log(error);
+      $.each(addresses, function (index, address) {
+        $(elements[address])
+          .closest("tr")
+          .children("#check")
+          .html("Error: " + error)
+          .addClass("text-danger")
+          .removeClass("text-dark");
+      });
+    }
+  });
+}
+
 // Sum all balances in table positions into a last row
 function refresh_tables() {
   $(".monitor_table").each(function () {
@@ -128,78 +163,7 @@ function check_address(address, element, progress) {
         "Received back data for address: " + address + "..."
       );
       increment_progress(progress);
-
-      if (data_return == "error") {
-        console.log("error - data was: " + data_return);
-        $(element)
-          .closest("tr")
-          .children("#check")
-          .html("Error. Try again.");
-        $(element)
-          .closest("tr")
-          .children("#check")
-          .addClass("text-danger")
-          .removeClass("text-dark");
-      }
-      if (data_return["success"] != null) {
-        console.log("Success - data ok");
-        // Hide alert after 4500ms
-        if (data_return["change"] == true) {
-          $(element)
-            .closest("tr")
-            .children("#transactions")
-            .addClass("text-danger");
-          $(element)
-            .closest("tr")
-            .children("#check")
-            .addClass("align-middle text-left text-danger");
-          $(element)
-            .closest("tr")
-            .children("#check")
-            .html("Change Detected");
-          $(element)
-            .closest("tr")
-            .children("#balance")
-            .html(
-              "<strong class='text-center'>Changed from:<br><span class='text-info'> " +
-              (
-                data_return["address_data"]["previous_balance"] / 100000000
-              ).toLocaleString("en-US", {
-                style: "decimal",
-                maximumFractionDigits: 2,
-                minimumFractionDigits: 2
-              }) +
-              "</span><br> to: <br><span class='text-info'>" +
-              (
-                data_return["address_data"]["last_balance"] / 100000000
-              ).toLocaleString("en-US", {
-                style: "decimal",
-                maximumFractionDigits: 2,
-                minimumFractionDigits: 2
-              })
-            ) +
-            "Check recent <a href='/bitcoin_transactions/" +
-            address +
-            "'>transactions</a></strong>.";
-          $(element)
-            .closest("tr")
-            .children("#method")
-            .html(data_return["method"]);
-        } else {
-          $(element)
-            .closest("tr")
-            .children("#check")
-            .addClass("text-success");
-          $(element)
-            .closest("tr")
-            .children("#check")
-            .html("No Changes");
-          $(element)
-            .closest("tr")
-            .children("#method")
-            .html(data_return["method"]);
-        }
-      }
+      show_result(element, address, data_return);
     },
     error: function (xhr, status, error) {
       increment_progress(progress);
@@ -219,3 +183,78 @@ function check_address(address, element, progress) {
     }
   });
 }
+
+// Updates the table row of an address with the result of a check
+function show_result(element, address, data_return) {
+  if (data_return == "error") {
+    console.log("error - data was: " + data_return);
+    $(element)
+      .closest("tr")
+      .children("#check")
+      .html("Error. Try again.");
+    $(element)
+      .closest("tr")
+      .children("#check")
+      .addClass("text-danger")
+      .removeClass("text-dark");
+  }
+  if (data_return["success"] != null) {
+    console.log("Success - data ok");
+    // Hide alert after 4500ms
+    if (data_return["change"] == true) {
+      $(element)
+        .closest("tr")
+        .children("#transactions")
+        .addClass("text-danger");
+      $(element)
+        .closest("tr")
+        .children("#check")
+        .addClass("align-middle text-left text-danger");
+      $(element)
+        .closest("tr")
+        .children("#check")
+        .html("Change Detected");
+      $(element)
+        .closest("tr")
+        .children("#balance")
+        .html(
+          "<strong class='text-center'>Changed from:<br><span class='text-info'> " +
+          (
+            data_return["address_data"]["previous_balance"] / 100000000
+          ).toLocaleString("en-US", {
+            style: "decimal",
+            maximumFractionDigits: 2,
+            minimumFractionDigits: 2
+          }) +
+          "</span><br> to: <br><span class='text-info'>" +
+          (
+            data_return["address_data"]["last_balance"] / 100000000
+          ).toLocaleString("en-US", {
+            style: "decimal",
+            maximumFractionDigits: 2,
+            minimumFractionDigits: 2
+          })
+        ) +
+        "Check recent <a href='/bitcoin_transactions/" +
+        address +
+        "'>transactions</a></strong>.";
+      $(element)
+        .closest("tr")
+        .children("#method")
+        .html(data_return["method"]);
+    } else {
+      $(element)
+        .closest("tr")
+        .children("#check")
+        .addClass("text-success");
+      $(element)
+        .closest("tr")
+        .children("#check")
+        .html("No Changes");
+      $(element)
+        .closest("tr")
+        .children("#method")
+        .html(data_return["method"]);
+    }
+  }
+}
@@ -368,6 +368,10 @@ $(document).ready(function () {
         type: 'GET',
         url: '/navchartdatajson',
         dataType: 'json',
+        // Long histories are downsampled (LTTB) to keep the chart light
+        data: {
+            points: 2000
+        },
         success: function (data) {
             navChart(data);
         }
@@ -48,8 +48,7 @@ function handle_ajax_data(data) {
     // Var to return message alerts for ticker errors
     var failed_message = "";
     // Prepare data for chart
-    // The ajax return functions sends a string that needs to be read as a json
-    var parsed_data = (jQuery.parseJSON(data.data));
+    var parsed_data = data.data;
     var chart_data_list = [];
     var nav_dict = {};
     // These are all HighChart inputs - first for NAV, then loop through tickers
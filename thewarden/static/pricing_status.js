@@ -1,6 +1,10 @@
 $(document).ready(function () {
     update_test();
+    update_negative_cache();
     $('.change_monitor').on('change', update_test);
+    $(document).on('click', '.clear_negative', function () {
+        clear_negative_cache($(this).data('ticker'));
+    });
 
 });
 
@@ -60,6 +64,48 @@ function update_test() {
 
 }
 
+// Lists the tickers that could not be priced by any provider
+function update_negative_cache() {
+    $.ajax({
+        type: "GET",
+        dataType: 'json',
+        url: "/negative_cache_json",
+        success: function (data) {
+            if (data.length == 0) {
+                $('#negative_cache_body').html("<tr><td colspan='4' class='text-center'>None</td></tr>")
+                return
+            }
+            html = ''
+            $.each(data, function (index, entry) {
+                failures = ''
+                $.each(entry.failures, function (provider, reason) {
+                    failures += "<strong>" + provider + "</strong>: " + $('<span>').text(reason).html() + "<br>"
+                });
+                html += "<tr><td class='align-middle'>" + entry.ticker + "</td>"
+                html += "<td class='small'>" + failures + "</td>"
+                html += "<td class='text-center align-middle'>" + formatNumber(entry.expires_in / 60, 0) + " min</td>"
+                html += "<td class='text-center align-middle'><button class='btn btn-sm btn-outline-secondary clear_negative' data-ticker='"
+                html += entry.ticker + "'>Clear</button></td></tr>"
+            });
+            $('#negative_cache_body').html(html)
+        }
+    });
+};
+
+function clear_negative_cache(ticker) {
+    $.ajax({
+        type: "POST",
+        dataType: 'json',
+        url: "/negative_cache_clear",
+        data: {
+            ticker: ticker
+        },
+        success: function (data) {
+            update_negative_cache();
+        }
+    });
+};
+
 function test_price(ticker, provider, rtprovider = null, this_var = null) {
     var url_str = "/test_price?ticker=" + ticker + "&provider=" + provider
     if (rtprovider != null) {
@@ -89,7 +89,7 @@ function run_ajax() {
 };
 
 function handle_ajax_data(data, ticker, fx) {
-    var parsed_data = (jQuery.parseJSON(data.data));
+    var parsed_data = data.data;
     // Create Chart
     createChart(parsed_data, ticker, fx);
 
@@ -8,7 +8,8 @@ from thewarden import db
 from thewarden.transactions.forms import NewTrade, EditTransaction
 from thewarden.models import Trades, AccountInfo
 from datetime import datetime
-from thewarden.users.utils import (cleancsv, bitmex_orders, regenerate_nav)
+from thewarden.users.utils import (cleancsv, bitmex_orders, regenerate_nav,
+                                   trade_blockchain_ids)
 
 transactions = Blueprint("transactions", __name__)
 
@@ -425,18 +426,6 @@ def account_positions():
     )
 
 
-def check_trade_included(id):
-    # Checks if a transaction id is already in database
-    # Returns True or False
-    df = pd.read_sql_table("trades", db.engine)
-    # Filter only the trades for current user
-    df = df[(df.user_id == current_user.username)]
-    df = df[(df.trade_blockchain_id == id)]
-    if df.empty:
-        return False
-    return True
-
-
 @transactions.route("/bitmex_transactions", methods=["GET", "POST"])
 @login_required
 def bitmex_transactions():
@@ -452,18 +441,19 @@ def bitmex_transactions():
     bitmex_credentials = api_keys_json['bitmex']
     if ("api_key" in bitmex_credentials) and (
             "api_secret" in bitmex_credentials):
-        data = bitmex_orders(bitmex_credentials['api_key'],
-                             bitmex_credentials['api_secret'], testnet)
+        data_df = bitmex_orders(bitmex_credentials['api_key'],
+                                bitmex_credentials['api_secret'], testnet,
+                                full=request.args.get("full") == "true")
         try:
-            # Create a DataFrame to return
-            data_df = pd.DataFrame.from_dict(data[0])
+            if isinstance(data_df, str):
+                raise ValueError(data_df)
             data_df['fiat_fee'] = data_df['execComm'] * data_df[
                 'lastPx'] / 100000000
             # Check if the transactions are included in the database already
-            data_df['exists'] = data_df['execID'].apply(check_trade_included)
+            data_df['exists'] = data_df['execID'].isin(trade_blockchain_ids())
             transactions["data"] = data_df
             meta["success"] = "success"
-        except ValueError:
+        except (KeyError, ValueError):
             meta["success"] = "error"
 
     return render_template("bitmex_transactions.html",
@@ -2,12 +2,15 @@ import collections
 import functools
 import hashlib
 import inspect
+import logging
 import os
+import threading
 import time
 from functools import wraps
 from glob import glob
 
 from thewarden.config import Config
+from thewarden.users.metrics import span
 
 import pandas as pd
 
@@ -54,22 +57,58 @@ def del_cached():
 
 
 def timing(method):
-    # Time a function - only runs if environment variable:
-    # WARDEN_STATUS="developer
+    # Records a span for each call (see users/metrics.py) so the time
+    # is included in the histograms and in the trace of the request.
+    # Durations are also logged if environment variable:
+    # WARDEN_STATUS="developer"
+    name = method.__module__.split('.')[-1] + '.' + method.__qualname__
+
+    @wraps(method)
     def timed(*args, **kw):
-        if Config.WARDEN_STATUS == "developer":
-            ts = time.time()
+        with span(name, 'function') as timed_span:
             result = method(*args, **kw)
-            te = time.time()
-            print('Function', method.__name__, 'time:',
-                  round((te - ts) * 1000, 1), 'ms')
-            return result
-        else:
-            return (method(*args, **kw))
+        if Config.WARDEN_STATUS == "developer":
+            logging.debug(f"[timing] {name} {timed_span.duration:.1f} ms")
+        return result
 
     return timed
 
 
+# Stale-while-revalidate helpers
+# Callers that find stale data return it immediately and hand the
+# refresh to background_refresh. Only one refresh runs for each key,
+# further calls while it is running are ignored.
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def background_refresh(key, func, *args, **kwargs):
+    # Returns True if a new refresh was started
+    with _refreshing_lock:
+        if key in _refreshing:
+            return False
+        _refreshing.add(key)
+
+    def run():
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            logging.error(f"[background_refresh] {key} failed: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    thread = threading.Thread(target=run, name=f"refresh {key}")
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def is_refreshing(key):
+    with _refreshing_lock:
+        return key in _refreshing
+
+
 class memoized(object):
     # Decorator. Caches a function's return value each time it is called.
     # If called later with the same arguments, the cached value is returned
@@ -0,0 +1,273 @@
+# Instrumentation for the hot paths
+# Spans are nested (a thread local stack keeps the current span) so a
+# dashboard request shows how much of its time went to NAV generation,
+# price requests, database reads and http requests.
+#
+# Categories used:
+#   request   Flask requests (root spans)
+#   function  functions decorated with @timing
+#   provider  price provider requests (rate limit governor)
+#   http      outgoing http requests (tor_request)
+#   db        SQL statements
+#
+# Each finished span is added to a histogram (category, name). Root spans
+# are kept with their children in a ring buffer of recent traces.
+#
+# Usage:
+#     with span('price_data', 'function'):
+#         ...
+#     snapshot()      dict with histograms and recent traces
+#     prometheus()    same histograms in Prometheus text format
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Histogram bucket limits in milliseconds
+BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+# Number of root spans (traces) kept
+MAX_TRACES = 100
+# Children kept for each span. Functions called in loops (i.e. one price
+# request per trade) would otherwise create huge traces. Durations are
+# still added to the histograms.
+MAX_CHILDREN = 200
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}
+_traces = deque(maxlen=MAX_TRACES)
+_db_events = False
+
+
+class Span():
+    __slots__ = ['name', 'category', 'start', 'duration', 'error', 'attrs',
+                 'children', 'dropped', '_t0']
+
+    def __init__(self, name, category, attrs=None):
+        self.name = name
+        self.category = category
+        self.attrs = attrs or {}
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.children = []
+        self.dropped = 0
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'category': self.category,
+            'start': self.start,
+            'duration_ms': round(self.duration or 0, 3),
+            'error': self.error,
+            'attrs': self.attrs,
+            'children': [child.to_dict() for child in self.children],
+            'dropped_children': self.dropped
+        }
+
+
+class Histogram():
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.errors = 0
+        self.max = 0
+
+    def add(self, duration, error=False):
+        index = len(BUCKETS)
+        for i, limit in enumerate(BUCKETS):
+            if duration <= limit:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += duration
+        self.max = max(self.max, duration)
+        if error:
+            self.errors += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'sum_ms': round(self.sum, 3),
+            'mean_ms': round(self.sum / self.count, 3) if self.count else 0,
+            'max_ms': round(self.max, 3),
+            'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'],
+                                self.counts))
+        }
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def current_span():
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def start_span(name, category='function', **attrs):
+    # Use span() when possible. start_span / end_span are used where a
+    # context manager can't be (i.e. Flask request hooks)
+    new_span = Span(name, category, attrs)
+    stack = _stack()
+    if stack:
+        parent = stack[-1]
+        if len(parent.children) < MAX_CHILDREN:
+            parent.children.append(new_span)
+        else:
+            parent.dropped += 1
+    stack.append(new_span)
+    return new_span
+
+
+def end_span(finished, error=None):
+    finished.duration = (time.perf_counter() - finished._t0) * 1000
+    if error is not None and finished.error is None:
+        finished.error = str(error)[:200]
+    stack = _stack()
+    # Remove this span and any child that was not closed
+    while stack:
+        if stack.pop() is finished:
+            break
+    with _lock:
+        key = (finished.category, finished.name)
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].add(finished.duration, finished.error is not None)
+        if not stack:
+            _traces.append(finished)
+    return finished
+
+
+@contextmanager
+def span(name, category='function', **attrs):
+    new_span = start_span(name, category, **attrs)
+    try:
+        yield new_span
+    except Exception as e:
+        end_span(new_span, error=f"{type(e).__name__}: {e}")
+        raise
+    else:
+        end_span(new_span)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _traces.clear()
+
+
+def snapshot(traces=20):
+    # Returns histograms and the most recent traces (newest first)
+    with _lock:
+        histograms = {}
+        for (category, name), histogram in sorted(_histograms.items()):
+            histograms.setdefault(category, {})[name] = histogram.to_dict()
+        recent = list(_traces)[-traces:] if traces else []
+    return {
+        'histograms': histograms,
+        'traces': [trace.to_dict() for trace in reversed(recent)]
+    }
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', ' ')
+
+
+def prometheus():
+    # Prometheus text format (version 0.0.4). Durations in seconds.
+    lines = [
+        '# HELP warden_span_duration_seconds Duration of instrumented spans',
+        '# TYPE warden_span_duration_seconds histogram'
+    ]
+    errors = []
+    with _lock:
+        items = sorted(_histograms.items())
+        for (category, name), histogram in items:
+            labels = f'category="{_label(category)}",name="{_label(name)}"'
+            cumulative = 0
+            for limit, count in zip(BUCKETS + ['+Inf'], histogram.counts):
+                cumulative += count
+                le = limit if limit == '+Inf' else limit / 1000
+                lines.append('warden_span_duration_seconds_bucket{' +
+                             f'{labels},le="{le}"' + '} ' + str(cumulative))
+            lines.append('warden_span_duration_seconds_sum{' + labels +
+                         '} ' + str(histogram.sum / 1000))
+            lines.append('warden_span_duration_seconds_count{' + labels +
+                         '} ' + str(histogram.count))
+            errors.append('warden_span_errors_total{' + labels + '} ' +
+                          str(histogram.errors))
+    lines += [
+        '# HELP warden_span_errors_total Spans that ended with an error',
+        '# TYPE warden_span_errors_total counter'
+    ] + errors
+    return '\n'.join(lines) + '\n'
+
+
+# SQL statements are grouped by operation and first table
+_sql_table = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+["`]?(\w+)',
+                        re.IGNORECASE)
+
+
+def sql_name(statement):
+    operation = statement.lstrip().split(' ', 1)[0].upper()
+    table = _sql_table.search(statement)
+    if table:
+        return f"{operation} {table.group(1)}"
+    return operation
+
+
+def init_app(app):
+    # Root spans for each request and spans for SQL statements
+    from flask import g, request
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    @app.before_request
+    def start_request_span():
+        g._metrics_span = start_span(request.endpoint or request.path,
+                                     'request', method=request.method,
+                                     path=request.path)
+
+    @app.teardown_request
+    def end_request_span(error=None):
+        request_span = g.pop('_metrics_span', None)
+        if request_span is not None:
+            end_span(request_span, error=error)
+
+    # Engine events are global - register only once
+    global _db_events
+    if _db_events:
+        return
+    _db_events = True
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('_metrics_spans', []).append(
+            start_span(sql_name(statement), 'db'))
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        spans = conn.info.get('_metrics_spans')
+        if spans:
+            end_span(spans.pop())
+
+    @event.listens_for(Engine, 'handle_error')
+    def handle_error(context):
+        if context.connection is None:
+            return
+        spans = context.connection.info.get('_metrics_spans')
+        if spans:
+            end_span(spans.pop(), error=context.original_exception)
@@ -0,0 +1,185 @@
+# Per request profiler - only available when WARDEN_STATUS="developer"
+# A request is profiled when it includes the header X-Warden-Profile or
+# the query argument _profile, for example:
+#     /portfolio_compare_json?tickers=BTC&_profile=1
+#
+# Two modes are available:
+#   sample   (default) a thread samples the stack of the request every
+#            SAMPLE_INTERVAL seconds. Saved in the collapsed stack format
+#            used by flamegraph.pl and speedscope (one stack per line).
+#   cprofile deterministic profiler (cProfile). Saved as a .prof file
+#            that can be opened with pstats or snakeviz.
+#            Use X-Warden-Profile: cprofile or _profile=cprofile
+#
+# Profiles are saved at thewarden/profiles/ as <timestamp>_<route>.<ext>
+# and listed at /debug/profiles (slowest first).
+import cProfile
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+from thewarden.config import Config
+
+SAMPLE_INTERVAL = 0.005
+# Number of profiles listed (older files are kept on disk)
+MAX_PROFILES = 100
+
+PROFILE_FOLDER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'profiles')
+
+# Most recent profiles (dicts) - see save_profile
+recent_profiles = deque(maxlen=MAX_PROFILES)
+
+
+def enabled():
+    return Config.WARDEN_STATUS == "developer"
+
+
+def requested_mode(request):
+    # Returns 'sample', 'cprofile' or None if profiling was not requested
+    flag = (request.headers.get('X-Warden-Profile') or
+            request.args.get('_profile'))
+    if not flag or not enabled():
+        return None
+    if flag.lower() == 'cprofile':
+        return 'cprofile'
+    return 'sample'
+
+
+class StackSampler():
+    # Samples the stack of a thread (the one serving the request)
+    # and counts each distinct stack
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}"
+                         for stack, count in self.stacks.most_common()) + '\n'
+
+
+class RequestProfiler():
+    def __init__(self, mode):
+        self.mode = mode
+        self.start_time = None
+        self._sampler = None
+        self._profile = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = StackSampler(threading.get_ident())
+            self._sampler.start()
+
+    def stop(self):
+        duration = (time.perf_counter() - self.start_time) * 1000
+        if self.mode == 'cprofile':
+            self._profile.disable()
+        else:
+            self._sampler.stop()
+        return (duration)
+
+    def save(self, filename):
+        if self.mode == 'cprofile':
+            self._profile.dump_stats(filename)
+            return (None)
+        with open(filename, 'w') as fp:
+            fp.write(self._sampler.collapsed())
+        return (self._sampler.samples)
+
+
+def save_profile(profiler, route, method, duration):
+    timestamp = datetime.now()
+    safe_route = re.sub(r'[^A-Za-z0-9_.-]', '_', route).strip('_') or 'root'
+    extension = 'prof' if profiler.mode == 'cprofile' else 'collapsed'
+    profile_id = f"{timestamp.strftime('%Y%m%d_%H%M%S_%f')}_{safe_route}"
+    filename = os.path.join(PROFILE_FOLDER, f"{profile_id}.{extension}")
+    try:
+        os.makedirs(PROFILE_FOLDER, exist_ok=True)
+        samples = profiler.save(filename)
+    except OSError as e:
+        logging.error(f"[Profiler] Could not save profile: {e}")
+        return (None)
+    entry = {
+        'id': profile_id,
+        'route': route,
+        'method': method,
+        'mode': profiler.mode,
+        'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        'duration_ms': round(duration, 1),
+        'samples': samples,
+        'filename': os.path.basename(filename)
+    }
+    recent_profiles.append(entry)
+    logging.info(f"[Profiler] {route} took {duration:.0f} ms - " +
+                 f"profile saved to {filename}")
+    return (entry)
+
+
+def slowest_profiles():
+    return sorted(recent_profiles, key=lambda x: x['duration_ms'],
+                  reverse=True)
+
+
+def profile_path(profile_id):
+    # Returns the file for a profile listed at recent_profiles
+    for entry in recent_profiles:
+        if entry['id'] == profile_id:
+            return (os.path.join(PROFILE_FOLDER, entry['filename']))
+    return (None)
+
+
+def init_app(app):
+    from flask import g, request
+
+    @app.before_request
+    def start_profiler():
+        mode = requested_mode(request)
+        if mode is None:
+            return
+        g._profiler = RequestProfiler(mode)
+        g._profiler.start()
+
+    @app.after_request
+    def stop_profiler(response):
+        profiler = g.pop('_profiler', None)
+        if profiler is None:
+            return response
+        duration = profiler.stop()
+        entry = save_profile(profiler, request.path, request.method, duration)
+        if entry is not None:
+            response.headers['X-Warden-Profile-Id'] = entry['id']
+        return response
@@ -0,0 +1,123 @@
+# Shared JSON encoder for API responses
+# Handles NaN / Inf (encoded as null), numpy scalars and arrays, Timestamps
+# and DataFrames without going through to_json + json.loads or encoding a
+# JSON string inside another JSON.
+#
+# orjson is used when installed (pip install orjson), otherwise simplejson.
+#
+# DataFrames are encoded as (see frame_to_dict):
+#   columns  {column: {index: value}} - same as DataFrame.to_json(),
+#            dates as epoch ms. Default.
+#   index    {index: {column: value}} - same as to_dict(orient='index')
+#   columnar {index: [...], columns: {column: [...]}} - smallest payload
+#
+# Usage:
+#     return json_response({'data': df, 'messages': messages})
+#     return json_response(columnar(df))
+import gzip
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+import simplejson
+from flask import Response, request
+
+from thewarden.analytics.downsample import epoch_ms
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Responses larger than this are gzipped (if the client accepts it)
+GZIP_MIN_BYTES = 16 * 1024
+GZIP_LEVEL = 5
+
+
+def index_values(index):
+    if isinstance(index, pd.DatetimeIndex):
+        return (epoch_ms(index))
+    return (index.tolist())
+
+
+def column_values(series):
+    if isinstance(series.dtype, np.dtype) and series.dtype.kind in 'fiub':
+        return (series.to_numpy().tolist())
+    return (series.tolist())
+
+
+def frame_to_dict(df, orient='columns'):
+    if orient == 'columnar':
+        return columnar(df)
+    keys = [str(key) for key in index_values(df.index)]
+    columns = [str(col) for col in df.columns]
+    values = [column_values(df.iloc[:, position])
+              for position in range(len(columns))]
+    if orient == 'index':
+        return {key: dict(zip(columns, row))
+                for key, row in zip(keys, zip(*values))}
+    return {column: dict(zip(keys, column_data))
+            for column, column_data in zip(columns, values)}
+
+
+def columnar(df):
+    # Column arrays are kept as numpy arrays - orjson writes them directly
+    return {
+        'index': index_values(df.index),
+        'columns': {str(col): (df[col].to_numpy()
+                               if df[col].dtype.kind in 'fiub'
+                               else df[col].tolist())
+                    for col in df.columns}
+    }
+
+
+def _default(obj):
+    # Types not handled by the encoders
+    if isinstance(obj, pd.DataFrame):
+        return frame_to_dict(obj)
+    if isinstance(obj, pd.Series):
+        return dict(zip([str(key) for key in index_values(obj.index)],
+                        column_values(obj)))
+    if isinstance(obj, pd.Index):
+        return index_values(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if obj is pd.NaT:
+        return None
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} " +
+                    "is not JSON serializable")
+
+
+def dumps(obj):
+    # Returns bytes
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default,
+                            option=(orjson.OPT_SERIALIZE_NUMPY |
+                                    orjson.OPT_NON_STR_KEYS))
+    return simplejson.dumps(obj, default=_default,
+                            ignore_nan=True).encode('utf-8')
+
+
+def encoded_response(body, status=200, mimetype='application/json'):
+    # body is an encoded JSON (str or bytes)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    headers = {}
+    if (len(body) >= GZIP_MIN_BYTES and
+            'gzip' in request.headers.get('Accept-Encoding', '')):
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+    return Response(body, status=status, mimetype=mimetype, headers=headers)
+
+
+def json_response(obj, status=200):
+    return encoded_response(dumps(obj), status=status)
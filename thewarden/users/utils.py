@@ -6,22 +6,26 @@ import json
 import logging
 import os
 import sys
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
-from flask import flash, url_for
+from flask import (copy_current_request_context, flash,
+                   has_request_context, url_for)
 from flask_login import current_user
 from flask_mail import Message
 
 from thewarden import db, mail
-from thewarden import mhp as mrh
+from thewarden.analytics.heatmap import COLUMNS as HEATMAP_COLUMNS
+from thewarden.analytics.heatmap import price_heatmap
+from thewarden.analytics.stats import nav_version
 from thewarden.models import Trades
 from thewarden.pricing_engine.pricing import (fx_price_ondate,
                                               multiple_price_grab, price_data,
                                               price_data_fx, price_data_rt,
                                               price_data_rt_full)
-from thewarden.users.decorators import MWT, memoized, timing
+from thewarden.users.decorators import (MWT, background_refresh,
+                                        is_refreshing, memoized, timing)
 
 # ---------------------------------------------------------
 # Helper Functions start here
@@ -38,6 +42,12 @@ try:
 except KeyError:
     RENEW_NAV = 10
     logging.error("Could not find RENEW_NAV at config.ini. Defaulting to 60.")
+try:
+    NAV_HARD_TTL = config['MAIN']['NAV_HARD_TTL']
+except KeyError:
+    NAV_HARD_TTL = 1440
+    logging.error("Could not find NAV_HARD_TTL at config.ini." +
+                  " Defaulting to 1440.")
 try:
     PORTFOLIO_MIN_SIZE_NAV = config['MAIN']['PORTFOLIO_MIN_SIZE_NAV']
 except KeyError:
@@ -291,6 +301,7 @@ def df_unpack(df, column, fillna=None):
 
 
 @MWT(timeout=2)
+@timing
 def positions():
     # Method to create a user's position table
     # Returns a df with the following information
@@ -333,6 +344,7 @@ def single_price(ticker):
 
 
 @MWT(timeout=1)
+@timing
 def positions_dynamic():
     # This method is the realtime updater for the front page. It gets the
     # position information from positions above and returns a dataframe
@@ -499,9 +511,33 @@ def cleancsv(text):  # Function to clean CSV fields - leave only digits and .
     return(str)
 
 
+def nav_filename():
+    # Local NAV files are saved under a hash of username and fx
+    usernamehash = hashlib.sha256(current_user.username.encode(
+        'utf-8')).hexdigest()
+    filename = "thewarden/nav_data/" + usernamehash + current_user.fx() + ".nav"
+    return (os.path.join(current_path(), filename))
+
+
+# Returns the age (in seconds) of the local NAV file, if it's past the
+# RENEW_NAV limit (stale) and if a background refresh is running
+def nav_status():
+    filename = nav_filename()
+    try:
+        modified = datetime.utcfromtimestamp(os.path.getmtime(filename))
+        age = (datetime.utcnow() - modified).total_seconds()
+    except FileNotFoundError:
+        age = None
+    return {
+        'age': age,
+        'stale': age is not None and (age / 60) >= int(RENEW_NAV),
+        'refreshing': is_refreshing(filename)
+    }
+
+
 @MWT(timeout=1)
 @timing
-def generatenav(user, force=False, filter=None):
+def generatenav(user, force=False, filter=None, revalidate=False):
     logging.info(f"[generatenav] Starting NAV Generator for user {user}")
     # Portfolios smaller than this size do not account for NAV calculations
     # Otherwise, there's an impact of dust left in the portfolio (in USD)
@@ -515,13 +551,15 @@ def generatenav(user, force=False, filter=None):
     # This period of time is setup in config.ini as RENEW_NAV (in minutes).
     # If last file is newer than 60 minutes (default), the local saved file
     # will be used.
+    # Files older than RENEW_NAV but newer than NAV_HARD_TTL are returned
+    # as is while a new NAV is generated in the background
+    # (stale-while-revalidate). Older files are rebuilt before returning.
     # Unless force is true, then a rebuild is done regardless
     # Local files are  saved under a hash of username.
-    if force:
-        usernamehash = hashlib.sha256(current_user.username.encode(
-            'utf-8')).hexdigest()
-        filename = "thewarden/nav_data/" + usernamehash + current_user.fx() +  ".nav"
-        filename = os.path.join(current_path(), filename)
+    # revalidate is used by the background refresh: rebuilds but keeps the
+    # current file available to other requests until the new one is saved.
+    if force and not revalidate:
+        filename = nav_filename()
         # Since this function can be run as a thread, it's safer to delete
         # the current NAV file if it exists. This avoids other tasks reading
         # the local file which is outdated
@@ -532,10 +570,7 @@ def generatenav(user, force=False, filter=None):
                          " for removal - continuing")
 
     if not force:
-        usernamehash = hashlib.sha256(current_user.username.encode(
-            'utf-8')).hexdigest()
-        filename = "thewarden/nav_data/" + usernamehash + current_user.fx() + ".nav"
-        filename = os.path.join(current_path(), filename)
+        filename = nav_filename()
         try:
             # Check if NAV saved file is recent enough to be used
             # Local file has to have a saved time less than RENEW_NAV min old
@@ -547,6 +582,15 @@ def generatenav(user, force=False, filter=None):
             if (elapsed_seconds / 60) < int(RENEW_NAV):
                 nav_pickle = pd.read_pickle(filename)
                 return (nav_pickle)
+            elif ((elapsed_seconds / 60) < int(NAV_HARD_TTL)
+                  and has_request_context()):
+                logging.info("[generatenav] File is stale - returning it " +
+                             "and refreshing NAV in the background")
+                nav_pickle = pd.read_pickle(filename)
+                background_refresh(
+                    filename, copy_current_request_context(generatenav),
+                    user, force=True, filter=filter, revalidate=True)
+                return (nav_pickle)
             else:
                 logging.info("File found but too old - rebuilding NAV")
 
@@ -706,12 +750,12 @@ def generatenav(user, force=False, filter=None):
 
     # Save NAV Locally as Pickle
     if save_nav:
-        usernamehash = hashlib.sha256(current_user.username.encode(
-            'utf-8')).hexdigest()
-        filename = "thewarden/nav_data/" + usernamehash + current_user.fx() + ".nav"
-        filename = os.path.join(current_path(), filename)
+        filename = nav_filename()
         os.makedirs(os.path.dirname(filename), exist_ok=True)
-        dailynav.to_pickle(filename)
+        # Write to a temporary file first so readers never get a
+        # partially written NAV while it's refreshed in the background
+        dailynav.to_pickle(filename + ".tmp")
+        os.replace(filename + ".tmp", filename)
         logging.info(f"[generatenav] NAV saved to {filename}")
 
     return dailynav
@@ -726,8 +770,8 @@ def regenerate_nav():
     if transactions.count() == 0:
         return
     print("Regenerating NAV. Please wait...")
-    # Delete all pricing history
-    filename = os.path.join(current_path(), 'thewarden/pricing_engine/pricing_data/*.*')
+    # Delete all pricing history (the routing table in the same folder is kept)
+    filename = os.path.join(current_path(), 'thewarden/pricing_engine/pricing_data/*.price')
     aa_files = glob.glob(filename)
     [os.remove(x) for x in aa_files]
     filename = os.path.join(current_path(), 'thewarden/nav_data/*.*')
@@ -741,6 +785,16 @@ def regenerate_nav():
     logging.info("Change to database - generated new NAV")
 
 
+def trade_blockchain_ids(user_id=None):
+    # Set of trade_blockchain_id already in the database for a user
+    # (single query - used to skip transactions already imported)
+    if user_id is None:
+        user_id = current_user.username
+    rows = db.session.query(Trades.trade_blockchain_id).filter(
+        Trades.user_id == user_id, Trades.trade_blockchain_id.isnot(None))
+    return (set(transaction_id for (transaction_id,) in rows))
+
+
 def send_reset_email(user):
     token = user.get_reset_token()
     msg = Message('Password Reset Request',
@@ -757,6 +811,7 @@ def send_reset_email(user):
 
 
 @MWT(timeout=1)
+@timing
 def heatmap_generator():
     # If no Transactions for this user, return empty.html
     transactions = Trades.query.filter_by(user_id=current_user.username).order_by(
@@ -767,57 +822,12 @@ def heatmap_generator():
 
     # Generate NAV Table first
     data = generatenav(current_user.username)
-    data["navpchange"] = (data["NAV_fx"] / data["NAV_fx"].shift(1)) - 1
-    returns = data["navpchange"]
-    # Run the mrh function to generate heapmap table
-    heatmap = mrh.get(returns, eoy=True)
-
+    # Heatmap and stats are computed together and cached for each NAV
+    # version (see analytics/heatmap.py)
+    heatmap = price_heatmap(data["NAV_fx"], key=("NAV", nav_version(data)))
     heatmap_stats = heatmap
-    cols = [
-        "Jan",
-        "Feb",
-        "Mar",
-        "Apr",
-        "May",
-        "Jun",
-        "Jul",
-        "Aug",
-        "Sep",
-        "Oct",
-        "Nov",
-        "Dec",
-        "eoy",
-    ]
-    cols_months = [
-        "Jan",
-        "Feb",
-        "Mar",
-        "Apr",
-        "May",
-        "Jun",
-        "Jul",
-        "Aug",
-        "Sep",
-        "Oct",
-        "Nov",
-        "Dec",
-    ]
+    cols = HEATMAP_COLUMNS
     years = (heatmap.index.tolist())
-    heatmap_stats["MAX"] = heatmap_stats[heatmap_stats[cols_months] != 0].max(axis=1)
-    heatmap_stats["MIN"] = heatmap_stats[heatmap_stats[cols_months] != 0].min(axis=1)
-    heatmap_stats["POSITIVES"] = heatmap_stats[heatmap_stats[cols_months] > 0].count(
-        axis=1
-    )
-    heatmap_stats["NEGATIVES"] = heatmap_stats[heatmap_stats[cols_months] < 0].count(
-        axis=1
-    )
-    heatmap_stats["POS_MEAN"] = heatmap_stats[heatmap_stats[cols_months] > 0].mean(
-        axis=1
-    )
-    heatmap_stats["NEG_MEAN"] = heatmap_stats[heatmap_stats[cols_months] < 0].mean(
-        axis=1
-    )
-    heatmap_stats["MEAN"] = heatmap_stats[heatmap_stats[cols_months] != 0].mean(axis=1)
 
     return (heatmap, heatmap_stats, years, cols)
 
@@ -863,65 +873,16 @@ def fxsymbol(fx, output='symbol'):
 # Helpers for Bitmex start here
 # ------------------------------------
 
-def bitmex_gethistory(ticker):
-    # Gets historical prices from bitmex
-    # Saves to folder
-    from bitmex import bitmex
-    testnet = False
-    logging.info(f"[Bitmex] Trying Bitmex for {ticker}")
-    from thewarden.pricing_engine.pricing import api_keys_class
-    api_keys_json = api_keys_class.loader()
-    bitmex_credentials = api_keys_json['bitmex']
-
-    if ("api_key" in bitmex_credentials) and ("api_secret" in bitmex_credentials):
-        try:
-            mex = bitmex(test=testnet,
-                         api_key=bitmex_credentials['api_key'],
-                         api_secret=bitmex_credentials['api_secret'])
-            # Need to paginate results here to get all the history
-            # Bitmex API end point limits 750 results per call
-            start_bin = 0
-            resp = (mex.Trade.Trade_getBucketed(
-                symbol=ticker, binSize="1d", count=750, start=start_bin).result())[0]
-            df = pd.DataFrame(resp)
-            last_update = df['timestamp'].iloc[-1]
-
-            # If last_update is older than 3 days ago, keep building.
-            while last_update < (datetime.now(timezone.utc) - timedelta(days=3)):
-                start_bin += 750
-                resp = (mex.Trade.Trade_getBucketed(
-                    symbol=ticker, binSize="1d", count=750, start=start_bin).result())[0]
-                df = df.append(resp)
-                last_update = df['timestamp'].iloc[-1]
-                # To avoid an infinite loop, check if start_bin
-                # is higher than 10000 and stop (i.e. 30+yrs of data)
-                if start_bin > 10000:
-                    logging.error("[Bitmex] Something went wrong on price grab loop. Forced quit of loop.")
-                    break
-
-            logging.info(f"[Bitmex] Success. Downloaded data for {ticker}")
-            return(df)
-
-        except Exception as e:
-            logging.error(f"[Bitmex] error: {e}")
-            return ("error")
-
-    else:
-        logging.warning(f"[Bitmex] No Credentials Found")
-        return ('error')
-
-
-def bitmex_orders(api_key, api_secret, testnet=True):
-    # Returns a json with all Bitmex Order History
-    # Takes arguments: ticker, testnet
-    # reads api credentials from file
-    from bitmex import bitmex
+def bitmex_orders(api_key, api_secret, testnet=True, full=False):
+    # Returns a df with all Bitmex executions (newest first) or an error
+    # message. Executions already downloaded are kept and only newer ones
+    # are requested - full=True downloads the whole history again
+    # (see pricing_engine/bitmex_history.py)
+    from thewarden.pricing_engine.bitmex_history import execution_history
     try:
-        mex = bitmex(test=testnet, api_key=api_key, api_secret=api_secret)
-    except Exception:
+        return (execution_history(api_key, api_secret, testnet, full))
+    except ImportError:
         return ("Connection Error. Check your connection.")
-    try:
-        resp = mex.Execution.Execution_getTradeHistory(count=500, start=0, reverse=True).result()
-    except Exception:
-        resp = "Invalid Credential or Connection Error"
-    return(resp)
+    except Exception as e:
+        logging.error(f"[Bitmex] Error getting executions: {e}")
+        return ("Invalid Credential or Connection Error")